@@ -0,0 +1,134 @@
+# breaker.py
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+
+
+class UpstreamUnavailable(Exception):
+    """
+    An upstream call was not made, or gave up, because the upstream is
+    down or over its limits. Views answer it with a 503 and a Retry-After
+    (core.middleware.upstream_unavailable_middleware).
+    """
+
+    def __init__(self, upstream, retry_after, message=None):
+        self.upstream = upstream
+        self.retry_after = retry_after
+        super().__init__(message or f"{upstream} is unavailable, retry in {retry_after:.0f}s")
+
+
+class CircuitOpen(UpstreamUnavailable):
+    def __init__(self, upstream, retry_after):
+        super().__init__(upstream, retry_after, f"{upstream} circuit is open, retry in {retry_after:.0f}s")
+
+
+class CircuitBreaker:
+    """
+    Closed / open / half-open circuit breaker for one upstream, kept in the
+    shared cache so every gunicorn and Celery process sees the same state.
+
+    Closed: calls go through; BREAKER_FAILURES failed calls (5xx or no
+    response, after the client's own retries) within BREAKER_WINDOW
+    seconds open the circuit. Open: calls raise CircuitOpen without
+    touching the network for BREAKER_OPEN_SECONDS. Half-open: one probe
+    call is let through; it closes the circuit on success and opens it
+    again on failure, while every other call still fails fast.
+
+    A closed circuit costs one cache read per call. If the cache itself
+    is unreachable the breaker stays out of the way (treated as closed).
+    """
+
+    CLOSED, OPEN, HALF_OPEN = "closed", "open", "half-open"
+    _warned_at = 0
+
+    def __init__(self, name):
+        self.name = name
+        self.open_key = f"breaker:{name}:open"
+        self.tripped_key = f"breaker:{name}:tripped"
+        self.failures_key = f"breaker:{name}:failures"
+        self.probe_key = f"breaker:{name}:probe"
+
+    def _read(self):
+        try:
+            return cache.get_many([self.open_key, self.tripped_key])
+        except Exception as e:
+            self._warn(f"cannot read the cache: {e}")
+            return {}
+
+    def _warn(self, message):
+        # Once a minute per process, not on every upstream call while the cache is down
+        if time.monotonic() - CircuitBreaker._warned_at > 60:
+            CircuitBreaker._warned_at = time.monotonic()
+            print(f"⚠️ Circuit breaker {self.name} {message}")
+
+    def state(self):
+        values = self._read()
+        if self.open_key in values:
+            return self.OPEN
+        return self.HALF_OPEN if self.tripped_key in values else self.CLOSED
+
+    def before_call(self) -> bool:
+        """
+        Raise CircuitOpen unless the call may go ahead. Returns True when the
+        call is the half-open probe; pass that on to the record_* methods.
+        """
+        values = self._read()
+        if self.open_key in values:
+            raise CircuitOpen(self.name, max(1.0, values[self.open_key] - time.time()))
+        if self.tripped_key not in values:
+            return False
+        try:
+            # Only one process gets to probe; the lock expires with the probe's timeout
+            probe_timeout = settings.UPSTREAM_CONNECT_TIMEOUT + settings.UPSTREAM_READ_TIMEOUT
+            if cache.add(self.probe_key, 1, timeout=probe_timeout):
+                print(f"🔌 Circuit breaker {self.name} half-open, probing")
+                return True
+        except Exception:
+            return False
+        raise CircuitOpen(self.name, 1.0)
+
+    def record_success(self, probe=False):
+        if not probe:
+            return
+        try:
+            cache.delete_many([self.tripped_key, self.failures_key, self.probe_key])
+        except Exception:
+            return
+        print(f"✅ Circuit breaker {self.name} closed")
+
+    def record_failure(self, probe=False):
+        try:
+            if probe:
+                self.trip()
+                return
+            cache.add(self.failures_key, 0, timeout=settings.BREAKER_WINDOW)
+            try:
+                failures = cache.incr(self.failures_key)
+            except ValueError:
+                # The window expired between add() and incr()
+                cache.set(self.failures_key, 1, timeout=settings.BREAKER_WINDOW)
+                failures = 1
+            if failures >= settings.BREAKER_FAILURES:
+                self.trip()
+        except Exception as e:
+            self._warn(f"cannot update the cache: {e}")
+
+    def release(self, probe=False):
+        """The call ended without telling us anything about the upstream (e.g. rate limited)."""
+        if probe:
+            try:
+                cache.delete(self.probe_key)
+            except Exception:
+                pass
+
+    def trip(self, seconds=None):
+        """Open the circuit for `seconds` (BREAKER_OPEN_SECONDS by default), then probe."""
+        open_seconds = seconds or settings.BREAKER_OPEN_SECONDS
+        cache.set(self.open_key, time.time() + open_seconds, timeout=open_seconds)
+        cache.set(self.tripped_key, 1, timeout=None)
+        cache.delete_many([self.failures_key, self.probe_key])
+        print(f"❌ Circuit breaker {self.name} open for {open_seconds}s")
+
+    def reset(self):
+        cache.delete_many([self.open_key, self.tripped_key, self.failures_key, self.probe_key])
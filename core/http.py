@@ -0,0 +1,310 @@
+# http.py
+import asyncio
+import os
+import threading
+import time
+import weakref
+from http.cookiejar import CookieJar, DefaultCookiePolicy
+
+import httpx
+import requests
+from asgiref.sync import async_to_sync
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import ConnectTimeoutError, NewConnectionError
+
+from .breaker import CircuitBreaker
+from .ratelimit import RateLimiter
+
+
+class UpstreamClient:
+    """
+    Pooled HTTP client for one upstream API (GHL, NotaryDash, Google).
+
+    Calls go through one requests.Session per process, so connections are
+    kept alive and reused instead of doing a TCP + TLS handshake for every
+    request. Every request gets connect / read timeouts unless the caller
+    passes its own `timeout`.
+
+    The session is created lazily and again after a fork, so gunicorn and
+    Celery prefork children never share sockets with their parent.
+
+    Requests also go through the upstream's core.ratelimit.RateLimiter:
+    `rate_key` picks the token bucket (e.g. the GHL location), 429s and
+    rate limit headers hold the bucket back for every worker, and
+    retryable failures are retried with backoff. Failed connects are
+    retryable for every method (the request never reached the upstream);
+    pass `idempotency_key` to send an Idempotency-Key header and make other
+    POST failures retryable too. The limiter is the only retry layer, so
+    every retry counts against UPSTREAM_MAX_ATTEMPTS and the retry budget.
+
+    Around all of that sits the upstream's core.breaker.CircuitBreaker:
+    while it is open, requests raise CircuitOpen straight away.
+    """
+
+    def __init__(self, name, connect_timeout=None, read_timeout=None, pool_maxsize=None):
+        self.name = name
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.pool_maxsize = pool_maxsize
+        self._session = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self._limiter = None
+        self.breaker = CircuitBreaker(name)
+
+    @property
+    def limiter(self) -> RateLimiter:
+        if self._limiter is None:
+            self._limiter = RateLimiter(self.name)
+        return self._limiter
+
+    @property
+    def timeout(self):
+        return (
+            self.connect_timeout or settings.UPSTREAM_CONNECT_TIMEOUT,
+            self.read_timeout or settings.UPSTREAM_READ_TIMEOUT,
+        )
+
+    @property
+    def session(self) -> requests.Session:
+        if self._session is None or self._pid != os.getpid():
+            with self._lock:
+                if self._session is None or self._pid != os.getpid():
+                    self._session = self._new_session()
+                    self._pid = os.getpid()
+        return self._session
+
+    def _new_session(self):
+        pool_maxsize = self.pool_maxsize or settings.UPSTREAM_POOL_MAXSIZE
+        adapter = HTTPAdapter(
+            pool_connections=4,
+            pool_maxsize=pool_maxsize,
+            # No retries here: _send retries, within the retry budget
+            max_retries=0,
+        )
+        session = requests.Session()
+        # The APIs authenticate with headers; never carry cookies from one caller to the next
+        session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        return session
+
+    def request(self, method, url, rate_key=None, idempotency_key=None, **kwargs) -> requests.Response:
+        probe = self.breaker.before_call()
+        try:
+            response = self._send(method, url, rate_key, idempotency_key, **kwargs)
+        except (requests.Timeout, requests.ConnectionError):
+            self.breaker.record_failure(probe)
+            raise
+        except BaseException:
+            self.breaker.release(probe)
+            raise
+        if response.status_code >= 500:
+            self.breaker.record_failure(probe)
+        else:
+            self.breaker.record_success(probe)
+        return response
+
+    def _send(self, method, url, rate_key, idempotency_key, **kwargs):
+        kwargs.setdefault("timeout", self.timeout)
+        if idempotency_key:
+            kwargs["headers"] = {**(kwargs.get("headers") or {}), "Idempotency-Key": idempotency_key}
+
+        attempt, waited = 0, 0.0
+        while True:
+            while delay := self.limiter.wait(rate_key, waited):
+                time.sleep(delay)
+                waited += delay
+            try:
+                response = self.session.request(method, url, **kwargs)
+            except (requests.Timeout, requests.ConnectionError) as e:
+                delay = self.limiter.retry_delay(
+                    method, attempt, waited, error=e, idempotent=bool(idempotency_key) or self.never_sent(e)
+                )
+                if delay is None:
+                    raise
+                print(f"⚠️ {self.name} {method} {url} failed ({e}), retrying in {delay:.1f}s")
+            else:
+                self.limiter.observe(rate_key, response)
+                delay = self.limiter.retry_delay(
+                    method, attempt, waited, response=response, idempotent=bool(idempotency_key)
+                )
+                if delay is None:
+                    return response
+                print(f"⚠️ {self.name} {method} {url} returned {response.status_code}, retrying in {delay:.1f}s")
+            time.sleep(delay)
+            waited += delay
+            attempt += 1
+
+    @staticmethod
+    def never_sent(error) -> bool:
+        """True when `error` happened while connecting, so the upstream never saw the request."""
+        if isinstance(error, requests.ConnectTimeout):
+            return True
+        reason = getattr(error.args[0], "reason", None) if error.args else None
+        return isinstance(reason, (NewConnectionError, ConnectTimeoutError))
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request("POST", url, **kwargs)
+
+    def put(self, url, **kwargs):
+        return self.request("PUT", url, **kwargs)
+
+    def delete(self, url, **kwargs):
+        return self.request("DELETE", url, **kwargs)
+
+    def close(self):
+        if self._session is not None:
+            self._session.close()
+            self._session = None
+
+
+class AsyncUpstreamClient:
+    """
+    asyncio counterpart of UpstreamClient, built on httpx.AsyncClient.
+
+    Same timeouts and pool size; speaks HTTP/2 where the upstream offers
+    it (httpx[http2]). An AsyncClient belongs to the event loop it was
+    first used on, so there is one per loop: ASGI views keep theirs for
+    the life of the server loop, and gather() closes the one it used when
+    its loop finishes. Requests beyond the pool size wait for a free
+    connection instead of failing, which also caps how hard one gather()
+    can hit an upstream. Rate limits, retries and the circuit breaker work
+    as in UpstreamClient.
+    """
+
+    _instances = weakref.WeakSet()
+
+    def __init__(self, name, connect_timeout=None, read_timeout=None, pool_maxsize=None):
+        self.name = name
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.pool_maxsize = pool_maxsize
+        self._clients = weakref.WeakKeyDictionary()
+        self._lock = threading.Lock()
+        self._limiter = None
+        self.breaker = CircuitBreaker(name)
+        AsyncUpstreamClient._instances.add(self)
+
+    limiter = UpstreamClient.limiter
+
+    @property
+    def client(self) -> httpx.AsyncClient:
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            client = self._clients.get(loop)
+            if client is None or client.is_closed:
+                client = self._clients[loop] = self._new_client()
+        return client
+
+    def _new_client(self):
+        pool_maxsize = self.pool_maxsize or settings.UPSTREAM_POOL_MAXSIZE
+        return httpx.AsyncClient(
+            timeout=httpx.Timeout(
+                self.read_timeout or settings.UPSTREAM_READ_TIMEOUT,
+                connect=self.connect_timeout or settings.UPSTREAM_CONNECT_TIMEOUT,
+                pool=None,
+            ),
+            limits=httpx.Limits(max_connections=pool_maxsize, max_keepalive_connections=pool_maxsize),
+            # No transport retries: _send retries, within the retry budget
+            transport=httpx.AsyncHTTPTransport(http2=True),
+            # The APIs authenticate with headers; never carry cookies from one caller to the next
+            cookies=httpx.Cookies(CookieJar(policy=DefaultCookiePolicy(allowed_domains=[]))),
+        )
+
+    async def request(self, method, url, rate_key=None, idempotency_key=None, **kwargs) -> httpx.Response:
+        # The breaker state is in the shared cache and the retry budget in Redis;
+        # keep their round trips off the event loop
+        probe = await asyncio.to_thread(self.breaker.before_call)
+        try:
+            response = await self._send(method, url, rate_key, idempotency_key, **kwargs)
+        except (httpx.TimeoutException, httpx.NetworkError):
+            await asyncio.to_thread(self.breaker.record_failure, probe)
+            raise
+        except BaseException:
+            await asyncio.to_thread(self.breaker.release, probe)
+            raise
+        if response.status_code >= 500:
+            await asyncio.to_thread(self.breaker.record_failure, probe)
+        else:
+            await asyncio.to_thread(self.breaker.record_success, probe)
+        return response
+
+    async def _send(self, method, url, rate_key, idempotency_key, **kwargs):
+        if idempotency_key:
+            kwargs["headers"] = {**(kwargs.get("headers") or {}), "Idempotency-Key": idempotency_key}
+
+        attempt, waited = 0, 0.0
+        while True:
+            while delay := await asyncio.to_thread(self.limiter.wait, rate_key, waited):
+                await asyncio.sleep(delay)
+                waited += delay
+            try:
+                response = await self.client.request(method, url, **kwargs)
+            except (httpx.TimeoutException, httpx.NetworkError) as e:
+                delay = await asyncio.to_thread(
+                    self.limiter.retry_delay, method, attempt, waited, error=e,
+                    idempotent=bool(idempotency_key) or isinstance(e, (httpx.ConnectError, httpx.ConnectTimeout)),
+                )
+                if delay is None:
+                    raise
+                print(f"⚠️ {self.name} {method} {url} failed ({e!r}), retrying in {delay:.1f}s")
+            else:
+                await asyncio.to_thread(self.limiter.observe, rate_key, response)
+                delay = await asyncio.to_thread(
+                    self.limiter.retry_delay, method, attempt, waited, response=response,
+                    idempotent=bool(idempotency_key),
+                )
+                if delay is None:
+                    return response
+                print(f"⚠️ {self.name} {method} {url} returned {response.status_code}, retrying in {delay:.1f}s")
+            await asyncio.sleep(delay)
+            waited += delay
+            attempt += 1
+
+    async def get(self, url, **kwargs):
+        return await self.request("GET", url, **kwargs)
+
+    async def post(self, url, **kwargs):
+        return await self.request("POST", url, **kwargs)
+
+    async def put(self, url, **kwargs):
+        return await self.request("PUT", url, **kwargs)
+
+    async def delete(self, url, **kwargs):
+        return await self.request("DELETE", url, **kwargs)
+
+    async def aclose(self):
+        """Close the client of the running event loop, if it has one."""
+        with self._lock:
+            client = self._clients.pop(asyncio.get_running_loop(), None)
+        if client is not None:
+            await client.aclose()
+
+    @classmethod
+    async def aclose_all(cls):
+        for instance in list(cls._instances):
+            await instance.aclose()
+
+
+def gather(*aws, return_exceptions=False):
+    """
+    Sync facade for the async services: run the awaitables concurrently on
+    one event loop and return their results in order, e.g.
+
+        contacts = gather(*(AsyncContactServices.get_contact(loc, cid) for cid in ids))
+
+    Meant for sync code (management commands, Celery tasks, sync views);
+    async code should await asyncio.gather() directly.
+    """
+    async def main():
+        try:
+            return await asyncio.gather(*aws, return_exceptions=return_exceptions)
+        finally:
+            await AsyncUpstreamClient.aclose_all()
+
+    return async_to_sync(main)()
@@ -0,0 +1,45 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from core.breaker import CircuitBreaker
+
+UPSTREAMS = ["ghl", "notarydash", "google"]
+
+
+class Command(BaseCommand):
+    help = (
+        "Show the circuit breaker state of every upstream API, or open / close one by hand "
+        "(e.g. `--open notarydash --for 3600` for an hour of NotaryDash maintenance)."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--open", choices=UPSTREAMS,
+            help="Open this breaker; once it expires the next call probes the upstream as usual.",
+        )
+        parser.add_argument(
+            "--for", dest="seconds", type=int,
+            help="Seconds to keep the breaker opened with --open (default: BREAKER_OPEN_SECONDS).",
+        )
+        parser.add_argument("--close", choices=UPSTREAMS, help="Close this breaker and clear its failure count.")
+
+    def handle(self, *args, **options):
+        if options["seconds"] is not None and (not options["open"] or options["seconds"] < 1):
+            raise CommandError("❌ --for takes a positive number of seconds and needs --open.")
+        try:
+            if options["open"]:
+                CircuitBreaker(options["open"]).trip(options["seconds"])
+            if options["close"]:
+                CircuitBreaker(options["close"]).reset()
+        except Exception as e:
+            raise CommandError(f"❌ Cannot update the breaker state in the cache: {e}")
+
+        self.stdout.write(self.style.MIGRATE_HEADING(f"{'upstream':<12} {'state':<10}"))
+        for name in UPSTREAMS:
+            state = CircuitBreaker(name).state()
+            style = self.style.SUCCESS if state == CircuitBreaker.CLOSED else self.style.ERROR
+            self.stdout.write(f"{name:<12} " + style(f"{state:<10}"))
+        self.stdout.write(
+            f"\nA breaker opens after {settings.BREAKER_FAILURES} failures within {settings.BREAKER_WINDOW}s "
+            f"and probes again after {settings.BREAKER_OPEN_SECONDS}s."
+        )
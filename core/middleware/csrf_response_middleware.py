@@ -1,5 +1,4 @@
 # core/middleware/csrf_response_middleware.py
-import json
 from django.conf import settings
 from django.middleware.csrf import get_token
 from django.utils.deprecation import MiddlewareMixin
@@ -7,11 +6,31 @@ from django.utils.deprecation import MiddlewareMixin
 DEFAULT_FIELD = "csrfToken"
 DEFAULT_HEADER = "X-CSRFToken"
 
+
+def csrf_payload_field(request, charset="utf-8"):
+    """
+    Bytes CsrfInjectMiddleware would splice into a JSON object body, or None
+    when payload injection is off. For views that encode bodies themselves
+    (Content-Encoding set), which the middleware leaves untouched.
+    """
+    if not getattr(settings, "CSRF_IN_RESPONSE_PAYLOAD", True):
+        return None
+    try:
+        token = get_token(request)
+    except Exception:
+        return None
+    field_name = getattr(settings, "CSRF_IN_RESPONSE_FIELD", DEFAULT_FIELD)
+    return f'"{field_name}":"{token}"'.encode(charset)
+
+
 class CsrfInjectMiddleware(MiddlewareMixin):
     """
     Ensure a CSRF token exists for the request (get_token())
     and, for GET responses with JSON content, inject a top-level
     field containing the token. Always sets X-CSRFToken header.
+
+    The token is spliced into the already-encoded body, so large payloads
+    (e.g. catalog snapshots) are never parsed or re-serialized here.
     """
 
     def __init__(self, get_response=None):
@@ -44,36 +63,39 @@ class CsrfInjectMiddleware(MiddlewareMixin):
         if token:
             response[self.header_name] = token
 
-        # Only consider injecting into GET JSON responses (common SPA pattern)
+        # Header-only mode: nothing else to do
+        if not (self.inject_into_payload and token):
+            return response
+
+        # Only consider injecting into GET JSON responses (common SPA pattern).
+        # Streaming bodies can't be spliced and encoded ones would be corrupted.
         if (
-            self.inject_into_payload
-            and request.method.upper() == "GET"
-            and token
-            and response.get("Content-Type")
-            and any(ct in response["Content-Type"] for ct in self.json_content_types)
+            request.method.upper() != "GET"
+            or response.streaming
+            or response.has_header("Content-Encoding")
+            or not any(ct in response.get("Content-Type", "") for ct in self.json_content_types)
         ):
-            try:
-                # response.content may be bytes; decode for parsing
-                content = response.content.decode(response.charset or "utf-8")
-                payload = json.loads(content)
-
-                # Only modify if payload is a JSON object (dict). Avoid arrays, strings.
-                if isinstance(payload, dict):
-                    # don't overwrite if key exists unless configured
-                    if self.field_name not in payload:
-                        payload[self.field_name] = token
-                    else:
-                        # optional: you may choose to overwrite existing value:
-                        # payload[self.field_name] = token
-                        pass
-
-                    new_content = json.dumps(payload, ensure_ascii=False)
-                    response.content = new_content.encode(response.charset or "utf-8")
-                    # update proper content-length header
-                    if response.has_header("Content-Length"):
-                        response["Content-Length"] = str(len(response.content))
-            except Exception:
-                # Parsing/encoding should not break the response; skip injection if any error
-                pass
+            return response
+
+        content = response.content
+        charset = response.charset or "utf-8"
+        field = f'"{self.field_name}"'.encode(charset)
+
+        # Only modify JSON objects (not arrays/strings), and don't overwrite an
+        # existing key. The body is spliced as bytes instead of being parsed and
+        # re-encoded: the token goes right after the opening brace. Only a key
+        # in that first position counts as existing; the same name inside a
+        # nested object or a string value must not stop the injection.
+        start = len(content) - len(content.lstrip())
+        rest = content[start + 1:]
+        if content[start:start + 1] != b"{" or rest.lstrip().startswith(field):
+            return response
+
+        separator = b"" if rest.lstrip().startswith(b"}") else b","
+        injected = field + b":" + f'"{token}"'.encode(charset) + separator
+        response.content = content[:start + 1] + injected + rest
+        # update proper content-length header
+        if response.has_header("Content-Length"):
+            response["Content-Length"] = str(len(response.content))
 
         return response
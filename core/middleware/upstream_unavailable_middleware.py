@@ -0,0 +1,31 @@
+# core/middleware/upstream_unavailable_middleware.py
+import math
+
+from django.http import JsonResponse
+from django.utils.deprecation import MiddlewareMixin
+
+from core.breaker import UpstreamUnavailable
+
+
+class UpstreamUnavailableMiddleware(MiddlewareMixin):
+    """
+    Turn an UpstreamUnavailable (open circuit breaker, rate limit wait too
+    long) escaping a view into a 503 with Retry-After, instead of a 500.
+    The client can retry once the breaker is due to let a probe through.
+    """
+
+    def process_exception(self, request, exception):
+        if not isinstance(exception, UpstreamUnavailable):
+            return None
+        retry_after = max(1, math.ceil(exception.retry_after))
+        print(f"⚠️ {request.method} {request.path}: {exception}")
+        response = JsonResponse(
+            {
+                "error": f"{exception.upstream} is temporarily unavailable, please try again shortly.",
+                "upstream": exception.upstream,
+                "retry_after": retry_after,
+            },
+            status=503,
+        )
+        response["Retry-After"] = str(retry_after)
+        return response
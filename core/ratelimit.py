@@ -0,0 +1,227 @@
+# ratelimit.py
+import random
+import threading
+import time
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+
+import redis
+from django.conf import settings
+
+from .breaker import UpstreamUnavailable
+
+
+class RateLimited(UpstreamUnavailable):
+    """An upstream call would have to wait longer than UPSTREAM_MAX_WAIT for its rate limit."""
+
+    def __init__(self, upstream, retry_after):
+        super().__init__(upstream, retry_after, f"{upstream} rate limit: next request allowed in {retry_after:.1f}s")
+
+
+# Token bucket in one round trip. Uses the Redis clock, so workers on different
+# hosts agree on refills. Returns the seconds to wait (as a string, Lua numbers
+# would be truncated to integers); 0 means a token was taken. ARGV[4] > 0 blocks
+# the bucket for that many seconds (a 429 Retry-After or an exhausted quota).
+TOKEN_BUCKET_SCRIPT = """
+local t = redis.call('TIME')
+local now = tonumber(t[1]) + tonumber(t[2]) / 1000000
+local rate, capacity = tonumber(ARGV[1]), tonumber(ARGV[2])
+local requested, block = tonumber(ARGV[3]), tonumber(ARGV[4])
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'ts', 'blocked')
+local tokens = tonumber(state[1]) or capacity
+local ts = tonumber(state[2]) or now
+local blocked = tonumber(state[3]) or 0
+tokens = math.min(capacity, tokens + math.max(0, now - ts) * rate)
+if block > 0 then
+    blocked = math.max(blocked, now + block)
+    tokens = 0
+end
+local wait = 0
+if now < blocked then
+    wait = blocked - now
+elseif tokens >= requested then
+    tokens = tokens - requested
+else
+    wait = (requested - tokens) / rate
+end
+-- A blocked bucket starts refilling when the block ends
+redis.call('HSET', KEYS[1], 'tokens', tokens, 'ts', math.max(now, blocked), 'blocked', blocked)
+redis.call('EXPIRE', KEYS[1], math.ceil(capacity / rate + math.max(0, blocked - now)) + 1)
+return tostring(wait)
+"""
+
+
+class TokenBucket:
+    """
+    Token buckets shared by every gunicorn / Celery process through Redis
+    (settings.RATELIMIT_REDIS_URL, the Celery broker by default).
+
+    If Redis cannot be reached the buckets are kept in this process for
+    RATELIMIT_REDIS_RETRY seconds before Redis is tried again: the limits
+    then only hold per process, but upstream calls never fail because of
+    the limiter itself.
+    """
+
+    _redis = None
+    _script = None
+    _redis_down_until = 0
+    _local = {}
+    _lock = threading.Lock()
+
+    def __init__(self, name, rate, capacity):
+        self.name = name
+        self.rate = float(rate)
+        self.capacity = float(capacity)
+
+    @classmethod
+    def _client(cls):
+        if cls._redis is None:
+            cls._redis = redis.Redis.from_url(
+                settings.RATELIMIT_REDIS_URL, socket_connect_timeout=0.5, socket_timeout=0.5,
+            )
+            cls._script = cls._redis.register_script(TOKEN_BUCKET_SCRIPT)
+        return cls._redis
+
+    def take(self, key=None, tokens=1, block=0) -> float:
+        """Take `tokens` from the bucket; returns 0, or the seconds until they are available."""
+        bucket_key = f"ratelimit:{self.name}:{key}" if key else f"ratelimit:{self.name}"
+        if time.monotonic() >= TokenBucket._redis_down_until:
+            try:
+                self._client()
+                return float(TokenBucket._script(keys=[bucket_key], args=[self.rate, self.capacity, tokens, block]))
+            except redis.RedisError as e:
+                TokenBucket._redis_down_until = time.monotonic() + settings.RATELIMIT_REDIS_RETRY
+                print(f"⚠️ Rate limiter cannot reach Redis, limiting per process for now: {e}")
+        return self._take_local(bucket_key, tokens, block)
+
+    def _take_local(self, bucket_key, tokens, block):
+        # Same algorithm as TOKEN_BUCKET_SCRIPT
+        with TokenBucket._lock:
+            now = time.monotonic()
+            level, ts, blocked = TokenBucket._local.get(bucket_key, (self.capacity, now, 0))
+            level = min(self.capacity, level + max(0, now - ts) * self.rate)
+            if block > 0:
+                blocked = max(blocked, now + block)
+                level = 0
+            wait = 0
+            if now < blocked:
+                wait = blocked - now
+            elif level >= tokens:
+                level -= tokens
+            else:
+                wait = (tokens - level) / self.rate
+            TokenBucket._local[bucket_key] = (level, max(now, blocked), blocked)
+            return wait
+
+
+def retry_after(response):
+    """Seconds a 429 / 503 response asks us to wait (Retry-After as seconds or an HTTP date)."""
+    value = response.headers.get("Retry-After")
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+
+def quota_reset(response):
+    """
+    Seconds until the upstream's quota refills when a response says it is
+    used up: GHL's X-RateLimit-Remaining / X-RateLimit-Interval-Milliseconds,
+    or the common X-RateLimit-Reset / RateLimit-Reset (delta or epoch seconds).
+    """
+    headers = response.headers
+    remaining = headers.get("X-RateLimit-Remaining") or headers.get("RateLimit-Remaining")
+    if remaining is None or remaining.strip() != "0":
+        return None
+    try:
+        if headers.get("X-RateLimit-Interval-Milliseconds"):
+            return float(headers["X-RateLimit-Interval-Milliseconds"]) / 1000
+        reset = float(headers.get("X-RateLimit-Reset") or headers.get("RateLimit-Reset"))
+    except (TypeError, ValueError):
+        return None
+    # Large values are a unix timestamp, not a delta
+    return max(0.0, reset - time.time()) if reset > 10 ** 9 else reset
+
+
+class RateLimiter:
+    """
+    Rate limit and retry policy for one upstream (UPSTREAM_RATE_LIMITS, keyed
+    by UpstreamClient name). The clients call wait() before every request and
+    retry_delay() after it; both work in seconds and never sleep themselves,
+    so the sync and the async client share them.
+
+    Retries use full-jitter exponential backoff, or the upstream's Retry-After
+    when it sends one. A 429 is retried for every method (the request was not
+    processed); a 5xx, timeout or dropped connection only for idempotent
+    methods and for POSTs sent with an idempotency key (the clients pass
+    idempotent=True for failed connects too, which never reached the
+    upstream). Retries also draw
+    from a per-upstream retry budget, so a failing upstream sees at most a
+    few retries per second from all workers together instead of a storm.
+    """
+
+    IDEMPOTENT_METHODS = {"GET", "HEAD", "OPTIONS", "PUT", "DELETE"}
+    RETRY_STATUSES = {500, 502, 503, 504}
+
+    def __init__(self, name):
+        self.name = name
+        limit = settings.UPSTREAM_RATE_LIMITS.get(name)
+        self.bucket = TokenBucket(name, *limit) if limit else None
+        self.retry_budget = TokenBucket(f"{name}:retries", *settings.UPSTREAM_RETRY_BUDGET)
+        self.max_attempts = settings.UPSTREAM_MAX_ATTEMPTS
+        self.max_wait = settings.UPSTREAM_MAX_WAIT
+
+    def wait(self, key=None, waited=0.0) -> float:
+        """
+        Take a token: returns 0 when the request may go now, else the seconds
+        to sleep before asking again. Raises RateLimited once the call would
+        have waited more than max_wait in total.
+        """
+        if self.bucket is None:
+            return 0
+        delay = self.bucket.take(key)
+        if delay and waited + delay > self.max_wait:
+            raise RateLimited(self.name, delay)
+        return delay
+
+    def observe(self, key, response):
+        """Hold the bucket back when the upstream says we are over its limit."""
+        if self.bucket is None:
+            return
+        pause = retry_after(response) if response.status_code == 429 else quota_reset(response)
+        if response.status_code == 429 and pause is None:
+            pause = 1.0
+        if pause:
+            self.bucket.take(key, tokens=0, block=pause)
+
+    def retry_delay(self, method, attempt, waited=0.0, response=None, error=None, idempotent=False):
+        """Seconds to wait before attempt number `attempt + 1`, or None to stop."""
+        if attempt + 1 >= self.max_attempts:
+            return None
+        if response is not None:
+            status = response.status_code
+            if status == 429:
+                delay = retry_after(response)
+            elif status in self.RETRY_STATUSES and (idempotent or method.upper() in self.IDEMPOTENT_METHODS):
+                delay = retry_after(response) if status == 503 else None
+            else:
+                return None
+        elif error is not None and (idempotent or method.upper() in self.IDEMPOTENT_METHODS):
+            delay = None
+        else:
+            return None
+
+        backoff = random.uniform(0, min(settings.UPSTREAM_BACKOFF_CAP, settings.UPSTREAM_BACKOFF_BASE * 2 ** attempt))
+        delay = backoff if delay is None else delay + backoff / 4
+        if waited + delay > self.max_wait:
+            return None
+        if self.retry_budget.take() > 0:
+            print(f"⚠️ {self.name} retry budget used up, not retrying {method} ({attempt + 1} attempts)")
+            return None
+        return delay
@@ -0,0 +1,53 @@
+# core/renderers.py
+"""
+orjson based drop-in replacements for DRF's JSONRenderer / JSONParser.
+
+Output is byte-compatible with DRF's compact, non-ASCII-escaped JSON:
+UUIDs are encoded natively, Decimal and datetime values go through DRF's own
+encoder so their formatting (COERCE_DECIMAL_TO_STRING, trailing 'Z') does not
+change for the frontend.
+"""
+import orjson
+from rest_framework.utils import encoders
+from rest_framework.exceptions import ParseError
+from rest_framework.parsers import JSONParser
+from rest_framework.renderers import JSONRenderer
+
+ORJSON_OPTIONS = orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME
+
+_drf_encoder = encoders.JSONEncoder()
+
+
+def _default(obj):
+    # Decimal, date/time, timedelta, querysets, lazy strings, ...
+    return _drf_encoder.default(obj)
+
+
+def dumps(data, indent=False) -> bytes:
+    """Encode `data` the same way ORJSONRenderer does."""
+    option = (ORJSON_OPTIONS | orjson.OPT_INDENT_2) if indent else ORJSON_OPTIONS
+    ret = orjson.dumps(data, default=_default, option=option)
+    # Same as DRF: keep the output safe to embed in <script> tags
+    if b"\xe2\x80\xa8" in ret or b"\xe2\x80\xa9" in ret:
+        ret = ret.replace(b"\xe2\x80\xa8", b"\\u2028").replace(b"\xe2\x80\xa9", b"\\u2029")
+    return ret
+
+
+class ORJSONRenderer(JSONRenderer):
+    """JSONRenderer backed by orjson."""
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b""
+        indent = self.get_indent(accepted_media_type, renderer_context or {})
+        return dumps(data, indent=bool(indent))
+
+
+class ORJSONParser(JSONParser):
+    """JSONParser backed by orjson (expects UTF-8 request bodies)."""
+
+    def parse(self, stream, media_type=None, parser_context=None):
+        try:
+            return orjson.loads(stream.read())
+        except orjson.JSONDecodeError as exc:
+            raise ParseError(f"JSON parse error - {exc}")
@@ -1,29 +1,34 @@
-import requests
 from django.utils.timezone import now
 from datetime import timedelta
 from django.utils.timezone import is_naive, make_aware
+from .http import AsyncUpstreamClient, UpstreamClient
 from .models import OAuthToken, Contact
 from django.conf import settings
 from django.db import transaction
-import requests 
 from datetime import datetime
 from typing import Any
 import json, os
 from django.utils.dateparse import parse_datetime
 from django.contrib.contenttypes.models import ContentType
 from django.apps import apps
+from asgiref.sync import sync_to_async
 
+import asyncio
 import time
 
 
 
 
-TOKEN_URL = 'https://services.leadconnectorhq.com/oauth/token'
+BASE_URL = settings.GHL_BASE_URL
+TOKEN_URL = f'{BASE_URL}/oauth/token'
 LIMIT_PER_PAGE = 100
-BASE_URL = 'https://services.leadconnectorhq.com'
 API_VERSION = "2021-07-28"
 MIGRATED_TASKS_FILE = "migrated_tasks.json"
 FAILED_TASKS_FILE = "failed_tasks.json"
+PULL_LOCATION_IDS = ['HBMH06bPfTaKkZx49Y4x']
+
+ghl = UpstreamClient("ghl")
+ghl_async = AsyncUpstreamClient("ghl")
 
 class OAuthTokenError(Exception):
     '''Custom exeption for Oauth token-related errors'''
@@ -72,7 +77,7 @@ class OAuthServices:
             'code' : auth_code,
         }
         # print(payload)
-        response =requests.post(TOKEN_URL,headers=headers,data=payload)
+        response =ghl.post(TOKEN_URL,headers=headers,data=payload)
         token_data = response.json()
 
         
@@ -115,7 +120,7 @@ class OAuthServices:
             'refresh_token': token_obj.refresh_token
         }
         print(f"payload: {payload}")
-        response = requests.post(TOKEN_URL, data=payload)
+        response = ghl.post(TOKEN_URL, data=payload, rate_key=location_id)
 
         if response.status_code != 200:
             raise OAuthTokenError(f"Failed to refresh access token: {response.json()}")
@@ -158,7 +163,7 @@ class ContactServices:
       
         url = f"{BASE_URL}/contacts/{contact_id}"
 
-        response = requests.get(url, headers=headers)
+        response = ghl.get(url, headers=headers, rate_key=location_id)
 
         if response.status_code == 200:
             return response.json()
@@ -196,8 +201,8 @@ class ContactServices:
     @staticmethod
     def post_contact(location_id, contact_data):
         headers = OAuthServices.get_valid_headers(location_id)
-        url = "https://services.leadconnectorhq.com/contacts/"
-        response = requests.post(url, headers=headers, json=contact_data)
+        url = f"{BASE_URL}/contacts/"
+        response = ghl.post(url, headers=headers, json=contact_data, rate_key=location_id)
 
         if response.status_code == 201:
             # print(json.dumps(response.json(),indent=4))
@@ -221,7 +226,7 @@ class ContactServices:
         }
 
         if url:
-            response = requests.get(url, headers=headers)
+            response = ghl.get(url, headers=headers, rate_key=location_id)
         else:
             url = f"{BASE_URL}/contacts/"
             params = {
@@ -230,7 +235,7 @@ class ContactServices:
             }
             if query:
                 params["query"] = query
-            response = requests.get(url, headers=headers, params=params)
+            response = ghl.get(url, headers=headers, params=params, rate_key=location_id)
 
         if response.status_code == 200:
             return response.json()
@@ -244,7 +249,7 @@ class ContactServices:
         """
         imported_contacts_summary = []
         # location_ids = list(OAuthToken.objects.values_list('LocationId', flat=True))
-        location_ids = ['HBMH06bPfTaKkZx49Y4x']
+        location_ids = PULL_LOCATION_IDS
         for location_id in location_ids:
             tokenobj: OAuthToken = OAuthServices.get_valid_access_token_obj(location_id)
             all_contacts = []
@@ -344,7 +349,7 @@ class ContactServices:
         url = f"{BASE_URL}/contacts/search"
         payload = {**query}  # Assuming query is a dict with search parameters
         # print(f"search payload: {json.dumps(payload, indent=4)}")
-        response = requests.post(url, headers=headers, json=payload)
+        response = ghl.post(url, headers=headers, json=payload, rate_key=location_id)
         # print(f"search result: {json.dumps(response.json(), indent=4)}")
         if response.status_code == 200:
         
@@ -365,7 +370,7 @@ class ContactServices:
         url = f"{BASE_URL}/contacts/{contact_obj.id}"
       
 
-        response = requests.put(url, headers=headers, json=data)
+        response = ghl.put(url, headers=headers, json=data, rate_key=contact_obj.location_id)
 
         if response.status_code == 200:
             return response.json()
@@ -373,5 +378,109 @@ class ContactServices:
             raise ContactServiceError(f"API request failed: {response.status_code}")
 
 
-    
+class AsyncContactServices:
+    """
+    Async counterparts of ContactServices, sharing one httpx client per event
+    loop (core.http.AsyncUpstreamClient), so many GHL calls can be in flight
+    on one thread. Token lookups and contact saves still hit the database
+    through sync_to_async. From sync code, run them with core.http.gather().
+    """
+
+    @staticmethod
+    async def get_contact(location_id, contact_id):
+        headers = await sync_to_async(OAuthServices.get_valid_headers)(location_id)
+        url = f"{BASE_URL}/contacts/{contact_id}"
+
+        response = await ghl_async.get(url, headers=headers, rate_key=location_id)
+
+        if response.status_code == 200:
+            return response.json()
+        else:
+            raise ContactServiceError(f"API request failed: {response.status_code}")
+
+    @staticmethod
+    async def save_contact(contact):
+        return await sync_to_async(ContactServices.save_contact)(contact)
+
+    @staticmethod
+    async def post_contact(location_id, contact_data):
+        headers = await sync_to_async(OAuthServices.get_valid_headers)(location_id)
+        url = f"{BASE_URL}/contacts/"
+        response = await ghl_async.post(url, headers=headers, json=contact_data, rate_key=location_id)
+
+        if response.status_code == 201:
+            await AsyncContactServices.save_contact(response.json().get("contact"))
+            return response.json().get("contact", {}), response.status_code
+        else:
+            print(f"\033[91m❌ Failed to create contact: {response.status_code} - {response.text}\033[0m")
+            return response.json(), response.status_code
 
+    @staticmethod
+    async def get_contacts(location_id, query=None, url=None, limit=LIMIT_PER_PAGE):
+        token_obj = await sync_to_async(OAuthServices.get_valid_access_token_obj)(location_id)
+        headers = {
+            "Authorization": f"Bearer {token_obj.access_token}",
+            "Content-Type": "application/json",
+            "Version": API_VERSION,
+        }
+
+        if url:
+            response = await ghl_async.get(url, headers=headers, rate_key=location_id)
+        else:
+            url = f"{BASE_URL}/contacts/"
+            params = {
+                "locationId": token_obj.LocationId,
+                "limit": limit,
+            }
+            if query:
+                params["query"] = query
+            response = await ghl_async.get(url, headers=headers, params=params, rate_key=location_id)
+
+        if response.status_code == 200:
+            return response.json()
+        else:
+            raise ContactServiceError(f"API request failed: {response.status_code}")
+
+    @staticmethod
+    async def pull_contacts(query=None):
+        """
+        Like ContactServices.pull_contacts, with the locations pulled concurrently.
+        Pages of one location still follow each other (each holds the next page URL).
+        """
+        async def pull_location(location_id):
+            all_contacts = []
+            url = None
+            while True:
+                response_data = await AsyncContactServices.get_contacts(location_id=location_id, query=query, url=url)
+                all_contacts.extend(response_data.get("contacts", []))
+                url = response_data.get("meta", {}).get("nextPageUrl")
+                if not url:
+                    break
+            print(f"completed fetching, Saving {len(all_contacts)} Contacts")
+            await sync_to_async(ContactServices._save_contacts)(all_contacts)
+            return f"{location_id}: Imported {len(all_contacts)} contacts"
+
+        return list(await asyncio.gather(*(pull_location(location_id) for location_id in PULL_LOCATION_IDS)))
+
+    @staticmethod
+    async def search_contacts(location_id, query):
+        headers = await sync_to_async(OAuthServices.get_valid_headers)(location_id)
+        url = f"{BASE_URL}/contacts/search"
+        response = await ghl_async.post(url, headers=headers, json={**query}, rate_key=location_id)
+
+        if response.status_code == 200:
+            return response.json()
+        else:
+            raise ContactServiceError(f"API request failed: {response.status_code}")
+
+    @staticmethod
+    async def push_contact(contact_obj: Contact, data):
+        headers = await sync_to_async(OAuthServices.get_valid_headers)(contact_obj.location_id)
+        url = f"{BASE_URL}/contacts/{contact_obj.id}"
+
+        response = await ghl_async.put(url, headers=headers, json=data, rate_key=contact_obj.location_id)
+
+        if response.status_code == 200:
+            return response.json()
+        else:
+            raise ContactServiceError(f"API request failed: {response.status_code}")
@@ -1,3 +1,432 @@
-from django.test import TestCase
+import asyncio
+import io
+import json
+import time
+import uuid
+from datetime import date, datetime, timedelta, timezone
+from decimal import Decimal
+from types import SimpleNamespace
+from unittest import mock
 
-# Create your tests here.
+import httpx
+import requests
+from django.core.cache import cache
+from django.core.management import call_command
+from django.http import HttpResponse
+from django.test import RequestFactory, SimpleTestCase, override_settings
+from requests.adapters import HTTPAdapter
+from rest_framework import serializers
+from rest_framework.exceptions import ParseError
+from rest_framework.renderers import JSONRenderer
+from urllib3.exceptions import MaxRetryError, NewConnectionError, ProtocolError
+
+from core.breaker import CircuitBreaker, CircuitOpen
+from core.http import AsyncUpstreamClient, UpstreamClient, gather
+from core.middleware.csrf_response_middleware import CsrfInjectMiddleware
+from core.middleware.upstream_unavailable_middleware import UpstreamUnavailableMiddleware
+from core.ratelimit import RateLimited, RateLimiter, TokenBucket
+from core.renderers import ORJSONParser, ORJSONRenderer
+
+
+LOCMEM = {"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache", "LOCATION": "core-tests"}}
+
+
+def local_buckets(test):
+    """Run `test`'s token buckets in process, as if Redis were down, starting from empty state."""
+    for name, value in (("_redis_down_until", time.monotonic() + 3600), ("_local", {})):
+        patcher = mock.patch.object(TokenBucket, name, value)
+        patcher.start()
+        test.addCleanup(patcher.stop)
+
+
+def response(status_code, **headers):
+    return SimpleNamespace(status_code=status_code, headers=headers)
+
+
+@override_settings(CSRF_IN_RESPONSE_PAYLOAD=True)
+class CsrfInjectMiddlewareTests(SimpleTestCase):
+    def respond(self, body, method="get", content_type="application/json", **headers):
+        request = getattr(RequestFactory(), method)("/")
+        response = HttpResponse(body, content_type=content_type, headers=headers)
+        response["Content-Length"] = str(len(response.content))
+        return CsrfInjectMiddleware(lambda request: response)(request)
+
+    def test_token_is_spliced_in_as_the_first_key(self):
+        response = self.respond(b'{"a": 1, "b": [1, 2]}')
+        data = json.loads(response.content)
+        self.assertEqual(list(data), ["csrfToken", "a", "b"])
+        self.assertEqual(data["a"], 1)
+        self.assertEqual(response["Content-Length"], str(len(response.content)))
+        self.assertEqual(response["X-CSRFToken"], data["csrfToken"])
+
+    def test_empty_object_gets_no_trailing_comma(self):
+        for body in (b"{}", b"  { \n }"):
+            with self.subTest(body=body):
+                response = self.respond(body)
+                self.assertEqual(list(json.loads(response.content)), ["csrfToken"])
+
+    def test_leading_whitespace_is_kept(self):
+        response = self.respond(b'\n {"a": 1}')
+        self.assertTrue(response.content.startswith(b'\n {"csrfToken":'))
+        self.assertEqual(json.loads(response.content)["a"], 1)
+
+    def test_bodies_left_alone(self):
+        cases = {
+            "array": self.respond(b"[1, 2]"),
+            "existing field": self.respond(b'{"csrfToken": "mine"}'),
+            "post": self.respond(b'{"a": 1}', method="post"),
+            "html": self.respond(b"{}", content_type="text/html"),
+            "encoded": self.respond(b"{}", **{"Content-Encoding": "gzip"}),
+        }
+        for name, response in cases.items():
+            with self.subTest(name):
+                self.assertNotIn(b'"csrfToken":"', response.content)
+                self.assertIn("X-CSRFToken", response)
+
+    def test_nested_or_quoted_field_names_do_not_count_as_existing(self):
+        for body in (b'{"user": {"csrfToken": "theirs"}}', b'{"note": "\\"csrfToken\\": x"}'):
+            with self.subTest(body=body):
+                response = self.respond(body)
+                data = json.loads(response.content)
+                self.assertEqual(list(data)[0], "csrfToken")
+                self.assertEqual(data["csrfToken"], response["X-CSRFToken"])
+                self.assertEqual({**data, "csrfToken": None}, {"csrfToken": None, **json.loads(body)})
+
+    @override_settings(CSRF_IN_RESPONSE_PAYLOAD=False)
+    def test_header_only_mode(self):
+        response = self.respond(b'{"a": 1}')
+        self.assertEqual(response.content, b'{"a": 1}')
+        self.assertIn("X-CSRFToken", response)
+
+
+class ORJSONTests(SimpleTestCase):
+    DATA = {
+        "price": Decimal("1234.50"),
+        "discount": Decimal("0.10"),
+        "created_at": datetime(2025, 3, 4, 5, 6, 7, 890123, tzinfo=timezone.utc),
+        "local_at": datetime(2025, 3, 4, 5, 6, 7, tzinfo=timezone(timedelta(hours=-5))),
+        "day": date(2025, 3, 4),
+        "id": uuid.UUID("12345678-1234-5678-1234-567812345678"),
+        "name": "Café \u2028 line",
+        7: [None, True, 1.5],
+    }
+
+    def test_output_matches_drf(self):
+        self.assertEqual(ORJSONRenderer().render(self.DATA), JSONRenderer().render(self.DATA))
+
+    def test_decimal_and_datetime_round_trip(self):
+        class PriceSerializer(serializers.Serializer):
+            price = serializers.DecimalField(max_digits=8, decimal_places=2)
+            created_at = serializers.DateTimeField()
+            id = serializers.UUIDField()
+
+        sent = {key: self.DATA[key] for key in ("price", "created_at", "id")}
+        body = ORJSONRenderer().render(PriceSerializer(sent).data)
+        parsed = ORJSONParser().parse(io.BytesIO(body))
+        self.assertEqual(parsed["price"], "1234.50")
+        received = PriceSerializer(data=parsed)
+        self.assertTrue(received.is_valid(), received.errors)
+        self.assertEqual(received.validated_data, sent)
+
+    def test_plain_values_parse_back(self):
+        parsed = ORJSONParser().parse(io.BytesIO(ORJSONRenderer().render(self.DATA)))
+        self.assertEqual(Decimal(str(parsed["price"])), self.DATA["price"])
+        self.assertEqual(parsed["created_at"], "2025-03-04T05:06:07.890123Z")
+        self.assertEqual(datetime.fromisoformat(parsed["local_at"]), self.DATA["local_at"])
+        self.assertEqual((parsed["day"], parsed["id"]), ("2025-03-04", str(self.DATA["id"])))
+        self.assertEqual(parsed["7"], [None, True, 1.5])
+
+    def test_invalid_body_is_a_parse_error(self):
+        with self.assertRaises(ParseError):
+            ORJSONParser().parse(io.BytesIO(b'{"price": 1,}'))
+
+
+class TokenBucketTests(SimpleTestCase):
+    def setUp(self):
+        local_buckets(self)
+        self.bucket = TokenBucket("test", rate=10, capacity=3)
+
+    def test_burst_then_refill_rate(self):
+        self.assertEqual([self.bucket.take("k") for _ in range(3)], [0, 0, 0])
+        self.assertAlmostEqual(self.bucket.take("k"), 0.1, delta=0.02)
+        time.sleep(0.12)
+        self.assertEqual(self.bucket.take("k"), 0)
+
+    def test_keys_have_their_own_buckets(self):
+        for _ in range(3):
+            self.bucket.take("location-1")
+        self.assertGreater(self.bucket.take("location-1"), 0)
+        self.assertEqual(self.bucket.take("location-2"), 0)
+
+    def test_block_holds_the_bucket_back(self):
+        self.bucket.take("k", tokens=0, block=2)
+        self.assertAlmostEqual(self.bucket.take("k"), 2, delta=0.05)
+
+    @override_settings(RATELIMIT_REDIS_URL="redis://127.0.0.1:1/0", RATELIMIT_REDIS_RETRY=30)
+    def test_unreachable_redis_falls_back_to_process_buckets(self):
+        TokenBucket._redis_down_until = 0
+        with mock.patch.object(TokenBucket, "_redis", None), mock.patch.object(TokenBucket, "_script", None):
+            self.assertEqual(self.bucket.take("k"), 0)
+        self.assertGreater(TokenBucket._redis_down_until, time.monotonic() + 20)
+        self.assertIn("ratelimit:test:k", TokenBucket._local)
+
+
+@override_settings(
+    UPSTREAM_RATE_LIMITS={"test": (10, 2)}, UPSTREAM_RETRY_BUDGET=(1, 10),
+    UPSTREAM_MAX_ATTEMPTS=3, UPSTREAM_MAX_WAIT=5, UPSTREAM_BACKOFF_BASE=0.5, UPSTREAM_BACKOFF_CAP=20,
+)
+class RateLimiterTests(SimpleTestCase):
+    def setUp(self):
+        local_buckets(self)
+        self.limiter = RateLimiter("test")
+
+    def test_wait_gives_up_past_max_wait(self):
+        self.assertEqual(self.limiter.wait("k"), 0)
+        self.assertEqual(self.limiter.wait("k"), 0)
+        self.assertGreater(self.limiter.wait("k"), 0)
+        with self.assertRaises(RateLimited):
+            self.limiter.wait("k", waited=5)
+
+    def test_429_is_retried_for_every_method_after_its_retry_after(self):
+        delay = self.limiter.retry_delay("POST", 0, response=response(429, **{"Retry-After": "2"}))
+        self.assertGreaterEqual(delay, 2)
+        self.assertLessEqual(delay, 2 + 0.5 / 4)
+
+    def test_server_errors_are_only_retried_when_idempotent(self):
+        self.assertIsNotNone(self.limiter.retry_delay("GET", 0, response=response(502)))
+        self.assertIsNone(self.limiter.retry_delay("POST", 0, response=response(502)))
+        self.assertIsNotNone(self.limiter.retry_delay("POST", 0, response=response(502), idempotent=True))
+        self.assertIsNone(self.limiter.retry_delay("GET", 0, response=response(404)))
+        self.assertIsNotNone(self.limiter.retry_delay("GET", 0, error=ConnectionError()))
+        self.assertIsNone(self.limiter.retry_delay("POST", 0, error=ConnectionError()))
+
+    @override_settings(UPSTREAM_RETRY_BUDGET=(1, 2))
+    def test_retries_stop_at_max_attempts_and_the_retry_budget(self):
+        limiter = RateLimiter("test")
+        self.assertIsNone(limiter.retry_delay("GET", 2, response=response(503)))
+        # The budget allows a burst of 2 retries across all calls
+        delays = [limiter.retry_delay("GET", 0, response=response(503)) for _ in range(3)]
+        self.assertIsNotNone(delays[1])
+        self.assertIsNone(delays[2])
+
+    def test_quota_headers_block_the_bucket(self):
+        self.limiter.observe("k", response(200, **{"X-RateLimit-Remaining": "0", "X-RateLimit-Reset": "3"}))
+        self.assertAlmostEqual(self.limiter.bucket.take("k"), 3, delta=0.05)
+
+
+@override_settings(CACHES=LOCMEM, BREAKER_FAILURES=3, BREAKER_WINDOW=30, BREAKER_OPEN_SECONDS=30)
+class CircuitBreakerTests(SimpleTestCase):
+    def setUp(self):
+        cache.clear()
+        self.breaker = CircuitBreaker("test")
+
+    def open_breaker(self):
+        for _ in range(3):
+            self.assertFalse(self.breaker.before_call())
+            self.breaker.record_failure()
+
+    def expire_open_period(self):
+        cache.delete(self.breaker.open_key)
+
+    def test_failures_within_the_window_open_it(self):
+        self.breaker.record_failure()
+        self.breaker.record_failure()
+        self.assertEqual(self.breaker.state(), CircuitBreaker.CLOSED)
+        self.breaker.record_failure()
+        self.assertEqual(self.breaker.state(), CircuitBreaker.OPEN)
+        with self.assertRaises(CircuitOpen) as raised:
+            self.breaker.before_call()
+        self.assertAlmostEqual(raised.exception.retry_after, 30, delta=1)
+
+    def test_one_probe_at_a_time_once_half_open(self):
+        self.open_breaker()
+        self.expire_open_period()
+        self.assertEqual(self.breaker.state(), CircuitBreaker.HALF_OPEN)
+        self.assertTrue(self.breaker.before_call())
+        with self.assertRaises(CircuitOpen):
+            self.breaker.before_call()
+
+    def test_probe_success_closes_it(self):
+        self.open_breaker()
+        self.expire_open_period()
+        self.breaker.record_success(self.breaker.before_call())
+        self.assertEqual(self.breaker.state(), CircuitBreaker.CLOSED)
+        self.assertFalse(self.breaker.before_call())
+
+    def test_probe_failure_opens_it_again(self):
+        self.open_breaker()
+        self.expire_open_period()
+        self.breaker.record_failure(self.breaker.before_call())
+        self.assertEqual(self.breaker.state(), CircuitBreaker.OPEN)
+
+    def test_released_probe_lets_the_next_call_probe(self):
+        self.open_breaker()
+        self.expire_open_period()
+        self.breaker.release(self.breaker.before_call())
+        self.assertTrue(self.breaker.before_call())
+
+    def test_unreachable_cache_keeps_it_out_of_the_way(self):
+        with mock.patch.object(cache, "get_many", side_effect=ConnectionError("cache down")):
+            self.assertEqual(self.breaker.state(), CircuitBreaker.CLOSED)
+            self.assertFalse(self.breaker.before_call())
+
+    def test_command_holds_it_open_for_the_given_time(self):
+        call_command("circuit_breakers", open="notarydash", seconds=3600, stdout=mock.Mock())
+        with self.assertRaises(CircuitOpen) as raised:
+            CircuitBreaker("notarydash").before_call()
+        self.assertAlmostEqual(raised.exception.retry_after, 3600, delta=1)
+        call_command("circuit_breakers", close="notarydash", stdout=mock.Mock())
+        self.assertEqual(CircuitBreaker("notarydash").state(), CircuitBreaker.CLOSED)
+
+    def test_open_circuit_escaping_a_view_is_a_503(self):
+        request = RequestFactory().get("/notary-view/")
+        response = UpstreamUnavailableMiddleware(lambda r: None).process_exception(
+            request, CircuitOpen("notarydash", 12.2)
+        )
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response["Retry-After"], "13")
+        self.assertEqual(json.loads(response.content)["upstream"], "notarydash")
+
+
+# Fast retries, no rate limits and the breaker in a local cache
+UPSTREAM = dict(
+    CACHES=LOCMEM, UPSTREAM_RATE_LIMITS={}, UPSTREAM_RETRY_BUDGET=(1, 10), UPSTREAM_MAX_ATTEMPTS=3,
+    UPSTREAM_MAX_WAIT=5, UPSTREAM_BACKOFF_BASE=0.001, UPSTREAM_BACKOFF_CAP=0.001,
+)
+
+
+def http_response(status_code, body=b"{}", **headers):
+    response = requests.Response()
+    response.status_code = status_code
+    response._content = body
+    response.headers.update(headers)
+    return response
+
+
+@override_settings(**UPSTREAM, UPSTREAM_CONNECT_TIMEOUT=2, UPSTREAM_READ_TIMEOUT=9, BREAKER_FAILURES=2)
+class UpstreamClientTests(SimpleTestCase):
+    def setUp(self):
+        local_buckets(self)
+        cache.clear()
+        self.upstream = UpstreamClient("test")
+        self.addCleanup(self.upstream.close)
+
+    def send(self, *responses, method="GET", **kwargs):
+        with mock.patch.object(HTTPAdapter, "send", side_effect=responses) as send:
+            response = self.upstream.request(method, "https://upstream.test/orders", **kwargs)
+        return response, send
+
+    def test_one_session_per_process(self):
+        session = self.upstream.session
+        self.assertIs(self.upstream.session, session)
+        self.assertEqual(session.get_adapter("https://upstream.test").max_retries.total, 0)
+        with mock.patch("core.http.os.getpid", return_value=-1):
+            self.assertIsNot(self.upstream.session, session)
+
+    def test_default_timeouts_and_idempotency_key_header(self):
+        _, send = self.send(http_response(201), method="POST", idempotency_key="order-1-notary-order")
+        request = send.call_args.args[0]
+        self.assertEqual(send.call_args.kwargs["timeout"], (2, 9))
+        self.assertEqual(request.headers["Idempotency-Key"], "order-1-notary-order")
+        _, send = self.send(http_response(200), timeout=1)
+        self.assertEqual(send.call_args.kwargs["timeout"], 1)
+        self.assertNotIn("Idempotency-Key", send.call_args.args[0].headers)
+
+    def test_429_is_retried_even_for_a_post(self):
+        response, send = self.send(http_response(429, **{"Retry-After": "0"}), http_response(201), method="POST")
+        self.assertEqual((response.status_code, send.call_count), (201, 2))
+
+    def test_server_errors_open_the_breaker(self):
+        for _ in range(2):
+            response, _ = self.send(http_response(500), method="POST")
+            self.assertEqual(response.status_code, 500)
+        with self.assertRaises(CircuitOpen):
+            self.send(http_response(200))
+
+
+@override_settings(**UPSTREAM)
+class AsyncUpstreamClientTests(SimpleTestCase):
+    def setUp(self):
+        local_buckets(self)
+        cache.clear()
+        self.upstream = AsyncUpstreamClient("test")
+        self.requests = []
+
+    async def handle(self, request):
+        """Fake upstream: /slow/<seconds> answers late, /status/<code> with that status."""
+        self.requests.append(request)
+        kind, _, value = request.url.path.strip("/").partition("/")
+        if kind == "slow":
+            await asyncio.sleep(float(value))
+        status_code = int(value) if kind == "status" else 200
+        return httpx.Response(status_code, json={"path": request.url.path}, request=request)
+
+    def serve(self):
+        return mock.patch.object(httpx.AsyncHTTPTransport, "handle_async_request", side_effect=self.handle)
+
+    async def fetch(self, path, **kwargs):
+        response = await self.upstream.get(f"https://upstream.test{path}", **kwargs)
+        return response.json()["path"], id(self.upstream.client)
+
+    def test_gather_keeps_the_order_and_shares_one_client_per_loop(self):
+        with self.serve():
+            results = gather(*(self.fetch(f"/slow/{delay}") for delay in (0.03, 0.01, 0)))
+        self.assertEqual([path for path, _ in results], ["/slow/0.03", "/slow/0.01", "/slow/0"])
+        self.assertEqual(len({client for _, client in results}), 1)
+        # gather() closed the client of the loop it ran on
+        self.assertEqual(len(self.upstream._clients), 0)
+
+    def test_gather_can_return_exceptions_in_place(self):
+        async def fail():
+            raise ValueError("boom")
+
+        with self.serve():
+            ok, error = gather(self.fetch("/a"), fail(), return_exceptions=True)
+        self.assertEqual(ok[0], "/a")
+        self.assertIsInstance(error, ValueError)
+
+    def test_transport_speaks_http2(self):
+        with mock.patch("core.http.httpx.AsyncHTTPTransport", wraps=httpx.AsyncHTTPTransport) as transport:
+            self.upstream._new_client()
+        transport.assert_called_once_with(http2=True)
+
+    def test_retries_and_idempotency_key_work_as_in_the_sync_client(self):
+        with self.serve():
+            [response] = gather(self.upstream.post(
+                "https://upstream.test/status/503", idempotency_key="order-1-notary-order"
+            ))
+        self.assertEqual((response.status_code, len(self.requests)), (503, 3))
+        self.assertEqual({request.headers["Idempotency-Key"] for request in self.requests}, {"order-1-notary-order"})
+
+
+@override_settings(**UPSTREAM)
+class UpstreamRetryTests(SimpleTestCase):
+    """The rate limiter is the only retry layer, so one call makes at most UPSTREAM_MAX_ATTEMPTS attempts."""
+
+    def setUp(self):
+        local_buckets(self)
+        cache.clear()
+
+    def send(self, error, method="POST"):
+        client = UpstreamClient("test")
+        with mock.patch.object(HTTPAdapter, "send", side_effect=error) as send, \
+                self.assertRaises(requests.ConnectionError):
+            client.request(method, "https://upstream.test/orders")
+        return send.call_count
+
+    def test_refused_connects_are_retried_for_every_method(self):
+        refused = requests.ConnectionError(MaxRetryError(None, "/orders", NewConnectionError(None, "refused")))
+        self.assertEqual(self.send(refused), 3)
+
+    def test_dropped_post_is_not_retried_without_an_idempotency_key(self):
+        dropped = requests.ConnectionError(ProtocolError("Connection aborted."))
+        self.assertEqual(self.send(dropped), 1)
+        self.assertEqual(self.send(dropped, method="GET"), 3)
+
+    def test_async_refused_connects_make_max_attempts(self):
+        client = AsyncUpstreamClient("test")
+        refused = httpx.ConnectError("refused")
+        with mock.patch.object(httpx.AsyncHTTPTransport, "handle_async_request", side_effect=refused) as send:
+            [error] = gather(client.post("https://upstream.test/orders"), return_exceptions=True)
+        self.assertIsInstance(error, httpx.ConnectError)
+        self.assertEqual(send.call_count, 3)
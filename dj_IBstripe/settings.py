@@ -51,6 +51,43 @@ if NOTARY_TEST:
 else:
     NOTARY_API_KEY = config('NOTARY_LIVE_API_KEY')
 
+# Upstream API base URLs; override them to run against a local stand-in
+# (python manage.py fake_upstream). Empty NOTARY_BASE_URL / STRIPE_API_BASE
+# keep the defaults picked by NOTARY_TEST / the stripe library.
+GHL_BASE_URL = config('GHL_BASE_URL', default='https://services.leadconnectorhq.com')
+NOTARY_BASE_URL = config('NOTARY_BASE_URL', default='')
+STRIPE_API_BASE = config('STRIPE_API_BASE', default='')
+
+# core.http.UpstreamClient: pooled keep-alive connections per upstream API, and the
+# timeouts (seconds) every GHL / NotaryDash / Google call gets unless it sets its own
+UPSTREAM_CONNECT_TIMEOUT = config('UPSTREAM_CONNECT_TIMEOUT', default=5, cast=float)
+UPSTREAM_READ_TIMEOUT = config('UPSTREAM_READ_TIMEOUT', default=30, cast=float)
+UPSTREAM_POOL_MAXSIZE = config('UPSTREAM_POOL_MAXSIZE', default=10, cast=int)
+# core.ratelimit: token bucket per upstream as (requests per second, burst). GHL
+# buckets are per location (its documented limit is 100 requests / 10 s each).
+UPSTREAM_RATE_LIMITS = {
+    'ghl': (10, 100),
+    'notarydash': (
+        config('NOTARYDASH_RATE_LIMIT', default=5, cast=float),
+        config('NOTARYDASH_RATE_BURST', default=20, cast=int),
+    ),
+    'google': (50, 100),
+}
+# Retries of failed upstream calls, per upstream across all workers, as (per second, burst)
+UPSTREAM_RETRY_BUDGET = (1, 10)
+# Attempts per upstream call, and the most one call may spend waiting on rate limits
+# and backoff in total (seconds); longer rate limit waits raise core.ratelimit.RateLimited
+UPSTREAM_MAX_ATTEMPTS = config('UPSTREAM_MAX_ATTEMPTS', default=4, cast=int)
+UPSTREAM_MAX_WAIT = config('UPSTREAM_MAX_WAIT', default=30, cast=float)
+# Full jitter backoff: a random wait up to min(cap, base * 2 ** attempt) seconds
+UPSTREAM_BACKOFF_BASE = 0.5
+UPSTREAM_BACKOFF_CAP = 20
+# core.breaker: a circuit opens after BREAKER_FAILURES failed calls to one upstream
+# within BREAKER_WINDOW seconds, and lets a probe call through after BREAKER_OPEN_SECONDS
+BREAKER_FAILURES = config('BREAKER_FAILURES', default=5, cast=int)
+BREAKER_WINDOW = 30
+BREAKER_OPEN_SECONDS = config('BREAKER_OPEN_SECONDS', default=30, cast=int)
+
 DEBUG = True
 
 ALLOWED_HOSTS = ['go.investorbootz.com','127.0.0.1','localhost', '37d5165a4f2b.ngrok-free.app', 'localhost:8000']
@@ -96,7 +133,8 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
-    'core.middleware.csrf_response_middleware.CsrfInjectMiddleware'
+    'core.middleware.csrf_response_middleware.CsrfInjectMiddleware',
+    'core.middleware.upstream_unavailable_middleware.UpstreamUnavailableMiddleware',
 ]
 
 ROOT_URLCONF = 'dj_IBstripe.urls'
@@ -118,6 +156,18 @@ TEMPLATES = [
 
 WSGI_APPLICATION = 'dj_IBstripe.wsgi.application'
 
+REST_FRAMEWORK = {
+    'DEFAULT_RENDERER_CLASSES': [
+        'core.renderers.ORJSONRenderer',
+        'rest_framework.renderers.BrowsableAPIRenderer',
+    ],
+    'DEFAULT_PARSER_CLASSES': [
+        'core.renderers.ORJSONParser',
+        'rest_framework.parsers.FormParser',
+        'rest_framework.parsers.MultiPartParser',
+    ],
+}
+
 
 # Database
 # https://docs.djangoproject.com/en/5.2/ref/settings/#databases
@@ -216,6 +266,21 @@ CELERY_BEAT_SCHEDULE = {
         'schedule':  crontab(hour=0, minute=0),
         'args': (),
     },
+    'sweep_webhook_inbox': {
+        'task': 'stripe_payment.tasks.sweep_webhook_inbox',
+        'schedule': 60,
+        'args': (),
+    },
+    'sweep_order_submissions': {
+        'task': 'stripe_payment.tasks.sweep_order_submissions',
+        'schedule': 60,
+        'args': (),
+    },
+    'purge_idempotency_keys': {
+        'task': 'stripe_payment.tasks.purge_idempotency_keys',
+        'schedule': crontab(minute=15),
+        'args': (),
+    },
 }
 
 CELERY_BROKER_URL = 'redis://localhost:6379/0'
@@ -225,6 +290,64 @@ CELERY_TASK_SERIALIZER = 'json'
 CELERY_RESULT_SERIALIZER = 'json'
 CELERY_TIMEZONE = TIME_ZONE
 
+# Redis holding the core.ratelimit token buckets, so every gunicorn / Celery process
+# shares them; while it is unreachable buckets are per process, Redis is tried again
+# after RATELIMIT_REDIS_RETRY seconds
+RATELIMIT_REDIS_URL = config('RATELIMIT_REDIS_URL', default=CELERY_BROKER_URL)
+RATELIMIT_REDIS_RETRY = 30
+
+# Shared cache (catalog snapshots, places lookups). Lives next to the Celery
+# broker so every gunicorn worker sees the same entries.
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': config('CACHE_URL', default='redis://localhost:6379/1'),
+    }
+}
+
+# order_page.catalog: how long a rendered ServiceVariance snapshot is kept
+CATALOG_SNAPSHOT_TIMEOUT = 60 * 60 * 24
+# Pre-build all active catalog snapshots in the background when the server starts
+CATALOG_WARM_ON_STARTUP = config('CATALOG_WARM_ON_STARTUP', default=False, cast=bool)
+# Charge the server side price breakdown instead of the totals the order page sends.
+# Off: the breakdown is only stored on the order and mismatches are logged.
+# Rolling it out:
+#   1. Run with it off and watch the logs for "Price mismatch for company ..." lines
+#      (Order.price_breakdown holds what the server would have charged).
+#   2. Fix every catalog row or pricing rule a mismatch points at until a normal
+#      week of orders logs none; "Could not price order" lines must be gone too,
+#      since those orders are rejected once it is on.
+#   3. Turn it on. Turning it off again is safe at any time.
+PRICING_AUTHORITATIVE = config('PRICING_AUTHORITATIVE', default=False, cast=bool)
+# Answer order submissions with 202 and do the NotaryDash / Stripe calls in Celery
+# (clients can also ask per request with a `Prefer: respond-async` header)
+ORDER_SUBMISSION_ASYNC = config('ORDER_SUBMISSION_ASYNC', default=False, cast=bool)
+# Times an accepted submission waits for an unavailable NotaryDash (open circuit breaker)
+# before it is marked failed; synchronous submissions are queued in that case too
+ORDER_SUBMISSION_MAX_DEFERS = 20
+# Seconds an async submission may sit pending / processing before the
+# sweep_order_submissions beat task queues it again (lost enqueue, crashed worker)
+ORDER_SUBMISSION_STALE_AFTER = config('ORDER_SUBMISSION_STALE_AFTER', default=300, cast=int)
+# Longest ?wait= a submission status poll may hold a worker for, in seconds. Keep it
+# short: a waiting poll pins a gunicorn worker; clients poll again after Retry-After
+ORDER_STATUS_MAX_WAIT = 1
+# How long a submit-order Idempotency-Key (and its stored response) is kept, in seconds
+IDEMPOTENCY_KEY_TTL = 60 * 60 * 24
+# Seconds a submit-order request holds its Idempotency-Key before a retry may take it
+# over (the request's worker died); keep it above the gunicorn worker timeout
+IDEMPOTENCY_KEY_LEASE = config('IDEMPOTENCY_KEY_LEASE', default=120, cast=int)
+# Stripe webhook inbox (stripe_payment.inbox): attempts an event gets before it is
+# marked failed, unless its handler in stripe_payment.webhooks sets its own
+WEBHOOK_MAX_ATTEMPTS = 8
+# Seconds a new webhook event may wait in the Celery queue before the inbox sweep
+# assumes its enqueue was lost and dispatches it again
+WEBHOOK_SWEEP_GRACE = config('WEBHOOK_SWEEP_GRACE', default=300, cast=int)
+# Celery queue for the slow webhook handlers (NotaryDash / GHL order processing);
+# run e.g. `celery -A dj_IBstripe worker -Q webhook_orders` when pointing it at its own queue
+WEBHOOK_ORDER_QUEUE = config('WEBHOOK_ORDER_QUEUE', default='celery')
+# Threads stripe_payment.fulfilment uses to run independent NotaryDash / GHL / Stripe calls of one order
+FULFILMENT_WORKERS = config('FULFILMENT_WORKERS', default=4, cast=int)
+
 LOGGING = {
     'version': 1,
     'disable_existing_loggers': False,
@@ -243,6 +366,10 @@ LOGGING = {
             'level': 'INFO',
             'propagate': False,
         },
+        # httpx logs every request at INFO
+        'httpx': {
+            'level': 'WARNING',
+        },
     },
 }
 
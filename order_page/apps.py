@@ -1,6 +1,21 @@
+import sys
+
 from django.apps import AppConfig
+from django.conf import settings
 
 
 class OrderPageConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'order_page'
+
+    def ready(self):
+        import order_page.signals
+
+        # Pre-build catalog snapshots on server boot, but not for
+        # migrate/shell/etc. (runserver and gunicorn only)
+        command = sys.argv[1] if len(sys.argv) > 1 else ""
+        if getattr(settings, "CATALOG_WARM_ON_STARTUP", False) and (
+            not sys.argv[0].endswith("manage.py") or command == "runserver"
+        ):
+            from .catalog import CatalogSnapshot
+            CatalogSnapshot.warm_in_background()
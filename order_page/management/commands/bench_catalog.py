@@ -0,0 +1,261 @@
+import statistics
+import time
+from decimal import Decimal
+from itertools import product
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, reset_queries, transaction
+from django.test import Client
+from django.test.utils import (
+    CaptureQueriesContext, override_settings, setup_test_environment, teardown_test_environment,
+)
+from django.urls import reverse
+from django.utils import timezone
+
+from order_page.models import (
+    ServiceVariance, ServiceCategory, IndividualService, ServiceForm, FormItem,
+    OptionGroup, OptionItem, Submenu, SubmenuItem, SubmenuPriceChange, ModalOption,
+    Disclosure, CheckDiscloure, BundleGroup, Bundle, BundleOptionGroup,
+    BundleOptionItem, BundleModalForm, BundleModalField,
+)
+from stripe_payment.models import NotaryClientCompany
+
+# Snapshots would turn every hit after the first into a cache read, so the
+# benchmark runs against a dummy cache and always measures the full render.
+NO_CACHE = {"default": {"BACKEND": "django.core.cache.backends.dummy.DummyCache"}}
+
+SERVICES_PER_CATALOG = 5
+OPTIONS_PER_GROUP = 3
+
+
+class _Rollback(Exception):
+    pass
+
+
+# ------------------------------------------------------------------
+# Synthetic catalog, also used by order_page.tests
+# ------------------------------------------------------------------
+def seed_catalog(items, bundles):
+    """Create a default and a client variance sharing one synthetic catalog."""
+    category = ServiceCategory.objects.create(title="Bench category")
+
+    services = []
+    for s in range(SERVICES_PER_CATALOG):
+        form = ServiceForm.objects.create(title=f"Bench form {s}")
+        service = IndividualService.objects.create(
+            service_id=f"bench{s}", title=f"Bench service {s}", form_ref=form, sort_order=s
+        )
+        Disclosure.objects.create(service=service, message=f"Bench disclosure {s}")
+        services.append(service)
+    category.services.set(services)
+
+    check = CheckDiscloure.objects.create(name="Bench check", message="Bench check message")
+    _seed_forms([s.form_ref for s in services], items, check)
+    group = _seed_bundles(bundles, check)
+
+    # The view picks the newest active default, which is this one
+    default = ServiceVariance.objects.create(
+        name="Bench default", service_category=category, is_default=True, is_active=True
+    )
+    default.bundle_group.set([group])
+
+    now = timezone.now()
+    last = NotaryClientCompany.objects.order_by("-id").values_list("id", flat=True).first() or 0
+    company = NotaryClientCompany.objects.create(
+        id=last + 1, owner_id=0, parent_company_id=0, type="client",
+        company_name="Bench company", created_at=now, updated_at=now,
+    )
+    variance = ServiceVariance.objects.create(
+        name="Bench client", service_category=category, is_active=True
+    )
+    variance.bundle_group.set([group])
+    variance.clients.set([company])
+    return company
+
+def _seed_forms(forms, items, check):
+    option_groups = OptionGroup.objects.bulk_create([OptionGroup() for _ in range(items)])
+    options = OptionItem.objects.bulk_create([
+        OptionItem(identifier=f"opt{i}", label=f"Option {i}", price_value=Decimal("5.00"), sort_order=i)
+        for i in range(items * OPTIONS_PER_GROUP)
+    ])
+    OptionGroup.items.through.objects.bulk_create([
+        OptionGroup.items.through(optiongroup=group, optionitem=options[g * OPTIONS_PER_GROUP + o])
+        for g, group in enumerate(option_groups) for o in range(OPTIONS_PER_GROUP)
+    ])
+
+    form_items = FormItem.objects.bulk_create([
+        FormItem(
+            identifier=f"item{i}", title=f"Item {i}", price=Decimal("25.00"),
+            base_price=Decimal("30.00"), sort_order=i, option_group=option_groups[i],
+        )
+        for i in range(items)
+    ])
+
+    submenu_items = []
+    for f, form in enumerate(forms):
+        submenu = Submenu.objects.create(name=f"Bench submenu {f}")
+        counter = SubmenuItem.objects.create(identifier=f"count{f}", label="Count", type="counter", value=1)
+        submenu.items.set([counter])
+        form.submenus.set([submenu])
+        submenu_items.append(counter)
+
+        modal = ModalOption.objects.create(label=f"Bench modal {f}", field_name=f"bench_modal_{f}")
+        modal.check_disclosure.set([check])
+        form.modal_options.set([modal])
+
+    # Spread items across the forms; every item gets a price change and a modal link
+    ServiceForm.items.through.objects.bulk_create([
+        ServiceForm.items.through(serviceform=forms[i % len(forms)], formitem=item)
+        for i, item in enumerate(form_items)
+    ])
+    SubmenuPriceChange.objects.bulk_create([
+        SubmenuPriceChange(
+            form_item=item, submenu_item=submenu_items[i % len(forms)],
+            change_type="add", value=Decimal("2.00"),
+        )
+        for i, item in enumerate(form_items)
+    ])
+    for f, form in enumerate(forms):
+        modal = form.modal_options.get()
+        modal.valid_for_items.set(form_items[f::len(forms)])
+
+def _seed_bundles(bundles, check):
+    group = BundleGroup.objects.create(name="Bench bundles", header="Bench bundles")
+    for b in range(bundles):
+        modal_form = BundleModalForm.objects.create(title=f"Bench modal {b}")
+        modal_form.field.set([
+            BundleModalField.objects.create(label="Field", name=f"field{b}_{n}", sort_order=n)
+            for n in range(2)
+        ])
+        modal_form.check_disclosure.set([check])
+
+        bundle = Bundle.objects.create(
+            group=group, name=f"Bench bundle {b}", base_price=Decimal("100.00"),
+            discounted_price=Decimal("90.00"), sort_order=b, modal_form=modal_form,
+        )
+        # Two option groups per bundle so get_options takes the list branch
+        option_groups = []
+        for g in range(2):
+            option_group = BundleOptionGroup.objects.create(name=f"Bench group {b}.{g}", sort_order=g)
+            option_group.items.set([
+                BundleOptionItem.objects.create(
+                    identifier=f"bopt{b}_{g}_{o}", label=f"Option {o}", price_change=Decimal("10.00")
+                )
+                for o in range(OPTIONS_PER_GROUP)
+            ])
+            option_groups.append(option_group)
+        bundle.option_groups.set(option_groups)
+    return group
+
+
+class Command(BaseCommand):
+    help = (
+        "Benchmark ServiceLookupView against synthetic catalogs of increasing size, "
+        "in a throwaway test database. Fails if the query count grows with the catalog "
+        "size (order_page.tests checks the same on every test run)."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--items", default="10,100,1000",
+            help="Comma separated FormItem counts to seed (default: 10,100,1000)."
+        )
+        parser.add_argument(
+            "--bundles", default="5,50",
+            help="Comma separated Bundle counts to seed (default: 5,50)."
+        )
+        parser.add_argument(
+            "--repeat", type=int, default=5,
+            help="Requests per scenario; wall time is the median of these."
+        )
+
+    def handle(self, *args, **options):
+        item_sizes = self._sizes(options["items"])
+        bundle_sizes = self._sizes(options["bundles"])
+        repeat = max(1, options["repeat"])
+
+        # Never seed into the configured database, build a test one like `manage.py test`
+        setup_test_environment()
+        old_name = connection.settings_dict["NAME"]
+        connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+        try:
+            results = []
+            for items, bundles in product(item_sizes, bundle_sizes):
+                results.extend(self._run_scenario(items, bundles, repeat))
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            teardown_test_environment()
+
+        self.stdout.write(self.style.MIGRATE_HEADING(
+            f"{'target':<8} {'items':>6} {'bundles':>8} {'queries':>8} {'median ms':>10} {'bytes':>10}"
+        ))
+        for row in results:
+            self.stdout.write(
+                f"{row['target']:<8} {row['items']:>6} {row['bundles']:>8} {row['queries']:>8} "
+                f"{row['ms']:>10.1f} {row['bytes']:>10}"
+            )
+
+        failed = []
+        for target in ("default", "client"):
+            counts = {r["queries"] for r in results if r["target"] == target}
+            if len(counts) > 1:
+                failed.append(f"{target}: {sorted(counts)}")
+        if failed:
+            raise CommandError(
+                "❌ Query count depends on catalog size (N+1 in the serializer tree?) -> "
+                + "; ".join(failed)
+            )
+        self.stdout.write(self.style.SUCCESS("✅ Query count is constant across catalog sizes."))
+
+    # ------------------------------------------------------------------
+    # Scenario
+    # ------------------------------------------------------------------
+    def _run_scenario(self, items, bundles, repeat):
+        rows = []
+        try:
+            with transaction.atomic():
+                client_company = seed_catalog(items, bundles)
+                http = Client()
+                with override_settings(CACHES=NO_CACHE):
+                    for target, company_id in (("default", "default"), ("client", str(client_company.pk))):
+                        rows.append(self._measure(http, target, company_id, items, bundles, repeat))
+                # Start every scenario from an empty catalog
+                raise _Rollback
+        except _Rollback:
+            pass
+        return rows
+
+    def _measure(self, http, target, company_id, items, bundles, repeat):
+        url = reverse("service-lookup", kwargs={"company_id": company_id})
+
+        # queries_log is a bounded deque; seeding under DEBUG can fill it up
+        reset_queries()
+        with CaptureQueriesContext(connection) as ctx:
+            response = http.get(url)
+        if response.status_code != 200:
+            raise CommandError(f"❌ {url} returned {response.status_code}: {response.content[:200]!r}")
+
+        timings = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            http.get(url)
+            timings.append((time.perf_counter() - start) * 1000)
+
+        return {
+            "target": target,
+            "items": items,
+            "bundles": bundles,
+            "queries": len(ctx.captured_queries),
+            "ms": statistics.median(timings),
+            "bytes": len(response.content),
+        }
+
+    @staticmethod
+    def _sizes(value):
+        try:
+            sizes = [int(v) for v in value.split(",") if v.strip()]
+        except ValueError:
+            raise CommandError(f"❌ Invalid size list: {value}")
+        if not sizes or min(sizes) < 1:
+            raise CommandError(f"❌ Invalid size list: {value}")
+        return sizes
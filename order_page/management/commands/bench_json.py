@@ -0,0 +1,49 @@
+import timeit
+
+from django.core.management.base import BaseCommand, CommandError
+from rest_framework.renderers import JSONRenderer
+
+from core.renderers import ORJSONRenderer
+from order_page.models import ServiceVariance
+from order_page.serializers import ServiceVarianceSerializer
+
+
+class Command(BaseCommand):
+    help = "Compare DRF's JSONRenderer with ORJSONRenderer on a real ServiceVarianceSerializer payload."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--variance", type=str, default=None,
+            help="ServiceVariance id to encode (default: the active default variance)."
+        )
+        parser.add_argument(
+            "--number", type=int, default=200,
+            help="Encodes per timing run (default: 200)."
+        )
+
+    def handle(self, *args, **options):
+        if options["variance"]:
+            variance = ServiceVariance.objects.filter(pk=options["variance"]).first()
+        else:
+            variance = ServiceVariance.get_default()
+        if not variance:
+            raise CommandError("❌ No ServiceVariance found to benchmark.")
+
+        queryset = ServiceVarianceSerializer.setup_eager_loading(ServiceVariance.objects.filter(pk=variance.pk))
+        data = ServiceVarianceSerializer(queryset.get()).data
+        number = max(1, options["number"])
+
+        drf_body = JSONRenderer().render(data)
+        orjson_body = ORJSONRenderer().render(data)
+        self.stdout.write(self.style.MIGRATE_HEADING(f"📦 {variance} ({len(drf_body)} bytes)"))
+        if drf_body != orjson_body:
+            self.stdout.write(self.style.WARNING("⚠️ Renderers produced different bytes for this payload."))
+
+        results = {}
+        for name, renderer in (("JSONRenderer", JSONRenderer()), ("ORJSONRenderer", ORJSONRenderer())):
+            best = min(timeit.repeat(lambda: renderer.render(data), number=number, repeat=5))
+            results[name] = best / number * 1000
+            self.stdout.write(f"{name:<16} {results[name]:>8.3f} ms / encode")
+
+        speedup = results["JSONRenderer"] / results["ORJSONRenderer"]
+        self.stdout.write(self.style.SUCCESS(f"✅ orjson is {speedup:.1f}x faster on this payload."))
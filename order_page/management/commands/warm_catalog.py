@@ -0,0 +1,50 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from order_page.catalog import CatalogSnapshot
+
+
+class Command(BaseCommand):
+    help = "Pre-build cached catalog snapshots for all active ServiceVariances (run after deploys)."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--workers", type=int, default=4,
+            help="Number of variances rendered in parallel (default: 4)."
+        )
+        parser.add_argument(
+            "--force", action="store_true",
+            help="Rebuild snapshots even if the current version is already cached."
+        )
+
+    def handle(self, *args, **options):
+        start = time.perf_counter()
+
+        def progress(done, total, result):
+            if result["status"] == "error":
+                line = self.style.ERROR(f"❌ {result['variance_id']}: {result['error']}")
+            else:
+                line = f"{result['status']:<6} {result['variance_id']} {result['bytes']:>9} bytes {result['ms']:>8.1f} ms"
+            self.stdout.write(f"[{done}/{total}] {line}")
+
+        results = CatalogSnapshot.warm(workers=options["workers"], force=options["force"], progress=progress)
+        elapsed = time.perf_counter() - start
+
+        built = [r for r in results if r["status"] == "built"]
+        cached = [r for r in results if r["status"] == "cached"]
+        errors = [r for r in results if r["status"] == "error"]
+
+        self.stdout.write(self.style.MIGRATE_HEADING("📊 Summary"))
+        self.stdout.write(f"Variances: {len(results)}  built: {len(built)}  cached: {len(cached)}  errors: {len(errors)}")
+        if built:
+            slowest = max(built, key=lambda r: r["ms"])
+            self.stdout.write(
+                f"Render time: {sum(r['ms'] for r in built):.1f} ms total, "
+                f"slowest {slowest['variance_id']} ({slowest['ms']:.1f} ms)"
+            )
+        self.stdout.write(f"Wall time: {elapsed:.2f}s with {options['workers']} workers")
+
+        if errors:
+            raise CommandError(f"❌ {len(errors)} snapshot(s) failed to build.")
+        self.stdout.write(self.style.SUCCESS("✅ Catalog snapshots are warm."))
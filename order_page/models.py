@@ -333,21 +333,12 @@ class ServiceVariance(TimeStampedModel):
         Retrieve the active variance for a given client.
         If no client-specific variance is assigned, return the default.
         """
-        # Try client-specific first
-        variance = (
-            cls.objects.filter(clients=client, is_active=True)
-            .select_related("service_category", "bundle_group")
-            .first()
-        )
-        if variance:
-            return variance
-
-        # Fallback to default active variance
-        return (
-            cls.objects.filter(is_default=True, is_active=True)
-            .select_related("service_category", "bundle_group")
-            .first()
-        )
+        from .catalog import ClientVarianceIndex
+
+        variance_id = ClientVarianceIndex.variance_id_for(client.pk)
+        if not variance_id:
+            return None
+        return cls.objects.select_related("service_category").filter(pk=variance_id).first()
 
     @classmethod
     def get_default(cls):
@@ -0,0 +1,287 @@
+# pricing.py
+import logging
+import threading
+from decimal import Decimal, ROUND_HALF_UP
+
+from django.db.models import prefetch_related_objects
+
+from .catalog import CatalogSnapshot, ClientVarianceIndex
+from .models import ServiceVariance, DiscountLevel
+from .serializers import SERVICE_VARIANCE_PREFETCH
+
+logger = logging.getLogger(__name__)
+
+CENT = Decimal("0.01")
+HUNDRED = Decimal("100")
+ZERO = Decimal("0.00")
+
+
+class PricingError(ValueError):
+    """The cart references something the variance does not sell."""
+
+
+def money(value) -> Decimal:
+    return Decimal(value).quantize(CENT, rounding=ROUND_HALF_UP)
+
+
+def protection_amount(kind, value, base) -> Decimal:
+    """Order protection for `base`: `value` percent of it, or a fixed `value`."""
+    if not kind or value is None:
+        return ZERO
+    if kind == "percent":
+        return money(base * value / HUNDRED)
+    return money(value)
+
+
+class PriceTable:
+    """
+    Everything a ServiceVariance needs to price a cart, flattened into dicts:
+
+        items        {(service_id, item identifier): {price, base_price, protection_invalid,
+                                                      options, submenu}}
+                     options  {option identifier: (price_type, value)}
+                     submenu  {submenu item identifier: (change_type, value)}
+        protection   {service_id: (order_protection_type, order_protection_value)}
+                     for services that offer order protection
+        bundles      {bundle name: {price, base_price, options {identifier: price_change}}}
+        tiers        [(min items, percent)] for active DiscountLevels, highest first
+        bundle_protection  (type, value) from the variance
+    """
+
+    def __init__(self, variance_id, version):
+        self.variance_id = variance_id
+        self.version = version
+        self.items = {}
+        self.protection = {}
+        self.bundles = {}
+        self.tiers = []
+        self.bundle_protection = (None, None)
+
+    @classmethod
+    def compile(cls, variance: ServiceVariance, version) -> "PriceTable":
+        prefetch_related_objects([variance], "service_category", *SERVICE_VARIANCE_PREFETCH)
+        table = cls(variance.pk, version)
+
+        for service in variance.service_category.services.all():
+            if service.order_protection:
+                table.protection[service.service_id] = (
+                    service.order_protection_type, service.order_protection_value
+                )
+            if not service.form_ref:
+                continue
+            for item in service.form_ref.items.all():
+                options = {}
+                if item.option_group:
+                    for option in item.option_group.items.all():
+                        if option.price_value is not None:
+                            options[option.identifier] = (option.price_type, option.price_value)
+                submenu = {
+                    change.submenu_item.identifier: (change.change_type, change.value)
+                    for change in item.submenu_price_changes.all()
+                    if change.submenu_item and change.value is not None
+                }
+                table.items[(service.service_id, item.identifier)] = {
+                    "price": item.price if item.price is not None else item.base_price,
+                    "base_price": item.base_price,
+                    "protection_invalid": item.protection_invalid,
+                    "options": options,
+                    "submenu": submenu,
+                }
+
+        for group in variance.bundle_group.all():
+            for bundle in group.bundles.all():
+                table.bundles[bundle.name] = {
+                    "price": bundle.discounted_price,
+                    "base_price": bundle.base_price,
+                    "options": {
+                        option.identifier: option.price_change
+                        for option_group in bundle.option_groups.all()
+                        for option in option_group.items.all()
+                        if option.price_change
+                    },
+                }
+
+        table.tiers = list(
+            DiscountLevel.objects.filter(active_flag=True)
+            .order_by("-items", "-percent")
+            .values_list("items", "percent")
+        )
+        table.bundle_protection = (
+            variance.bundle_order_protection_type, variance.bundle_order_protection_value
+        )
+        return table
+
+    def discount_percent(self, item_count) -> Decimal:
+        for min_items, percent in self.tiers:
+            if item_count >= min_items:
+                return percent
+        return ZERO
+
+
+class PricingEngine:
+    """
+    Prices an order page cart on the server.
+
+    PriceTables are compiled once per variance and kept in-process, keyed by
+    the same content version as the catalog snapshots, so any catalog edit
+    that changes the JSON the frontend prices from also recompiles the table.
+    """
+
+    _lock = threading.Lock()
+    _tables = {}
+
+    @classmethod
+    def table_for(cls, variance_id) -> PriceTable:
+        version = CatalogSnapshot.get_version(variance_id)
+        table = cls._tables.get(variance_id)
+        if table is not None and table.version == version:
+            return table
+
+        with cls._lock:
+            table = cls._tables.get(variance_id)
+            if table is not None and table.version == version:
+                return table
+            variance = ServiceVariance.objects.filter(pk=variance_id).first()
+            if variance is None:
+                raise PricingError(f"ServiceVariance {variance_id} does not exist")
+            table = PriceTable.compile(variance, version)
+            cls._tables[variance_id] = table
+            logger.info(f"Compiled price table for variance {variance_id} v{version} ({len(table.items)} items)")
+            return table
+
+    @classmethod
+    def price_order(cls, data) -> dict:
+        """
+        Price a FormSubmissionAPIView payload against the company's variance.
+
+        Returns a JSON serializable breakdown (amounts as strings):
+            variance_id, version
+            bundles           [{name, base_price, price}]
+            services          {service_id: {subtotal, protection, items {item_id: {unit_price, price}}}}
+            item_count, discount_percent
+            bundle_total, a_la_carte_total
+            protection        {a_la_carte, bundle, total}   (only the parts the customer opted into)
+            total             bundle_total + a_la_carte_total (protection is charged separately)
+        """
+        try:
+            company_id = int(data.get("company_id"))
+        except (TypeError, ValueError):
+            raise PricingError(f"Invalid company_id: {data.get('company_id')!r}")
+        variance_id = ClientVarianceIndex.variance_id_for(company_id)
+        if not variance_id:
+            raise PricingError(f"No active ServiceVariance for company {company_id}")
+
+        return cls.price_cart(cls.table_for(variance_id), data)
+
+    @staticmethod
+    def price_cart(table: PriceTable, data) -> dict:
+        # ---------------------------------------------------------------
+        # Bundles
+        # ---------------------------------------------------------------
+        bundles = []
+        bundle_total = ZERO
+        for b in data.get("bundles", []):
+            entry = table.bundles.get(b.get("name"))
+            if entry is None:
+                raise PricingError(f"Unknown bundle: {b.get('name')!r}")
+            price = entry["price"]
+            for opt_id, selected in (b.get("selectedOptions") or {}).items():
+                if selected and opt_id in entry["options"]:
+                    price += entry["options"][opt_id]
+            price = money(price)
+            bundle_total += price
+            bundles.append({"name": b.get("name"), "base_price": str(entry["base_price"]), "price": str(price)})
+
+        # ---------------------------------------------------------------
+        # A la carte: unit prices first, the tier discount needs the item count
+        # ---------------------------------------------------------------
+        priced = []
+        for svc in data.get("a_la_carteOrder", []):
+            service_id = svc.get("id")
+            form = svc.get("form") or {}
+            submenu_values = {
+                sub.get("id"): sub.get("value")
+                for sub in (form.get("submenu") or {}).get("items", [])
+            }
+            for item_data in form.get("items", []):
+                item = table.items.get((service_id, item_data.get("id")))
+                if item is None:
+                    raise PricingError(f"Unknown item: {service_id}/{item_data.get('id')}")
+                priced.append((service_id, item_data.get("id"), item, PricingEngine._unit_price(item, item_data, submenu_values)))
+
+        percent = table.discount_percent(len(priced))
+        services = {}
+        a_la_carte_total = ZERO
+        for service_id, item_id, item, unit_price in priced:
+            price = money(unit_price * (HUNDRED - percent) / HUNDRED)
+            service = services.setdefault(service_id, {"subtotal": ZERO, "protected": ZERO, "items": {}})
+            service["subtotal"] += price
+            if not item["protection_invalid"]:
+                service["protected"] += price
+            service["items"][item_id] = {"unit_price": str(unit_price), "price": str(price)}
+            a_la_carte_total += price
+
+        a_la_carte_protection = ZERO
+        for service_id, service in services.items():
+            kind, value = table.protection.get(service_id, (None, None))
+            service["protection"] = str(protection_amount(kind, value, service.pop("protected")))
+            a_la_carte_protection += Decimal(service["protection"])
+            service["subtotal"] = str(service["subtotal"])
+
+        bundle_protection = protection_amount(*table.bundle_protection, bundle_total) if bundles else ZERO
+
+        # Protection is opt-in on the order page
+        if not data.get("alaCarteOrderProtectionCheck"):
+            a_la_carte_protection = ZERO
+        if not data.get("bundleOrderProtectionCheck"):
+            bundle_protection = ZERO
+
+        return {
+            "variance_id": str(table.variance_id),
+            "version": table.version,
+            "bundles": bundles,
+            "services": services,
+            "item_count": len(priced),
+            "discount_percent": str(percent),
+            "bundle_total": str(bundle_total),
+            "a_la_carte_total": str(a_la_carte_total),
+            "protection": {
+                "a_la_carte": str(a_la_carte_protection),
+                "bundle": str(bundle_protection),
+                "total": str(a_la_carte_protection + bundle_protection),
+            },
+            "total": str(bundle_total + a_la_carte_total),
+        }
+
+    @staticmethod
+    def _unit_price(item, item_data, submenu_values) -> Decimal:
+        """Item price after option and submenu modifiers, before the tier discount."""
+        price = item["price"] or ZERO
+
+        # "Change Into" options replace the base price, "Addition" options stack on top
+        added = ZERO
+        for option in (item_data.get("options") or {}).get("items", []):
+            if not option.get("value"):
+                continue
+            kind, value = item["options"].get(option.get("id"), (None, None))
+            if kind == "priceChange":
+                price = value
+            elif kind == "priceAdd":
+                added += value
+        price += added
+
+        for key, (change_type, value) in item["submenu"].items():
+            selected = submenu_values.get(key)
+            # Radio submenus send booleans, counters send numbers
+            try:
+                count = max(int(selected), 0)
+            except (TypeError, ValueError):
+                count = 1 if selected else 0
+            if not count:
+                continue
+            if change_type == "multiple":
+                price += value * count
+            else:
+                price += value
+
+        return money(price)
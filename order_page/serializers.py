@@ -1,5 +1,7 @@
 # serializers.py
+from django.db.models import Prefetch
 from rest_framework import serializers
+from stripe_payment.models import NotaryClientCompany
 from .models import (
     TermsOfConditions, Bundle, BundleGroup,
     ServiceCategory,
@@ -143,12 +145,12 @@ class BundleSerializer(serializers.ModelSerializer):
         { type, minimumRequired, items: [...] }
         If multiple groups exist, returns the first or a list (depending on use case).
         """
-        option_groups = obj.option_groups.all()
-        if not option_groups.exists():
+        option_groups = list(obj.option_groups.all())
+        if not option_groups:
             return {}
         # If there’s only one group, return single dict (to match frontend pattern)
-        if option_groups.count() == 1:
-            return BundleOptionGroupSerializer(option_groups.first()).data
+        if len(option_groups) == 1:
+            return BundleOptionGroupSerializer(option_groups[0]).data
         # If multiple groups, return list
         return BundleOptionGroupSerializer(option_groups, many=True).data
 
@@ -283,7 +285,7 @@ class FormItemSerializer(serializers.ModelSerializer):
         }
         """
         changes = {}
-        for change in obj.submenu_price_changes.select_related("submenu_item").all():
+        for change in obj.submenu_price_changes.all():
             key = change.submenu_item.identifier
             changes[key] = {
                 "type": change.change_type,
@@ -318,8 +320,8 @@ class ModalOptionSerializer(serializers.ModelSerializer):
         Return an array of linked FormItem identifiers.
         If none are linked, return [] (applies to all).
         """
-        items = obj.valid_for_items.values_list("identifier", flat=True)
-        return list(items) if items else None
+        items = [item.identifier for item in obj.valid_for_items.all()]
+        return items if items else None
 
         
 class ServiceFormSerializer(serializers.ModelSerializer):
@@ -337,16 +339,15 @@ class ServiceFormSerializer(serializers.ModelSerializer):
         return {}
 
     def get_submenu(self, obj):
-        submenus = obj.submenus.all()
-        if not submenus.exists():
+        submenus = list(obj.submenus.all())
+        if not submenus:
             return {}
         # JS expects single submenu structure, not a list
-        first = submenus.first()
-        return SubmenuSerializer(first).data
+        return SubmenuSerializer(submenus[0]).data
 
     def get_modalOption(self, obj):
-        modals = obj.modal_options.all()
-        if not modals.exists():
+        modals = list(obj.modal_options.all())
+        if not modals:
             return {}
         return {
             "eachItem": False,
@@ -418,10 +419,46 @@ class DiscountLevelSerializer(serializers.ModelSerializer):
             raise serializers.ValidationError("Percent must be between 0 and 100")
         return value
 
+# -------------------------------------------------------------------
+#  Prefetch plan for the whole variance tree
+# -------------------------------------------------------------------
+# Every relation the serializers below walk is loaded here, one query per
+# level, so the number of queries does not grow with the catalog size.
+# SerializerMethodFields must only use `.all()` on these relations (no
+# filter/exists/count/first), otherwise they bypass the prefetch cache.
+_SERVICES = "service_category__services"
+_FORM = f"{_SERVICES}__form_ref"
+_BUNDLES = "bundle_group__bundles"
+
+SERVICE_VARIANCE_PREFETCH = [
+    Prefetch("clients", queryset=NotaryClientCompany.objects.only("id")),
+    # Forward one-to-one / FK hops are joined rather than prefetched, so a
+    # large catalog never turns into a huge "id = .. OR id = .." query.
+    Prefetch(_BUNDLES, queryset=Bundle.objects.select_related("modal_form")),
+    f"{_BUNDLES}__option_groups__items",
+    f"{_BUNDLES}__modal_form__field",
+    f"{_BUNDLES}__modal_form__check_disclosure",
+    Prefetch(_SERVICES, queryset=IndividualService.objects.select_related("form_ref")),
+    f"{_SERVICES}__disclosures",
+    Prefetch(f"{_FORM}__items", queryset=FormItem.objects.select_related("option_group")),
+    f"{_FORM}__items__option_group__items",
+    Prefetch(
+        f"{_FORM}__items__submenu_price_changes",
+        queryset=SubmenuPriceChange.objects.select_related("submenu_item"),
+    ),
+    f"{_FORM}__submenus__items",
+    f"{_FORM}__modal_options__valid_for_items",
+    f"{_FORM}__modal_options__check_disclosure",
+]
+
+
 class ServiceVarianceSerializer(serializers.ModelSerializer):
     """
     Combines the selected ServiceCategory + all related BundleGroups
     into a unified JSON output for frontend consumption.
+
+    Load instances through `setup_eager_loading` (or prefetch them with
+    SERVICE_VARIANCE_PREFETCH) before serializing.
     """
 
     # Nested serializers
@@ -450,6 +487,10 @@ class ServiceVarianceSerializer(serializers.ModelSerializer):
             "updated_at",
             "discount_levels"
         ]
+    @staticmethod
+    def setup_eager_loading(queryset):
+        return queryset.select_related("service_category").prefetch_related(*SERVICE_VARIANCE_PREFETCH)
+
     def get_discount_levels(self, obj):
 
         qs = DiscountLevel.objects.filter(active_flag=True).order_by("items")
@@ -3,6 +3,10 @@ import requests
 import time
 from django.conf import settings
 
+from core.http import UpstreamClient
+
+google = UpstreamClient("google", read_timeout=10)
+
 
 class GoogleService:
     def __init__(self):
@@ -46,7 +50,7 @@ class GoogleService:
                 payload[key] = value
             
         try:
-            response = requests.post(url, headers=headers, json=payload)
+            response = google.post(url, headers=headers, json=payload)
             response.raise_for_status()
             return response.json()
         except requests.exceptions.RequestException as e:
@@ -68,7 +72,7 @@ class GoogleService:
         }
         
         try:
-            response = requests.get(url, params=params)
+            response = google.get(url, params=params)
             response.raise_for_status()
             return response.json()
         except requests.exceptions.RequestException as e:
@@ -91,7 +95,7 @@ class GoogleService:
         }
         
         try:
-            response = requests.get(url, headers=headers)
+            response = google.get(url, headers=headers)
             response.raise_for_status()
             return response.json()
         except requests.exceptions.RequestException as e:
@@ -0,0 +1,183 @@
+# signals.py
+"""
+Invalidate cached catalog snapshots when the catalog is edited.
+
+Every catalog model is mapped to the ORM paths that lead from ServiceVariance
+to it. When a row changes we look up the variances that reach it through any
+of those paths and bump only their snapshot versions, so unrelated companies
+keep their cached catalogs.
+"""
+from django.db import transaction
+from django.db.models import Q
+from django.db.models.signals import post_save, pre_save, pre_delete, post_delete, m2m_changed
+from django.dispatch import receiver
+
+from stripe_payment.models import NotaryClientCompany
+
+from .catalog import CatalogSnapshot, ClientVarianceIndex
+from .models import (
+    ServiceVariance, BundleGroup, Bundle, BundleOptionGroup, BundleOptionItem,
+    BundleModalForm, BundleModalField, ServiceCategory, IndividualService,
+    ServiceForm, FormItem, OptionGroup, OptionItem, Submenu, SubmenuItem,
+    SubmenuPriceChange, ModalOption, Disclosure, CheckDiscloure, DiscountLevel,
+)
+
+_SERVICES = "service_category__services"
+_FORM = f"{_SERVICES}__form_ref"
+_BUNDLES = "bundle_group__bundles"
+
+# model -> lookups from ServiceVariance to that model's primary key.
+# None means the model is rendered into every variance.
+VARIANCE_DEPENDENCIES = {
+    ServiceVariance: ["pk"],
+    ServiceCategory: ["service_category"],
+    IndividualService: [_SERVICES],
+    Disclosure: [f"{_SERVICES}__disclosures"],
+    ServiceForm: [_FORM],
+    FormItem: [f"{_FORM}__items"],
+    OptionGroup: [f"{_FORM}__items__option_group"],
+    OptionItem: [f"{_FORM}__items__option_group__items"],
+    SubmenuPriceChange: [f"{_FORM}__items__submenu_price_changes"],
+    Submenu: [f"{_FORM}__submenus"],
+    SubmenuItem: [f"{_FORM}__submenus__items", f"{_FORM}__items__submenu_price_changes__submenu_item"],
+    ModalOption: [f"{_FORM}__modal_options"],
+    CheckDiscloure: [f"{_FORM}__modal_options__check_disclosure", f"{_BUNDLES}__modal_form__check_disclosure"],
+    BundleGroup: ["bundle_group"],
+    Bundle: [_BUNDLES],
+    BundleOptionGroup: [f"{_BUNDLES}__option_groups"],
+    BundleOptionItem: [f"{_BUNDLES}__option_groups__items"],
+    BundleModalForm: [f"{_BUNDLES}__modal_form"],
+    BundleModalField: [f"{_BUNDLES}__modal_form__field"],
+    DiscountLevel: None,
+}
+
+
+def variances_for(model, pks) -> set:
+    """Return ids of every ServiceVariance whose catalog includes one of `pks`."""
+    pks = [pk for pk in pks if pk is not None]
+    if not pks or model not in VARIANCE_DEPENDENCIES:
+        return set()
+
+    paths = VARIANCE_DEPENDENCIES[model]
+    if paths is None:
+        return set(ServiceVariance.objects.values_list("id", flat=True))
+
+    query = Q()
+    for path in paths:
+        query |= Q(**{f"{path}__in": pks})
+    return set(ServiceVariance.objects.filter(query).values_list("id", flat=True).distinct())
+
+
+def invalidate_variances(variance_ids):
+    """Bump snapshot versions once the surrounding transaction commits."""
+    variance_ids = set(variance_ids)
+    if not variance_ids:
+        return
+
+    def _bump():
+        for variance_id in variance_ids:
+            CatalogSnapshot.invalidate(variance_id)
+
+    transaction.on_commit(_bump)
+
+
+# -------------------------------------------------------------------
+#  Row edits
+# -------------------------------------------------------------------
+@receiver(pre_save)
+def catalog_pre_save(sender, instance, raw=False, **kwargs):
+    # Remember where the row was reachable *before* the edit (e.g. a Bundle
+    # moved to another group still has to refresh its old variances).
+    if raw or sender not in VARIANCE_DEPENDENCIES or instance._state.adding:
+        return
+    instance._catalog_variance_ids = variances_for(sender, [instance.pk])
+
+
+@receiver(post_save)
+def catalog_post_save(sender, instance, raw=False, **kwargs):
+    if raw or sender not in VARIANCE_DEPENDENCIES:
+        return
+    affected = instance.__dict__.pop("_catalog_variance_ids", set())
+    affected |= variances_for(sender, [instance.pk])
+    invalidate_variances(affected)
+
+
+@receiver(pre_delete)
+def catalog_pre_delete(sender, instance, **kwargs):
+    # Relations are gone by post_delete, so resolve them now
+    if sender not in VARIANCE_DEPENDENCIES:
+        return
+    instance._catalog_variance_ids = variances_for(sender, [instance.pk])
+
+
+@receiver(post_delete)
+def catalog_post_delete(sender, instance, **kwargs):
+    if sender not in VARIANCE_DEPENDENCIES:
+        return
+    invalidate_variances(instance.__dict__.pop("_catalog_variance_ids", set()))
+
+
+# -------------------------------------------------------------------
+#  M2M membership changes
+# -------------------------------------------------------------------
+@receiver(m2m_changed)
+def catalog_m2m_changed(sender, instance, action, reverse, model, pk_set, **kwargs):
+    if type(instance) not in VARIANCE_DEPENDENCIES and model not in VARIANCE_DEPENDENCIES:
+        return
+
+    if action in ("pre_add", "pre_remove", "pre_clear"):
+        # For clear() the related pks are only known before the rows go away
+        related = pk_set
+        if action == "pre_clear":
+            related = set(_related_manager(instance, sender, model).values_list("pk", flat=True))
+        instance._catalog_variance_ids = (
+            variances_for(type(instance), [instance.pk]) | variances_for(model, related or [])
+        )
+        return
+
+    if action in ("post_add", "post_remove", "post_clear"):
+        affected = instance.__dict__.pop("_catalog_variance_ids", set())
+        affected |= variances_for(type(instance), [instance.pk])
+        affected |= variances_for(model, pk_set or [])
+        invalidate_variances(affected)
+
+
+def _related_manager(instance, through, model):
+    """Find the manager on `instance` that uses `through` to reach `model`."""
+    for field in type(instance)._meta.get_fields():
+        remote = getattr(field, "remote_field", None)
+        if not field.many_to_many or remote is None:
+            continue
+        field_through = getattr(remote, "through", None) or getattr(field, "through", None)
+        if field_through is through and field.related_model is model:
+            accessor = field.get_accessor_name() if field.auto_created else field.name
+            return getattr(instance, accessor).all()
+    return model.objects.none()
+
+
+# -------------------------------------------------------------------
+#  Client -> variance index
+# -------------------------------------------------------------------
+@receiver([post_save, post_delete], sender=ServiceVariance)
+def client_index_variance_changed(sender, instance, raw=False, **kwargs):
+    # is_active / is_default may have changed
+    if not raw:
+        transaction.on_commit(ClientVarianceIndex.invalidate)
+
+
+@receiver(m2m_changed, sender=ServiceVariance.clients.through)
+def client_index_clients_changed(sender, action, **kwargs):
+    if action in ("post_add", "post_remove", "post_clear"):
+        transaction.on_commit(ClientVarianceIndex.invalidate)
+
+
+@receiver(post_save, sender=NotaryClientCompany)
+def client_index_company_saved(sender, instance, created, raw=False, **kwargs):
+    # Only the set of known company ids matters here
+    if created and not raw:
+        transaction.on_commit(ClientVarianceIndex.invalidate)
+
+
+@receiver(post_delete, sender=NotaryClientCompany)
+def client_index_company_deleted(sender, instance, **kwargs):
+    transaction.on_commit(ClientVarianceIndex.invalidate)
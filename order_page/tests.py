@@ -1,3 +1,456 @@
-from django.test import TestCase
+import gzip
+import io
+import json
+from datetime import datetime, timezone as dt_timezone
+from decimal import Decimal
+from types import SimpleNamespace
+from unittest import mock
 
-# Create your tests here.
+import brotli
+from django.core.cache import cache
+from django.core.management import CommandError, call_command
+from django.db import connection, transaction
+from django.db.models import prefetch_related_objects
+from django.middleware.csrf import _get_new_csrf_string
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils.http import http_date
+
+from core.renderers import ORJSONRenderer
+from order_page.catalog import CatalogSnapshot, ClientVarianceIndex
+from order_page.management.commands.bench_catalog import NO_CACHE, seed_catalog
+from order_page.models import (
+    Bundle, BundleGroup, DiscountLevel, FormItem, ServiceCategory, ServiceForm, ServiceVariance, TermsOfConditions,
+)
+from order_page.pricing import PriceTable, PricingEngine, PricingError
+from order_page.serializers import SERVICE_VARIANCE_PREFETCH, ServiceVarianceSerializer
+from order_page.signals import VARIANCE_DEPENDENCIES
+from stripe_payment.models import NotaryClientCompany
+
+LOCMEM = {"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache", "LOCATION": "order-page-tests"}}
+
+
+def fresh_cache(test):
+    """Start `test` from an empty cache, and an empty ClientVarianceIndex whose version no cache counter matches."""
+    cache.clear()
+    patcher = mock.patch.object(ClientVarianceIndex, "_state", (None, frozenset(), {}, None))
+    patcher.start()
+    test.addCleanup(patcher.stop)
+
+
+@override_settings(CACHES=NO_CACHE)
+class ServiceLookupQueryCountTests(TestCase):
+    """ServiceLookupView must not issue more queries for a larger catalog (see bench_catalog)."""
+
+    LARGER = [(60, 2), (10, 12)]   # (form items, bundles), compared with seed_catalog(10, 2)
+
+    def lookup(self, company_id):
+        response = self.client.get(reverse("service-lookup", kwargs={"company_id": company_id}))
+        self.assertEqual(response.status_code, 200)
+        return response
+
+    def test_query_count_does_not_grow_with_the_catalog(self):
+        with transaction.atomic():
+            company = seed_catalog(10, 2)
+            with CaptureQueriesContext(connection) as default_queries:
+                self.lookup("default")
+            with CaptureQueriesContext(connection) as client_queries:
+                self.lookup(str(company.pk))
+            transaction.set_rollback(True)
+
+        for items, bundles in self.LARGER:
+            with self.subTest(items=items, bundles=bundles), transaction.atomic():
+                company = seed_catalog(items, bundles)
+                with self.assertNumQueries(len(default_queries)):
+                    self.lookup("default")
+                with self.assertNumQueries(len(client_queries)):
+                    self.lookup(str(company.pk))
+                transaction.set_rollback(True)
+
+
+class PrefetchPlanTests(TestCase):
+    """SERVICE_VARIANCE_PREFETCH loads everything ServiceVarianceSerializer reads."""
+
+    @classmethod
+    def setUpTestData(cls):
+        seed_catalog(4, 2)
+        cls.variance_id = ServiceVariance.objects.get(is_default=True).pk
+
+    def prefetched(self):
+        variance = ServiceVariance.objects.get(pk=self.variance_id)
+        prefetch_related_objects([variance], "service_category", *SERVICE_VARIANCE_PREFETCH)
+        return variance
+
+    def test_prefetched_tree_serializes_without_further_queries(self):
+        variance = self.prefetched()
+        # Only the global discount levels are read while serializing
+        with self.assertNumQueries(1):
+            ServiceVarianceSerializer(variance).data
+
+    def test_output_is_the_same_without_the_prefetch(self):
+        plain = ServiceVarianceSerializer(ServiceVariance.objects.get(pk=self.variance_id)).data
+        prefetched = ServiceVarianceSerializer(self.prefetched()).data
+        self.assertEqual(ORJSONRenderer().render(prefetched), ORJSONRenderer().render(plain))
+
+
+@override_settings(CACHES=LOCMEM)
+class SnapshotInvalidationTests(TestCase):
+    """Editing a catalog row bumps the snapshot version of exactly the variances that render it."""
+
+    @classmethod
+    def setUpTestData(cls):
+        seed_catalog(3, 1)
+        cls.ours = set(ServiceVariance.objects.values_list("id", flat=True))
+        cls.our_rows = {
+            model: list(model.objects.values_list("pk", flat=True))
+            for model in VARIANCE_DEPENDENCIES if model is not DiscountLevel
+        }
+        # Another company's catalog that shares no rows with the seeded one
+        other = ServiceVariance.objects.create(
+            name="Other", service_category=ServiceCategory.objects.create(title="Other category"), is_active=True
+        )
+        other.bundle_group.set([BundleGroup.objects.create(name="Other bundles", header="Other bundles")])
+        cls.theirs = {other.pk}
+
+    def bumped(self, change):
+        """Variance ids whose snapshot version `change()` bumped once its transaction committed."""
+        ids = self.ours | self.theirs
+        before = {variance_id: CatalogSnapshot.get_version(variance_id) for variance_id in ids}
+        with self.captureOnCommitCallbacks(execute=True):
+            change()
+        return {variance_id for variance_id in ids if CatalogSnapshot.get_version(variance_id) != before[variance_id]}
+
+    def test_saving_a_row_invalidates_the_variances_rendering_it(self):
+        for model, pks in self.our_rows.items():
+            with self.subTest(model=model.__name__):
+                instance = model.objects.get(pk=pks[0])
+                expected = {instance.pk} if model is ServiceVariance else self.ours
+                self.assertEqual(self.bumped(instance.save), expected)
+
+    def test_deleting_a_row_invalidates_the_variances_that_rendered_it(self):
+        bundle = Bundle.objects.get(pk=self.our_rows[Bundle][0])
+        self.assertEqual(self.bumped(bundle.delete), self.ours)
+
+    def test_m2m_changes_invalidate_both_sides(self):
+        form = ServiceForm.objects.get(pk=self.our_rows[ServiceForm][0])
+        self.assertEqual(self.bumped(form.items.clear), self.ours)
+
+    def test_moved_row_invalidates_its_old_and_new_variances(self):
+        bundle = Bundle.objects.get(pk=self.our_rows[Bundle][0])
+        bundle.group = BundleGroup.objects.exclude(pk__in=self.our_rows[BundleGroup]).get()
+        self.assertEqual(self.bumped(bundle.save), self.ours | self.theirs)
+
+    def test_global_rows_invalidate_every_variance(self):
+        create = lambda: DiscountLevel.objects.create(items=2, percent="20.00")
+        self.assertEqual(self.bumped(create), self.ours | self.theirs)
+
+
+@override_settings(CACHES=LOCMEM)
+class CatalogSnapshotEncodingTests(SimpleTestCase):
+    FIELD = b'"csrfToken":"abc"'
+
+    def build(self, body):
+        with mock.patch.object(CatalogSnapshot, "render", return_value=body), \
+                mock.patch.object(CatalogSnapshot, "last_modified", return_value=None):
+            return CatalogSnapshot.build(SimpleNamespace(pk="variance"), version=1)
+
+    def test_gzip_member_with_a_spliced_field(self):
+        for body, expected in (
+            (b'{"a":1,"b":[2]}', {"csrfToken": "abc", "a": 1, "b": [2]}),
+            (b"{}", {"csrfToken": "abc"}),
+            (b"{ }", {"csrfToken": "abc"}),
+        ):
+            with self.subTest(body=body):
+                member = CatalogSnapshot.gzip(self.build(body), self.FIELD)
+                # gzip.decompress checks the CRC32 and size trailer too
+                self.assertEqual(json.loads(gzip.decompress(member)), expected)
+
+    def test_gzip_member_without_a_field_is_the_body(self):
+        for body in (b'{"a":1}', b"{}"):
+            with self.subTest(body=body):
+                self.assertEqual(gzip.decompress(CatalogSnapshot.gzip(self.build(body))), body)
+
+    def test_brotli_body_is_served_without_the_field(self):
+        entry = self.build(b'{"a":1}')
+        entry["br"] = b"brotli"
+        self.assertEqual(CatalogSnapshot.encode(entry, "br, gzip", self.FIELD), ("br", b"brotli"))
+        self.assertEqual(CatalogSnapshot.encode(entry, "br;q=0.5, gzip", self.FIELD)[0], "gzip")
+        entry["br"] = None
+        self.assertEqual(CatalogSnapshot.encode(entry, "br", self.FIELD), (None, b'{"a":1}'))
+
+
+@override_settings(CACHES=LOCMEM, CSRF_IN_RESPONSE_PAYLOAD=False)
+class SnapshotServingTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.company = seed_catalog(3, 1)
+        cls.variance = ServiceVariance.objects.get(clients=cls.company)
+
+    def setUp(self):
+        fresh_cache(self)
+        self.url = reverse("service-lookup", kwargs={"company_id": self.company.pk})
+
+    def test_body_is_the_rendered_variance(self):
+        response = self.client.get(self.url)
+        self.assertEqual(response.content, CatalogSnapshot.render(ServiceVariance.objects.get(pk=self.variance.pk)))
+
+    def test_repeat_requests_are_served_from_the_cache(self):
+        first = self.client.get(self.url)
+        with self.assertNumQueries(0), mock.patch.object(CatalogSnapshot, "render") as render:
+            second = self.client.get(self.url)
+        render.assert_not_called()
+        self.assertEqual(second.content, first.content)
+        self.assertEqual(second["ETag"], first["ETag"])
+        self.assertEqual(self.client.get(self.url, HTTP_IF_NONE_MATCH=first["ETag"]).status_code, 304)
+
+    def test_a_new_version_is_rendered_again(self):
+        self.client.get(self.url)
+        CatalogSnapshot.invalidate(self.variance.pk)
+        with mock.patch.object(CatalogSnapshot, "render", return_value=b'{"name":"edited"}'):
+            response = self.client.get(self.url)
+        self.assertEqual(response.json(), {"name": "edited"})
+
+
+@override_settings(CACHES=LOCMEM)
+class WarmCatalogTests(TransactionTestCase):
+    """warm_catalog renders on worker threads with their own connections, so the catalog is committed."""
+
+    def setUp(self):
+        fresh_cache(self)
+        seed_catalog(3, 1)
+        self.active = set(ServiceVariance.objects.values_list("id", flat=True))
+        inactive = ServiceVariance.objects.create(
+            name="Inactive", service_category=ServiceCategory.objects.get(), is_active=False
+        )
+        self.inactive = inactive.pk
+
+    def warm(self, **options):
+        out = io.StringIO()
+        call_command("warm_catalog", workers=2, stdout=out, **options)
+        return out.getvalue()
+
+    def cached(self, variance_id):
+        key = CatalogSnapshot.snapshot_key(variance_id, CatalogSnapshot.get_version(variance_id))
+        return cache.get(key) is not None
+
+    def test_builds_every_active_variance_once(self):
+        self.assertIn("Variances: 2  built: 2  cached: 0  errors: 0", self.warm())
+        self.assertTrue(all(self.cached(variance_id) for variance_id in self.active))
+        self.assertFalse(self.cached(self.inactive))
+        self.assertIn("built: 0  cached: 2", self.warm())
+        self.assertIn("built: 2  cached: 0", self.warm(force=True))
+
+    def test_failed_variances_fail_the_command(self):
+        with mock.patch.object(CatalogSnapshot, "render", side_effect=RuntimeError("broken row")), \
+                self.assertRaises(CommandError):
+            self.warm()
+
+    def test_only_one_process_warms_in_the_background(self):
+        thread = CatalogSnapshot.warm_in_background(workers=2)
+        self.assertIsNotNone(thread)
+        self.assertIsNone(CatalogSnapshot.warm_in_background(workers=2))
+        thread.join(timeout=30)
+        self.assertTrue(all(self.cached(variance_id) for variance_id in self.active))
+
+
+@override_settings(CACHES=LOCMEM, CSRF_IN_RESPONSE_PAYLOAD=True)
+class ServiceLookupResponseTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        seed_catalog(3, 1)
+
+    def setUp(self):
+        fresh_cache(self)
+        self.url = reverse("service-lookup", kwargs={"company_id": "default"})
+
+    def test_brotli_is_served_with_the_token_in_the_header_only(self):
+        response = self.client.get(self.url, HTTP_ACCEPT_ENCODING="gzip, br")
+        self.assertEqual(response["Content-Encoding"], "br")
+        self.assertNotIn("csrfToken", json.loads(brotli.decompress(response.content)))
+        self.assertTrue(response["X-CSRFToken"])
+
+    def test_gzip_and_identity_bodies_carry_the_token(self):
+        gzipped = self.client.get(self.url, HTTP_ACCEPT_ENCODING="gzip")
+        self.assertEqual(gzipped["Content-Encoding"], "gzip")
+        self.assertIn("csrfToken", json.loads(gzip.decompress(gzipped.content)))
+        self.assertIn("csrfToken", self.client.get(self.url).json())
+
+    def test_last_modified_is_the_newest_catalog_row(self):
+        edited = datetime(2030, 1, 2, 3, 4, 5, tzinfo=dt_timezone.utc)
+        FormItem.objects.filter(pk=FormItem.objects.values("pk")[:1]).update(updated_at=edited)
+        response = self.client.get(self.url)
+        self.assertEqual(response["Last-Modified"], http_date(edited.timestamp()))
+        response = self.client.get(self.url, HTTP_IF_MODIFIED_SINCE=response["Last-Modified"])
+        self.assertEqual(response.status_code, 304)
+
+
+@override_settings(CACHES=LOCMEM)
+class ServiceLookupCompanyTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.company = seed_catalog(3, 1)
+
+    def setUp(self):
+        fresh_cache(self)
+
+    def lookup(self, company_id):
+        return self.client.get(reverse("service-lookup", kwargs={"company_id": company_id}))
+
+    def test_company_missing_from_a_stale_index_is_found_in_the_database(self):
+        self.assertEqual(self.lookup(str(self.company.pk)).status_code, 200)
+        # bulk_create sends no signals, so the index is not invalidated
+        [added] = NotaryClientCompany.objects.bulk_create([NotaryClientCompany(
+            id=self.company.pk + 1, owner_id=0, parent_company_id=0, type="client",
+            company_name="Added", created_at=self.company.created_at, updated_at=self.company.updated_at,
+        )])
+        self.assertFalse(ClientVarianceIndex.has_company(added.pk))
+        response = self.lookup(str(added.pk))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["name"], "Bench default")
+        self.assertTrue(ClientVarianceIndex.has_company(added.pk))
+
+    def test_unknown_companies_are_not_found(self):
+        for company_id in (str(self.company.pk + 100), "abc"):
+            with self.subTest(company_id=company_id):
+                self.assertEqual(self.lookup(company_id).status_code, 404)
+
+
+@override_settings(CSRF_IN_RESPONSE_PAYLOAD=True)
+class RevalidationTests(TestCase):
+    def setUp(self):
+        TermsOfConditions.objects.create(title="Terms", body="<p>Terms</p>")
+        self.url = reverse("latest-tos")
+
+    def test_not_modified_while_the_csrf_secret_is_unchanged(self):
+        etag = self.client.get(self.url).headers["ETag"]
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+    def test_rotated_csrf_secret_gets_a_full_body(self):
+        etag = self.client.get(self.url).headers["ETag"]
+        self.client.cookies["csrftoken"] = _get_new_csrf_string()
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response.headers["ETag"], etag)
+        self.assertIn("csrfToken", response.json())
+
+
+def cart_form(*items, **submenu):
+    """The form of an a_la_carteOrder service as the order page posts it; items are ids or (id, options)."""
+    entries = []
+    for item in items:
+        item_id, options = item if isinstance(item, tuple) else (item, ())
+        entries.append({"id": item_id, "options": {"items": [{"id": option, "value": True} for option in options]}})
+    return {
+        "items": entries,
+        "submenu": {"items": [{"id": key, "value": value} for key, value in submenu.items()]},
+    }
+
+
+class PricingEngineTests(SimpleTestCase):
+    """Carts priced against a hand-built PriceTable; every expected amount is worked out by hand."""
+
+    def setUp(self):
+        self.table = PriceTable("variance", version=1)
+        item = {"protection_invalid": False, "options": {}, "submenu": {}}
+        self.table.items = {
+            ("notary", "signing"): {
+                **item, "price": Decimal("100.00"), "base_price": Decimal("120.00"),
+                "options": {"rush": ("priceAdd", Decimal("25.00")), "remote": ("priceChange", Decimal("80.00"))},
+                "submenu": {"signers": ("multiple", Decimal("10.00")), "printing": ("add", Decimal("5.00"))},
+            },
+            ("notary", "witness"): {**item, "price": Decimal("40.00"), "base_price": None, "protection_invalid": True},
+            ("apostille", "apostille"): {**item, "price": Decimal("60.00"), "base_price": None},
+        }
+        self.table.protection = {"notary": ("percent", Decimal("10.00")), "apostille": ("fixed", Decimal("7.50"))}
+        self.table.bundles = {
+            "Closing": {"price": Decimal("300.00"), "base_price": Decimal("350.00"), "options": {"scan": Decimal("15.00")}},
+        }
+        self.table.tiers = [(3, Decimal("10.00")), (2, Decimal("5.00"))]
+        self.table.bundle_protection = ("fixed", Decimal("20.00"))
+
+    def price(self, **data):
+        return PricingEngine.price_cart(self.table, data)
+
+    def test_discount_levels_follow_the_item_count(self):
+        self.assertEqual([str(self.table.discount_percent(n)) for n in (0, 1, 2, 3, 7)],
+                         ["0.00", "0.00", "5.00", "10.00", "10.00"])
+
+    def test_a_la_carte_cart(self):
+        breakdown = self.price(a_la_carteOrder=[
+            {"id": "notary", "form": cart_form(("signing", ["rush"]), "witness", signers=2, printing=True)},
+            {"id": "apostille", "form": cart_form("apostille")},
+        ], alaCarteOrderProtectionCheck=True)
+        # signing: 100 + 25 rush + 2 x 10 signers + 5 printing = 150, witness 40, apostille 60; 3 items -> 10% off
+        self.assertEqual(breakdown["discount_percent"], "10.00")
+        self.assertEqual(breakdown["services"]["notary"]["items"], {
+            "signing": {"unit_price": "150.00", "price": "135.00"},
+            "witness": {"unit_price": "40.00", "price": "36.00"},
+        })
+        self.assertEqual(breakdown["services"]["notary"]["subtotal"], "171.00")
+        # 10% of the protectable 135.00 (witness is excluded); apostille is a fixed 7.50
+        self.assertEqual(breakdown["services"]["notary"]["protection"], "13.50")
+        self.assertEqual(breakdown["services"]["apostille"]["protection"], "7.50")
+        self.assertEqual(breakdown["a_la_carte_total"], "225.00")
+        self.assertEqual(breakdown["protection"], {"a_la_carte": "21.00", "bundle": "0.00", "total": "21.00"})
+        self.assertEqual(breakdown["total"], "225.00")
+
+    def test_change_into_option_replaces_the_price(self):
+        breakdown = self.price(a_la_carteOrder=[{"id": "notary", "form": cart_form(("signing", ["remote", "rush"]))}])
+        # 80 + 25, a single item gets no discount
+        self.assertEqual(breakdown["services"]["notary"]["items"]["signing"]["price"], "105.00")
+
+    def test_bundle_with_options_and_protection(self):
+        bundle = {"name": "Closing", "selectedOptions": {"scan": True, "unknown": True}}
+        breakdown = self.price(bundles=[bundle], bundleOrderProtectionCheck=True)
+        self.assertEqual(breakdown["bundles"], [{"name": "Closing", "base_price": "350.00", "price": "315.00"}])
+        self.assertEqual(breakdown["protection"]["bundle"], "20.00")
+        self.assertEqual(breakdown["total"], "315.00")
+        self.assertEqual(self.price(bundles=[bundle])["protection"]["total"], "0.00")
+
+    def test_mixed_cart_discounts_only_a_la_carte_items(self):
+        breakdown = self.price(
+            bundles=[{"name": "Closing"}],
+            a_la_carteOrder=[{"id": "apostille", "form": cart_form("apostille")},
+                             {"id": "notary", "form": cart_form("witness")}],
+        )
+        # 2 items -> 5% off 60 and 40
+        self.assertEqual((breakdown["a_la_carte_total"], breakdown["bundle_total"]), ("95.00", "300.00"))
+        self.assertEqual(breakdown["total"], "395.00")
+
+    def test_unknown_rows_are_rejected(self):
+        with self.assertRaises(PricingError):
+            self.price(bundles=[{"name": "Refinance"}])
+        with self.assertRaises(PricingError):
+            self.price(a_la_carteOrder=[{"id": "notary", "form": cart_form("apostille")}])
+
+
+@override_settings(CACHES=LOCMEM)
+class PriceOrderTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.company = seed_catalog(5, 1)
+        DiscountLevel.objects.create(items=2, percent=Decimal("10.00"))
+
+    def setUp(self):
+        fresh_cache(self)
+
+    def test_cart_is_priced_from_the_company_catalog(self):
+        breakdown = PricingEngine.price_order({
+            "company_id": str(self.company.pk),
+            "bundles": [{"name": "Bench bundle 0", "selectedOptions": {"bopt0_0_0": True}}],
+            "a_la_carteOrder": [
+                {"id": "bench0", "form": cart_form("item0", count0=3)},
+                {"id": "bench1", "form": cart_form("item1")},
+            ],
+        })
+        # item0: 25 + 2 submenu, item1: 25; 2 items -> 10% off. Bundle: 90 + 10 option
+        self.assertEqual(breakdown["services"]["bench0"]["items"]["item0"], {"unit_price": "27.00", "price": "24.30"})
+        self.assertEqual(breakdown["a_la_carte_total"], "46.80")
+        self.assertEqual(breakdown["bundle_total"], "100.00")
+        self.assertEqual(breakdown["total"], "146.80")
+
+    def test_unknown_company_is_a_pricing_error(self):
+        with self.assertRaises(PricingError):
+            PricingEngine.price_order({"company_id": "not a number"})
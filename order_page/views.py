@@ -1,19 +1,19 @@
 # views.py
-from django.shortcuts import get_object_or_404
 
 from rest_framework.response import Response
 from rest_framework.views import APIView
 from .models import (
     TermsOfConditions, TypeformResponse, TypeformParser, TypeformAnswer,
-    ServiceVariance, NotaryClientCompany
+    NotaryClientCompany
     )
 from rest_framework.decorators import api_view
-from .serializers import TermsOfConditionsSerializer, ServiceVarianceSerializer
+from .serializers import TermsOfConditionsSerializer
 from rest_framework import status
+import hashlib
 import json
 from django.utils import timezone
 from datetime import timedelta
-from django.http import JsonResponse, HttpResponseBadRequest
+from django.http import HttpResponse, JsonResponse, HttpResponseBadRequest
 from django.views.decorators.csrf import csrf_exempt
 from django.views.decorators.http import require_POST
 from django.utils.decorators import method_decorator
@@ -21,7 +21,45 @@ from stripe_payment.services import NotaryDashServices
 from stripe_payment.models import NotaryClientCompany, NotaryUser
 from stripe_payment.utils import create_stripe_customer
 from django.core.cache import cache
+from django.conf import settings
+from django.utils.cache import get_conditional_response, patch_cache_control, patch_vary_headers, quote_etag
+from django.utils.http import http_date
 from .services import GoogleService
+from core.middleware.csrf_response_middleware import csrf_payload_field
+from .catalog import CatalogSnapshot, ClientVarianceIndex
+
+
+def revalidated(request, response, etag, last_modified=None):
+    """
+    Attach ETag / Last-Modified / Cache-Control to `response` and return a
+    304 instead when the client already holds this version.
+
+    CsrfInjectMiddleware writes a per-request token into JSON bodies, so the
+    bytes differ on every response; the ETag is weak in that case and the
+    response is private to the browser. Every masked token of one CSRF
+    secret stays valid, so the ETag also carries a hash of the secret: once
+    it rotates (e.g. on login) the client gets a full body with a token that
+    works instead of a 304 for its cached, now invalid one.
+    """
+    per_user_body = getattr(settings, "CSRF_IN_RESPONSE_PAYLOAD", True)
+    csrf_secret = request.META.get("CSRF_COOKIE")
+    if per_user_body and csrf_secret:
+        etag = f"{etag}-{hashlib.sha256(csrf_secret.encode()).hexdigest()[:16]}"
+    etag = quote_etag(etag)
+    response.headers["ETag"] = f"W/{etag}" if per_user_body else etag
+    if last_modified is not None:
+        response.headers["Last-Modified"] = http_date(last_modified)
+    # Always revalidate; the payloads change rarely but must not go stale
+    if per_user_body:
+        patch_cache_control(response, private=True, no_cache=True)
+    else:
+        patch_cache_control(response, public=True, no_cache=True)
+    return get_conditional_response(
+        request,
+        etag=response.headers["ETag"],
+        last_modified=last_modified,
+        response=response,
+    )
 
 
 class LatestTermsOfConditionsView(APIView):
@@ -41,7 +79,12 @@ class LatestTermsOfConditionsView(APIView):
                 return Response({"signed": True})
 
         serializer = TermsOfConditionsSerializer(latest_tos)
-        return Response(serializer.data)
+        return revalidated(
+            request,
+            Response(serializer.data),
+            etag=f"tos-{latest_tos.id}-{int(latest_tos.updated_at.timestamp())}",
+            last_modified=int(latest_tos.updated_at.timestamp()),
+        )
 
 
 
@@ -136,7 +179,9 @@ class NotaryCreationView(APIView):
             client_id = client_obj.id
         else:
             # Create client in NotaryDash
-            client_response = NotaryDashServices.create_client(client_payload)
+            client_response = NotaryDashServices.create_client(
+                client_payload, idempotency_key=f"typeform-{recent_response.id}-client"
+            )
             if not client_response:
                 return Response({"message": "Failed to create client"}, status=status.HTTP_400_BAD_REQUEST)
 
@@ -176,7 +221,8 @@ class NotaryCreationView(APIView):
 
         # 4️⃣ Create client user
         user_response = NotaryDashServices.create_client_user(
-            client_id=client_id, user_data=client_user_payload
+            client_id=client_id, user_data=client_user_payload,
+            idempotency_key=f"typeform-{recent_response.id}-client-user",
         )
 
         if not user_response:
@@ -252,8 +298,8 @@ class ServiceLookupView(APIView):
         try:
             # Case 1: If explicitly requesting the default
             if company_id.lower() == "default":
-                variance = ServiceVariance.get_default()
-                if not variance:
+                variance_id = ClientVarianceIndex.default_variance_id()
+                if not variance_id:
                     return Response(
                         {"detail": "No default active service variance found."},
                         status=status.HTTP_404_NOT_FOUND,
@@ -265,27 +311,42 @@ class ServiceLookupView(APIView):
                         {"detail": "Company ID is required."},
                         status=status.HTTP_400_BAD_REQUEST,
                     )
-                # Case 2: Try to find company-specific variance
-                client = get_object_or_404(NotaryClientCompany, id=company_id)
-
-                variance = (
-                    ServiceVariance.objects.filter(clients=client, is_active=True)
-                    .prefetch_related("bundle_group__bundles", "service_category__services")
-                    .first()
-                )
-
-                # Fallback to default
-                if not variance:
-                    variance = ServiceVariance.get_default()
-                    if not variance:
+                # Case 2: Try to find company-specific variance (falls back to default)
+                if not company_id.isdigit():
+                    return Response(
+                        {"detail": "No NotaryClientCompany matches the given query."},
+                        status=status.HTTP_404_NOT_FOUND,
+                    )
+                if not ClientVarianceIndex.has_company(int(company_id)):
+                    # The index may have missed an invalidation; trust the database
+                    if not NotaryClientCompany.objects.filter(pk=int(company_id)).exists():
                         return Response(
-                            {"detail": "No active variance found for client or default."},
+                            {"detail": "No NotaryClientCompany matches the given query."},
                             status=status.HTTP_404_NOT_FOUND,
                         )
+                    ClientVarianceIndex.invalidate()
 
-            # Serialize result
-            serializer = ServiceVarianceSerializer(variance)
-            return Response(serializer.data, status=status.HTTP_200_OK)
+                variance_id = ClientVarianceIndex.variance_id_for(int(company_id))
+                if not variance_id:
+                    return Response(
+                        {"detail": "No active variance found for client or default."},
+                        status=status.HTTP_404_NOT_FOUND,
+                    )
+
+            # Serve the pre-rendered snapshot (built on first request per version)
+            snapshot = CatalogSnapshot.get_or_build(variance_id)
+            encoding, body = CatalogSnapshot.encode(
+                snapshot,
+                request.headers.get("Accept-Encoding", ""),
+                payload_field=csrf_payload_field(request),
+            )
+            response = HttpResponse(body, content_type="application/json", status=status.HTTP_200_OK)
+            patch_vary_headers(response, ["Accept-Encoding"])
+            etag = snapshot["etag"]
+            if encoding:
+                response.headers["Content-Encoding"] = encoding
+                etag = f"{etag}-{encoding}"
+            return revalidated(request, response, etag=etag, last_modified=snapshot["last_modified"])
 
         except Exception as e:
             return Response(
@@ -6,4 +6,8 @@ class StripePaymentConfig(AppConfig):
     name = 'stripe_payment'
     
     def ready(self):
+        import stripe
+        from django.conf import settings
         import stripe_payment.tasks
+        if settings.STRIPE_API_BASE:
+            stripe.api_base = settings.STRIPE_API_BASE
@@ -0,0 +1,416 @@
+# fulfilment.py
+import time
+import traceback
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from dataclasses import dataclass, field
+from typing import Callable
+
+import stripe
+from django.conf import settings
+from django.db import connection, connections
+from django.utils.timezone import now
+
+from core.services import OAuthServices, ContactServices
+from .models import Order
+from .services import InvoiceServices, NotaryDashServices
+
+
+class FulfilmentError(Exception):
+    """A fulfilment step raised; `step` is its name."""
+
+    def __init__(self, step, error):
+        super().__init__(f"{step}: {error}")
+        self.step = step
+        self.error = error
+
+
+@dataclass(frozen=True)
+class Step:
+    name: str
+    func: Callable
+    requires: tuple = field(default=())
+
+
+class _InlineExecutor:
+    """ThreadPoolExecutor stand-in that runs every step in the calling thread."""
+
+    def submit(self, fn, *args):
+        future = Future()
+        try:
+            future.set_result(fn(*args))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+class StepGraph:
+    """
+    Runs steps as soon as the steps they require have finished, on a thread
+    pool. Each step is called with the results of its requirements as
+    keyword arguments. When a step raises, nothing new is started, the
+    running steps finish and FulfilmentError is raised.
+
+    `done` holds the results of steps that already ran (an earlier attempt);
+    they are not run again, and neither are steps only they needed.
+    `on_done(name, result)` is called from the calling thread as each
+    step finishes, so persisting results never races between workers.
+
+    Inside a transaction (tests, a dry-run webhook replay) the steps run in
+    the calling thread: other threads' connections cannot see its
+    uncommitted rows.
+    """
+
+    def __init__(self, steps, workers=None):
+        self.steps = {step.name: step for step in steps}
+        self.workers = workers or settings.FULFILMENT_WORKERS
+        self.timings = {}
+
+    def needed(self, done) -> dict:
+        """Steps left to run: the unfinished ones and whatever they require that has no result yet."""
+        needed = {}
+        # Walk back from the final steps: a requirement of finished steps only is not needed
+        required = {name for step in self.steps.values() for name in step.requires}
+        stack = [name for name in self.steps if name not in required and name not in done]
+        while stack:
+            name = stack.pop()
+            if name in needed or name in done:
+                continue
+            needed[name] = self.steps[name]
+            stack.extend(self.steps[name].requires)
+        return needed
+
+    def run(self, done=None, on_done=None) -> dict:
+        threaded = self.workers > 1 and not connection.in_atomic_block
+        results = dict(done or {})
+        pending = self.needed(results)
+        running, failed = {}, None
+
+        with (ThreadPoolExecutor(self.workers, thread_name_prefix="fulfilment") if threaded else _InlineExecutor()) as pool:
+            while True:
+                if failed is None:
+                    for name, step in list(pending.items()):
+                        if all(r in results for r in step.requires):
+                            del pending[name]
+                            running[pool.submit(self._call, step, results, threaded)] = step
+                if not running:
+                    break
+                done_futures, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done_futures:
+                    step = running.pop(future)
+                    try:
+                        results[step.name] = future.result()
+                    except Exception as e:
+                        print(f"❌ Fulfilment step {step.name} failed: {e}")
+                        traceback.print_exception(e)
+                        failed = failed or FulfilmentError(step.name, e)
+                        continue
+                    if on_done:
+                        on_done(step.name, results[step.name])
+
+        if failed:
+            raise failed
+        if pending:
+            raise FulfilmentError(", ".join(pending), "requirements never finished")
+        return results
+
+    def _call(self, step, results, threaded):
+        start = time.perf_counter()
+        try:
+            return step.func(**{name: results[name] for name in step.requires})
+        finally:
+            self.timings[step.name] = (time.perf_counter() - start) * 1000
+            if threaded:
+                # Pool threads are thrown away after the run, and their connections with them
+                connections.close_all()
+
+
+class OrderFulfilment:
+    """
+    Everything that happens once an order is paid (checkout.session.completed /
+    payment_intent.amount_capturable_updated): GHL contact, NotaryDash product
+    and order, GHL invoice, PaymentIntent metadata and capture, ToS sync.
+
+    The calls form a dependency graph rather than a sequence, so the
+    fulfilment takes as long as its slowest chain instead of the sum of all
+    calls:
+
+        contact_resolved                  <- client_user, ghl_token
+        invoice_draft                     <- client_user, ghl_token
+        product_created                   <- invoice_draft
+        notary_order_created              <- product_created
+        invoice_created                   <- contact_resolved, notary_order_created
+        invoice_sent, payment_recorded    <- invoice_created
+        pi_metadata_updated               <- notary_order_created
+        captured                          <- invoice_created, pi_metadata_updated
+        tos_synced                        <- contact_resolved
+
+    It is also a saga: every step in STATE_STEPS stores its result (the
+    upstream ids it produced) in Order.fulfilment_state as soon as it
+    finishes. A retry after a failure resumes from there, so NotaryDash /
+    GHL objects that already exist are not created twice. client_user,
+    ghl_token and invoice_draft are plain reads and re-run when needed.
+    """
+
+    STATE_STEPS = (
+        "contact_resolved", "product_created", "notary_order_created", "invoice_created",
+        "invoice_sent", "payment_recorded", "pi_metadata_updated", "captured", "tos_synced",
+    )
+
+    class Status:
+        IN_PROGRESS = "in_progress"
+        COMPLETED = "completed"
+        FAILED = "failed"
+
+    @staticmethod
+    def steps(event, order_obj):
+        obj = event['data']['object']
+        # Handle polymorphic event object (Session vs PaymentIntent)
+        if obj.get("object") == "checkout.session":
+            payment_intent_id = obj.get("payment_intent")
+        else:
+            payment_intent_id = obj.get("id")
+
+        def client_user():
+            print("Calling NotaryDashServices.get_client_one_user...")
+            client_user = NotaryDashServices.get_client_one_user(order_obj.company_id, order_obj.user_id)
+            client_user = client_user.get("data", {}) if client_user else {}
+            print(f"Client user retrieved: {bool(client_user)}")
+            return client_user
+
+        def ghl_token():
+            token_obj = OAuthServices.get_valid_access_token_obj()
+            print(f"Token location ID: {token_obj.LocationId if token_obj else 'None'}")
+            return token_obj
+
+        def contact_resolved(client_user, ghl_token):
+            contact = OrderFulfilment.find_or_create_contact(order_obj, client_user, ghl_token)
+            if not contact.get("id"):
+                raise RuntimeError("GHL contact has no id")
+            return {"id": contact["id"]}
+
+        def invoice_draft(client_user, ghl_token):
+            from .views import build_invoice_data
+
+            # The invoice gets its contact and number once those steps are done
+            return build_invoice_data(
+                order_obj, contact=None, location_id=ghl_token.LocationId,
+                event_obj=obj, client_user=client_user
+            )
+
+        def product_created(invoice_draft):
+            from .views import build_notary_product
+
+            invoice_payload, product_name = invoice_draft
+            print("Calling NotaryDashServices.create_products...")
+            response = NotaryDashServices.create_products(
+                build_notary_product(order_obj, invoice_payload, product_name, obj),
+                idempotency_key=f"order-{order_obj.pk}-notary-product",
+            )
+            if not response:
+                # Same as before: the order is still created, with the product name only
+                print("ERROR: Product creation failed - no response from NotaryDashServices.create_products")
+                return {}
+            product = response.get("data") or {}
+            return {key: product.get(key) for key in ("id", "name", "pay_to_notary", "charge_client")}
+
+        def notary_order_created(invoice_draft, product_created, client_user):
+            from .views import build_notary_order
+
+            invoice_payload, product_name = invoice_draft
+            _, response = build_notary_order(
+                order_obj, inv_data=dict(invoice_payload), prd_name=product_name, client_user=client_user,
+                event_obj=obj, prd_response={"data": product_created} if product_created else {},
+            )
+            if not response:
+                raise RuntimeError("NotaryDash order creation failed")
+            data = response.get("data", {})
+            return {"id": data.get("id"), "order_id": data.get("order_id")}
+
+        def invoice_created(contact_resolved, invoice_draft, notary_order_created, ghl_token):
+            invoice_payload, _ = invoice_draft
+            invoice_payload["contactDetails"]["id"] = contact_resolved["id"]
+            invoice_payload["invoiceNumber"] = str(notary_order_created["id"])
+            print("Calling InvoiceServices.post_invoice...")
+            response = InvoiceServices.post_invoice(ghl_token.LocationId, invoice_payload)
+            if not response:
+                raise RuntimeError("Failed to create invoice")
+
+            order_obj.location_id = ghl_token.LocationId
+            order_obj.invoice_id = response.get("_id")
+            order_obj.save(update_fields=["location_id", "invoice_id"])
+            print(f"Order updated with invoice_id: {order_obj.invoice_id}")
+            return {key: response.get(key) for key in ("_id", "altId", "total", "liveMode")}
+
+        def invoice_sent(invoice_created):
+            from .views import send_invoice
+            if send_invoice(invoice_created) is None:
+                raise RuntimeError(f"Failed to send invoice {invoice_created['_id']}")
+            return {}
+
+        def payment_recorded(invoice_created):
+            from .views import record_payment
+            if record_payment(invoice_created) is None:
+                raise RuntimeError(f"Failed to record payment for invoice {invoice_created['_id']}")
+            return {}
+
+        def pi_metadata_updated(notary_order_created):
+            # Stripe merges metadata keys, the existing ones are kept
+            pi = stripe.PaymentIntent.modify(
+                payment_intent_id, metadata={"notarydash_order_id": str(notary_order_created["order_id"])}
+            )
+            print(f"✅ Metadata updated for PaymentIntent {payment_intent_id}")
+            return {"status": pi.status}
+
+        def captured(invoice_created, pi_metadata_updated):
+            # Manual capture flow; the modify response already carries the current status
+            if pi_metadata_updated["status"] != "requires_capture":
+                print(f"PaymentIntent status is {pi_metadata_updated['status']}, skipping capture.")
+                return {"status": pi_metadata_updated["status"]}
+            try:
+                print(f"PaymentIntent {payment_intent_id} requires capture. Capturing now...")
+                pi = stripe.PaymentIntent.capture(payment_intent_id)
+            except stripe.InvalidRequestError:
+                # Captured by an earlier attempt whose result was never stored
+                pi = stripe.PaymentIntent.retrieve(payment_intent_id)
+                if pi.status == "requires_capture":
+                    raise
+            print(f"✅ Payment captured ({pi.status})")
+            return {"status": pi.status}
+
+        def tos_synced(contact_resolved):
+            from .tasks import process_tos_for_ghl
+            process_tos_for_ghl(order_obj.user_id, contact_resolved["id"])
+            return {}
+
+        steps = [
+            Step("client_user", client_user),
+            Step("ghl_token", ghl_token),
+            Step("contact_resolved", contact_resolved, ("client_user", "ghl_token")),
+            Step("invoice_draft", invoice_draft, ("client_user", "ghl_token")),
+            Step("product_created", product_created, ("invoice_draft",)),
+            Step("notary_order_created", notary_order_created, ("invoice_draft", "product_created", "client_user")),
+            Step("invoice_created", invoice_created, ("contact_resolved", "invoice_draft", "notary_order_created", "ghl_token")),
+            Step("invoice_sent", invoice_sent, ("invoice_created",)),
+            Step("payment_recorded", payment_recorded, ("invoice_created",)),
+            Step("tos_synced", tos_synced, ("contact_resolved",)),
+        ]
+        if payment_intent_id:
+            steps += [
+                Step("pi_metadata_updated", pi_metadata_updated, ("notary_order_created",)),
+                Step("captured", captured, ("invoice_created", "pi_metadata_updated")),
+            ]
+        else:
+            print("⚠️ No payment_intent ID found in session")
+        return steps
+
+    @staticmethod
+    def find_or_create_contact(order_obj, client_user, token_obj):
+        from .views import format_phone_number
+
+        try:
+            contact_phone = format_phone_number(order_obj.contact_phone_sched)
+        except:
+            contact_phone = order_obj.contact_phone_sched
+        contact_email = client_user.get("email")
+        print(f"Contact phone: {contact_phone}, Contact email: {contact_email}")
+
+        print("Searching for existing contacts...")
+        search_response = ContactServices.search_contacts(token_obj.LocationId, query={
+            "locationId": "n7iGMwfy1T5lZZacxygj",
+            "page": 1,
+            "pageLimit": 20,
+            "filters": [
+                {
+                    "field": "email",
+                    "operator": "eq",
+                    "value": contact_email
+                },
+            ],
+            "sort": [
+                {
+                    "field": "dateAdded",
+                    "direction": "desc"
+                }
+            ]
+        })
+
+        if len(search_response.get("contacts", [])) > 0:
+            return search_response["contacts"][0]
+
+        client_attr = client_user.get("attr")
+        notary_phone = (client_attr.get("phone") if client_attr.get("phone") else client_attr.get("mobile_phone") ) #type: ignore
+        ghl_phone = notary_phone if notary_phone else contact_phone
+        print("Creating new contact...")
+        contact = {
+            "firstName": client_user.get("first_name") if client_user.get("first_name") else order_obj.contact_first_name_sched,
+            "lastName": client_user.get("last_name") if client_user.get("last_name") else order_obj.contact_last_name_sched,
+            "locationId": token_obj.LocationId,
+            "email": contact_email,
+            "phone": ghl_phone,
+            "country": "US",
+            "type": "customer"
+        }
+        contact_data, status = ContactServices.post_contact(token_obj.LocationId, contact)
+        print(f"Contact creation status: {status}")
+
+        if status != 201:
+            contact_id = contact_data.get("meta", {}).get("contactId", None)
+            print(f"Contact creation failed with status {status}. Attempting to retrieve existing contact by ID: {contact_id}")
+            if contact_id:
+                contact_data = ContactServices.get_contact(token_obj.LocationId, contact_id)
+                if contact_data:
+                    ContactServices.save_contact(contact_data)
+                contact_data["id"] = contact_id
+        ContactServices.save_contact(contact_data)
+        return contact_data
+
+    @staticmethod
+    def save_state(order_obj, **changes):
+        order_obj.fulfilment_state = {**order_obj.fulfilment_state, **changes}
+        Order.objects.filter(pk=order_obj.pk).update(fulfilment_state=order_obj.fulfilment_state)
+
+    @staticmethod
+    def process(event, order_obj) -> bool:
+        """
+        Run (or resume) the fulfilment of `order_obj`. Returns True once every step is done;
+        raises FulfilmentError when a step failed, with the finished steps saved for the retry.
+        """
+        Status = OrderFulfilment.Status
+        state = order_obj.fulfilment_state or {}
+        if state.get("status") == Status.COMPLETED:
+            print(f"Order {order_obj.id} is already fulfilled, skipping")
+            return True
+
+        done = {name: step["result"] for name, step in state.get("steps", {}).items()}
+        if done:
+            print(f"Resuming fulfilment of order {order_obj.id} after: {', '.join(done)}")
+        steps = dict(state.get("steps", {}))
+        OrderFulfilment.save_state(
+            order_obj, status=Status.IN_PROGRESS, attempts=state.get("attempts", 0) + 1, error=None, steps=steps,
+        )
+
+        def on_done(name, result):
+            if name in OrderFulfilment.STATE_STEPS:
+                steps[name] = {"at": now().isoformat(), "result": result}
+                OrderFulfilment.save_state(order_obj, steps=steps)
+
+        graph = StepGraph(OrderFulfilment.steps(event, order_obj))
+        start = time.perf_counter()
+        try:
+            graph.run(done=done, on_done=on_done)
+        except FulfilmentError as e:
+            print(f"ERROR fulfilling order {order_obj.id}: {e}")
+            OrderFulfilment.save_state(order_obj, status=Status.FAILED, error=str(e))
+            raise
+        finally:
+            timings = ", ".join(f"{name} {ms:.0f}ms" for name, ms in graph.timings.items())
+            print(f"⏱️ Order {order_obj.id} fulfilment took {(time.perf_counter() - start) * 1000:.0f}ms ({timings})")
+
+        OrderFulfilment.save_state(order_obj, status=Status.COMPLETED)
+        return True
@@ -0,0 +1,124 @@
+# idempotency.py
+import hashlib
+import json
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.utils.timezone import now
+from rest_framework import status
+from rest_framework.response import Response
+
+from .models import IdempotencyKey
+
+MAX_KEY_LENGTH = 255
+
+
+class IdempotencyKeys:
+    """
+    `Idempotency-Key` support for submit-order.
+
+    The first request with a key claims a row (no response yet) and runs;
+    its response is stored once an order exists. Repeats with the same key
+    and payload get the stored response back without touching NotaryDash,
+    Stripe or the order tables. Responses that did not create an order
+    (validation / upstream errors) release the key so the client can retry.
+
+    A claim is a lease of IDEMPOTENCY_KEY_LEASE seconds: when the worker
+    holding it dies before storing a response, the next request with the
+    key takes the row over once the lease is up instead of getting 409s
+    until the key expires.
+
+    Keys are scoped per company and user and expire after
+    IDEMPOTENCY_KEY_TTL seconds (purged by tasks.purge_idempotency_keys).
+    """
+
+    @staticmethod
+    def fingerprint(data) -> str:
+        body = json.dumps(data, sort_keys=True, separators=(",", ":"), default=str)
+        return hashlib.sha256(body.encode()).hexdigest()
+
+    @staticmethod
+    def expires_before():
+        return now() - timedelta(seconds=settings.IDEMPOTENCY_KEY_TTL)
+
+    @staticmethod
+    def lease_until():
+        return now() + timedelta(seconds=settings.IDEMPOTENCY_KEY_LEASE)
+
+    @staticmethod
+    def claim(scope, key, fingerprint):
+        """
+        Returns (record, None) when this request owns the key, or
+        (None, response) to send back as is.
+        """
+        if len(key) > MAX_KEY_LENGTH:
+            return None, Response(
+                {"error": f"Idempotency-Key must be at most {MAX_KEY_LENGTH} characters."},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+
+        # An expired key is free to be reused
+        IdempotencyKey.objects.filter(scope=scope, key=key, created_at__lt=IdempotencyKeys.expires_before()).delete()
+        try:
+            with transaction.atomic():
+                record = IdempotencyKey.objects.create(
+                    scope=scope, key=key, fingerprint=fingerprint, locked_until=IdempotencyKeys.lease_until(),
+                )
+                return record, None
+        except IntegrityError:
+            pass
+
+        record = IdempotencyKey.objects.filter(scope=scope, key=key).first()
+        if record is None:
+            # Released by the first request in the meantime
+            return None, Response(
+                {"error": "A request with this Idempotency-Key just failed, retry it."},
+                status=status.HTTP_409_CONFLICT, headers={"Retry-After": "1"},
+            )
+        if record.fingerprint != fingerprint:
+            return None, Response(
+                {"error": "Idempotency-Key was already used with a different request body."},
+                status=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            )
+        if record.status_code is None and record.locked_until and record.locked_until < now():
+            # The request that claimed the key died without an answer; only one retry gets the row
+            lease = IdempotencyKeys.lease_until()
+            taken = IdempotencyKey.objects.filter(
+                pk=record.pk, status_code__isnull=True, locked_until=record.locked_until,
+            ).update(locked_until=lease)
+            if taken:
+                print(f"♻️ Taking over abandoned Idempotency-Key {key}")
+                record.locked_until = lease
+                return record, None
+        if record.status_code is None:
+            return None, Response(
+                {"error": "A request with this Idempotency-Key is still being processed."},
+                status=status.HTTP_409_CONFLICT, headers={"Retry-After": "1"},
+            )
+
+        print(f"🔁 Replaying stored response for Idempotency-Key {key}")
+        return None, Response(
+            record.response_body, status=record.status_code, headers={"Idempotent-Replayed": "true"}
+        )
+
+    @staticmethod
+    def complete(record: IdempotencyKey, response):
+        """Store the response when it created an order, otherwise release the key."""
+        data = response.data if isinstance(response.data, dict) else {}
+        if response.status_code >= 500 or not data.get("order_id"):
+            IdempotencyKeys.release(record)
+            return
+        # Only while we still hold the lease, a retry may have taken the key over
+        IdempotencyKey.objects.filter(pk=record.pk, locked_until=record.locked_until).update(
+            status_code=response.status_code, response_body=data,
+        )
+
+    @staticmethod
+    def release(record: IdempotencyKey):
+        IdempotencyKey.objects.filter(pk=record.pk, locked_until=record.locked_until).delete()
+
+    @staticmethod
+    def purge() -> int:
+        deleted, _ = IdempotencyKey.objects.filter(created_at__lt=IdempotencyKeys.expires_before()).delete()
+        return deleted
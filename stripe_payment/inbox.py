@@ -0,0 +1,181 @@
+# inbox.py
+import traceback
+from datetime import timedelta
+
+import stripe
+from django.conf import settings
+from django.db import connection
+from django.db.models import F, Q
+from django.utils.timezone import now
+
+from core.breaker import UpstreamUnavailable
+
+from . import webhooks
+from .models import StripeWebhookEventLog
+from .webhooks import handler_for
+
+Status = StripeWebhookEventLog.Status
+
+
+class WebhookInbox:
+    """
+    Processes Stripe events stored by stripe_webhook.
+
+    A worker claims an event with a single conditional UPDATE (pending and
+    due, or processing with an expired lock), so two workers never run the
+    same event. Handler exceptions put the event back to pending with an
+    exponential backoff until the handler's max_attempts; a handler returning
+    an error message fails the event for good (e.g. an expired checkout).
+    An upstream that is unavailable (circuit breaker open) defers the event
+    until it is due back, without using up an attempt.
+    Handlers and their policies are registered in webhooks.py.
+    """
+
+    @staticmethod
+    def receive(**fields) -> bool:
+        """
+        Store a new event as pending with one INSERT ... ON CONFLICT (event_id) DO NOTHING.
+        Returns False when the event was already received, without a separate SELECT,
+        so concurrent deliveries of one event cannot both get through.
+        """
+        evt_log = StripeWebhookEventLog(**fields)
+        meta = StripeWebhookEventLog._meta
+        qn = connection.ops.quote_name
+
+        columns, params = [], []
+        for field in meta.concrete_fields:
+            columns.append(qn(field.column))
+            params.append(field.get_db_prep_save(field.pre_save(evt_log, add=True), connection))
+
+        sql = (
+            f"INSERT INTO {qn(meta.db_table)} ({', '.join(columns)}) "
+            f"VALUES ({', '.join(['%s'] * len(columns))}) "
+            f"ON CONFLICT ({qn(meta.pk.column)}) DO NOTHING RETURNING {qn(meta.pk.column)}"
+        )
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+            return cursor.fetchone() is not None
+
+    @staticmethod
+    def claimable():
+        current = now()
+        due = Q(status=Status.PENDING) & (Q(next_attempt_at__isnull=True) | Q(next_attempt_at__lte=current))
+        abandoned = Q(status=Status.PROCESSING, locked_until__lt=current)
+        return StripeWebhookEventLog.objects.filter(due | abandoned)
+
+    @staticmethod
+    def claim(event_id, handler) -> bool:
+        claimed = WebhookInbox.claimable().filter(event_id=event_id).update(
+            status=Status.PROCESSING,
+            attempts=F("attempts") + 1,
+            locked_until=now() + timedelta(seconds=handler.lock_timeout),
+        )
+        return bool(claimed)
+
+    @staticmethod
+    def dispatch(event_id, event_type):
+        """Hand a stored event to its handler: inline, on its Celery queue, or straight to processed."""
+        from .tasks import process_webhook_event
+
+        handler = handler_for(event_type)
+        if handler is None:
+            print(f"⚠️ Unhandled event type: {event_type}")
+            StripeWebhookEventLog.objects.filter(event_id=event_id, status=Status.PENDING).update(
+                status=Status.PROCESSED, processed=True, error_message="No handler"
+            )
+            return
+        if not handler.run_async:
+            WebhookInbox.process(event_id, event_type)
+            return
+        try:
+            process_webhook_event.apply_async(
+                (event_id, event_type), queue=handler.queue, soft_time_limit=handler.timeout,
+            )
+        except Exception as e:
+            # The inbox sweep picks the event up once the broker is back
+            print(f"⚠️ Could not queue webhook event {event_id}: {e}")
+
+    @staticmethod
+    def process(event_id, event_type):
+        """Claim and handle one event; returns its new status, or None if another worker has it."""
+        handler = handler_for(event_type)
+        if handler is None or not WebhookInbox.claim(event_id, handler):
+            print(f"⚠️ Webhook event {event_id} is not claimable, skipping")
+            return None
+
+        evt_log = StripeWebhookEventLog.objects.get(event_id=event_id)
+        if evt_log.attempts > handler.max_attempts:
+            # Claimed again after its lock expired, too many times
+            return WebhookInbox.retry_later(evt_log, handler, evt_log.error_message or "Worker lost the event")
+        event = stripe.Event.construct_from(evt_log.json_body, stripe.api_key)
+        try:
+            error = webhooks.dispatch(event)
+        except Exception as e:
+            unavailable = e if isinstance(e, UpstreamUnavailable) else getattr(e, "error", None)
+            if isinstance(unavailable, UpstreamUnavailable):
+                return WebhookInbox.defer(evt_log, unavailable)
+            traceback.print_exc()
+            return WebhookInbox.retry_later(evt_log, handler, str(e))
+
+        evt_log.status = Status.FAILED if error else Status.PROCESSED
+        evt_log.error_message = error or "No errors"
+        evt_log.processed = True
+        evt_log.locked_until = None
+        evt_log.save(update_fields=["status", "error_message", "processed", "locked_until"])
+        print(f"✅ Webhook event {event_id} {evt_log.status}")
+        return evt_log.status
+
+    @staticmethod
+    def retry_later(evt_log, handler, error):
+        if evt_log.attempts >= handler.max_attempts:
+            evt_log.status = Status.FAILED
+            evt_log.processed = True
+            print(f"❌ Webhook event {evt_log.event_id} failed after {evt_log.attempts} attempts: {error}")
+        else:
+            evt_log.status = Status.PENDING
+            delay = min(30 * 2 ** (evt_log.attempts - 1), 60 * 60)
+            evt_log.next_attempt_at = now() + timedelta(seconds=delay)
+            print(f"⚠️ Webhook event {evt_log.event_id} attempt {evt_log.attempts} failed, retrying in {delay}s: {error}")
+        evt_log.error_message = error
+        evt_log.locked_until = None
+        evt_log.save(update_fields=["status", "processed", "next_attempt_at", "error_message", "locked_until"])
+        return evt_log.status
+
+    @staticmethod
+    def defer(evt_log, unavailable):
+        evt_log.status = Status.PENDING
+        evt_log.attempts -= 1
+        evt_log.next_attempt_at = now() + timedelta(seconds=max(unavailable.retry_after, 5))
+        evt_log.error_message = str(unavailable)
+        evt_log.locked_until = None
+        evt_log.save(update_fields=["status", "attempts", "next_attempt_at", "error_message", "locked_until"])
+        print(f"⚠️ Webhook event {evt_log.event_id} deferred: {unavailable}")
+        return evt_log.status
+
+    @staticmethod
+    def sweepable():
+        """
+        Events nobody is going to pick up: retries that are due, expired locks
+        (crashed workers) and new events still pending after WEBHOOK_SWEEP_GRACE
+        seconds (lost enqueue). Newer pending events are most likely just
+        waiting in a backed up queue, dispatching them again would only add
+        duplicates to it.
+        """
+        current = now()
+        retry_due = Q(status=Status.PENDING, next_attempt_at__lte=current)
+        abandoned = Q(status=Status.PROCESSING, locked_until__lt=current)
+        lost = Q(
+            status=Status.PENDING, next_attempt_at__isnull=True,
+            created_at__lt=current - timedelta(seconds=settings.WEBHOOK_SWEEP_GRACE),
+        )
+        return StripeWebhookEventLog.objects.filter(retry_due | abandoned | lost)
+
+    @staticmethod
+    def sweep(limit=100) -> int:
+        """Dispatch due and abandoned events (missed enqueues, retries, crashed workers) again."""
+        events = list(
+            WebhookInbox.sweepable().order_by("created_at").values_list("event_id", "event_type")[:limit]
+        )
+        for event_id, event_type in events:
+            WebhookInbox.dispatch(event_id, event_type)
+        return len(events)
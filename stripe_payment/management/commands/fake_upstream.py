@@ -0,0 +1,202 @@
+import itertools
+import json
+import random
+import re
+import signal
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+
+from django.core.management.base import BaseCommand
+
+
+_ids = itertools.count(1000)
+
+
+def _next_id(prefix=""):
+    return f"{prefix}{next(_ids)}"
+
+
+# ----------------------------------------------------------------------
+# Canned responses: (method, path regex) -> handler(match, body) -> (status, json)
+# Only the fields the webhook / order pipeline reads are filled in.
+# ----------------------------------------------------------------------
+def ghl_token(match, body):
+    return 200, {
+        "access_token": _next_id("fake-access-"), "refresh_token": _next_id("fake-refresh-"),
+        "token_type": "Bearer", "expires_in": 86399, "scope": "", "userType": "Location",
+        "companyId": "fake-company", "locationId": "fake-location", "userId": "fake-user",
+    }
+
+
+def ghl_contact_search(match, body):
+    return 200, {"contacts": [], "total": 0}
+
+
+def _contact(body, contact_id):
+    stamp = "2024-01-01T00:00:00.000Z"
+    return {**body, "id": contact_id, "dateAdded": stamp, "dateUpdated": stamp}
+
+
+def ghl_contact_create(match, body):
+    return 201, {"contact": _contact(body, _next_id("contact_"))}
+
+
+def ghl_contact(match, body):
+    return 200, {"contact": _contact(body, match["id"])}
+
+
+def ghl_invoice_create(match, body):
+    return 201, {**body, "_id": _next_id("inv_"), "altId": body.get("altId", "fake-location")}
+
+
+def ghl_invoice(match, body):
+    return 200, {"_id": match["id"], "altId": "fake-location", "status": "sent"}
+
+
+def notary_user(match, body):
+    return 200, {"data": {
+        "id": int(match["user"]), "email": f"user{match['user']}@example.com",
+        "first_name": "Fake", "last_name": "User", "attr": {"phone": f"555555{int(match['user']) % 10000:04d}"},
+    }}
+
+
+def notary_order_create(match, body):
+    order_id = next(_ids)
+    return 201, {"data": {"id": order_id, "order_id": order_id}}
+
+
+def notary_list(match, body):
+    return 200, {"data": [], "links": {"next": None}}
+
+
+def notary_object(match, body):
+    return 200, {"data": {**body, "id": next(_ids)}}
+
+
+def stripe_payment_intent(match, body):
+    status = "succeeded" if match["action"] == "capture" else "requires_capture"
+    return 200, {"id": match["id"], "object": "payment_intent", "status": status, "metadata": {}}
+
+
+def stripe_session_expire(match, body):
+    return 200, {"id": match["id"], "object": "checkout.session", "status": "expired"}
+
+
+def stripe_object(match, body):
+    return 200, {"id": match["id"] or _next_id("obj_"), "object": match["resource"].rstrip("s")}
+
+
+ROUTES = [
+    ("POST", r"/oauth/token", ghl_token),
+    ("POST", r"/contacts/search", ghl_contact_search),
+    ("POST", r"/contacts/?", ghl_contact_create),
+    ("GET|PUT", r"/contacts/(?P<id>[^/]+)", ghl_contact),
+    ("POST", r"/invoices/?", ghl_invoice_create),
+    ("GET|POST", r"/invoices/(?P<id>[^/]+)(/send|/record-payment)?", ghl_invoice),
+    ("GET", r"/api/v2/clients/(?P<client>[^/]+)/users/(?P<user>\d+)", notary_user),
+    ("POST", r"/api/v2/orders", notary_order_create),
+    ("GET", r"/api/v2/.*", notary_list),
+    ("POST", r"/api/v2/.*", notary_object),
+    ("GET|POST", r"/v1/payment_intents/(?P<id>[^/]+)(/(?P<action>capture|cancel))?", stripe_payment_intent),
+    ("POST", r"/v1/checkout/sessions/(?P<id>[^/]+)/expire", stripe_session_expire),
+    ("GET|POST", r"/v1/(?P<resource>[a-z_]+)(/(?P<id>[^/]+))?(/.*)?", stripe_object),
+]
+ROUTES = [(method.split("|"), re.compile(pattern + "$"), handler) for method, pattern, handler in ROUTES]
+
+
+class Command(BaseCommand):
+    help = (
+        "Run a local stand-in for the Stripe, GHL and NotaryDash APIs. Point "
+        "STRIPE_API_BASE, GHL_BASE_URL and NOTARY_BASE_URL at it to replay webhooks "
+        "or load test the order pipeline without touching the real services."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--host", default="127.0.0.1")
+        parser.add_argument("--port", type=int, default=8765)
+        parser.add_argument(
+            "--latency", type=float, default=0,
+            help="Milliseconds to wait before every response, to mimic the real APIs."
+        )
+        parser.add_argument(
+            "--jitter", type=float, default=0,
+            help="Random extra latency of up to this many milliseconds."
+        )
+        parser.add_argument(
+            "--error-rate", type=float, default=0,
+            help="Share of requests (0-1) answered with a random 429 or 500."
+        )
+
+    def handle(self, *args, **options):
+        stats = Counter()
+        lock = threading.Lock()
+        latency, jitter, error_rate = options["latency"], options["jitter"], options["error_rate"]
+
+        class Handler(BaseHTTPRequestHandler):
+            # Keep-alive, like the real APIs
+            protocol_version = "HTTP/1.1"
+            disable_nagle_algorithm = True
+
+            def _respond(self):
+                path = urlparse(self.path).path
+                length = int(self.headers.get("Content-Length") or 0)
+                raw = self.rfile.read(length) if length else b""
+                try:
+                    body = json.loads(raw) if raw else {}
+                except ValueError:
+                    # Stripe and the OAuth token endpoint send form data
+                    body = {}
+                if not isinstance(body, dict):
+                    body = {}
+
+                if latency or jitter:
+                    time.sleep((latency + random.uniform(0, jitter)) / 1000)
+
+                status, payload = 404, {"error": f"No fake route for {self.command} {path}"}
+                for methods, pattern, handler in ROUTES:
+                    match = pattern.match(path)
+                    if self.command in methods and match:
+                        status, payload = handler(match.groupdict(), body)
+                        break
+                if status < 400 and error_rate and random.random() < error_rate:
+                    status = random.choice((429, 500))
+                    payload = {"error": {"message": "Injected failure", "type": "api_error"}}
+
+                with lock:
+                    stats[(self.command, re.sub(r"/(?!v\d+(/|$))[^/]*\d[^/]*", "/:id", path), status)] += 1
+
+                data = json.dumps(payload).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                if status == 429:
+                    self.send_header("Retry-After", "1")
+                self.end_headers()
+                self.wfile.write(data)
+
+            do_GET = do_POST = do_PUT = do_DELETE = _respond
+
+            def log_message(self, format, *args):
+                pass
+
+        # Room for a whole connection pool connecting at once (core.http.AsyncUpstreamClient)
+        ThreadingHTTPServer.request_queue_size = 128
+        server = ThreadingHTTPServer((options["host"], options["port"]), Handler)
+        base = f"http://{options['host']}:{options['port']}"
+        self.stdout.write(self.style.SUCCESS(f"✅ Fake upstream listening on {base}"))
+        self.stdout.write(f"   STRIPE_API_BASE={base} GHL_BASE_URL={base} NOTARY_BASE_URL={base}")
+        # Print the request counts on Ctrl+C and on a plain kill alike
+        signal.signal(signal.SIGTERM, signal.default_int_handler)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+
+        self.stdout.write(self.style.MIGRATE_HEADING(f"\n{'method':<7} {'path':<50} {'status':>6} {'count':>7}"))
+        for (method, path, status), count in sorted(stats.items()):
+            self.stdout.write(f"{method:<7} {path:<50} {status:>6} {count:>7}")
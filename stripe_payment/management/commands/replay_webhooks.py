@@ -0,0 +1,226 @@
+import json
+import queue
+import statistics
+import threading
+import time
+from collections import defaultdict
+
+import stripe
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections, transaction
+from django.utils.dateparse import parse_datetime
+from django.utils.timezone import now
+
+from stripe_payment import webhooks
+from stripe_payment.inbox import WebhookInbox
+from stripe_payment.models import StripeWebhookEventLog
+
+Status = StripeWebhookEventLog.Status
+
+
+class _Rollback(Exception):
+    pass
+
+
+class Command(BaseCommand):
+    help = (
+        "Re-run stored Stripe webhook events, or events from a JSONL file, through the "
+        "handler registry and report throughput and per event type latency. Dry run by "
+        "default: database writes are rolled back and queued (NotaryDash / GHL / Stripe "
+        "calling) handlers are skipped unless --include-async is given."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--file",
+            help="JSONL file with one Stripe event (or a {'json_body': event} row) per line, "
+                 "instead of the stored events."
+        )
+        parser.add_argument(
+            "--status", action="append", choices=Status.values,
+            help="Stored events with this status (repeatable, default: failed)."
+        )
+        parser.add_argument("--event-type", action="append", help="Only this event type (repeatable).")
+        parser.add_argument("--event-id", action="append", help="Only this event id (repeatable).")
+        parser.add_argument("--since", help="Only events received at or after this ISO datetime.")
+        parser.add_argument("--limit", type=int, help="At most this many events.")
+        parser.add_argument("--concurrency", type=int, default=4, help="Worker threads (default: 4).")
+        parser.add_argument(
+            "--live", action="store_true",
+            help="Process for real through WebhookInbox: stored events are reset to pending, "
+                 "file events are received first, and the results are kept."
+        )
+        parser.add_argument(
+            "--include-async", action="store_true",
+            help="Also run queued handlers in a dry run. They call the upstream APIs, so point "
+                 "STRIPE_API_BASE / GHL_BASE_URL / NOTARY_BASE_URL at fake_upstream first."
+        )
+
+    def handle(self, *args, **options):
+        if options["concurrency"] < 1:
+            raise CommandError("❌ --concurrency must be at least 1")
+        self.live = options["live"]
+        self.include_async = options["include_async"]
+
+        events = self._load_file(options) if options["file"] else self._load_stored(options)
+        if options["limit"]:
+            events = events[:options["limit"]]
+        if not events:
+            self.stdout.write("Nothing to replay.")
+            return
+
+        mode = "live" if self.live else "dry run"
+        self.stdout.write(f"Replaying {len(events)} events ({mode}, concurrency {options['concurrency']})")
+
+        work = queue.Queue()
+        for event in events:
+            work.put(event)
+        self.results = defaultdict(lambda: defaultdict(int))
+        self.timings = defaultdict(list)
+        self.lock = threading.Lock()
+
+        start = time.perf_counter()
+        threads = [threading.Thread(target=self._worker, args=(work,)) for _ in range(options["concurrency"])]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+
+        self._report(len(events), elapsed)
+
+    # ------------------------------------------------------------------
+    # Sources
+    # ------------------------------------------------------------------
+    def _load_stored(self, options):
+        rows = StripeWebhookEventLog.objects.filter(status__in=options["status"] or [Status.FAILED])
+        if options["event_type"]:
+            rows = rows.filter(event_type__in=options["event_type"])
+        if options["event_id"]:
+            rows = rows.filter(event_id__in=options["event_id"])
+        if options["since"]:
+            since = parse_datetime(options["since"])
+            if since is None:
+                raise CommandError(f"❌ Invalid --since datetime: {options['since']}")
+            rows = rows.filter(created_at__gte=since)
+
+        events = []
+        for event_id, body in rows.order_by("created_at").values_list("event_id", "json_body").iterator():
+            if not body:
+                self.stderr.write(f"⚠️ {event_id} has no stored json_body, skipping")
+                continue
+            events.append(body)
+        return events
+
+    def _load_file(self, options):
+        events = []
+        try:
+            with open(options["file"]) as f:
+                for number, line in enumerate(f, 1):
+                    if not line.strip():
+                        continue
+                    try:
+                        body = json.loads(line)
+                    except ValueError as e:
+                        raise CommandError(f"❌ {options['file']}:{number}: {e}")
+                    body = body.get("json_body", body)
+                    if not isinstance(body, dict) or not body.get("id") or not body.get("type"):
+                        raise CommandError(f"❌ {options['file']}:{number}: not a Stripe event")
+                    events.append(body)
+        except OSError as e:
+            raise CommandError(f"❌ {e}")
+
+        if options["event_type"]:
+            events = [e for e in events if e["type"] in options["event_type"]]
+        if options["event_id"]:
+            events = [e for e in events if e["id"] in options["event_id"]]
+        return events
+
+    # ------------------------------------------------------------------
+    # Workers
+    # ------------------------------------------------------------------
+    def _worker(self, work):
+        try:
+            while True:
+                try:
+                    body = work.get_nowait()
+                except queue.Empty:
+                    return
+                start = time.perf_counter()
+                try:
+                    outcome = self._replay_live(body) if self.live else self._replay_dry(body)
+                except Exception as e:
+                    outcome = f"error: {type(e).__name__}"
+                    self.stderr.write(f"❌ {body['id']} ({body['type']}): {e}")
+                ms = (time.perf_counter() - start) * 1000
+                with self.lock:
+                    self.results[body["type"]][outcome] += 1
+                    if outcome in (Status.PROCESSED, Status.FAILED, Status.PENDING):
+                        self.timings[body["type"]].append(ms)
+        finally:
+            # Every thread opened its own connection
+            connections.close_all()
+
+    def _replay_dry(self, body):
+        handler = webhooks.handler_for(body["type"])
+        if handler is None:
+            return "unhandled"
+        if handler.run_async and not self.include_async:
+            return "skipped"
+
+        event = stripe.Event.construct_from(body, stripe.api_key)
+        try:
+            with transaction.atomic():
+                error = webhooks.dispatch(event)
+                raise _Rollback
+        except _Rollback:
+            pass
+        return Status.FAILED if error else Status.PROCESSED
+
+    def _replay_live(self, body):
+        event_id, event_type = body["id"], body["type"]
+        if webhooks.handler_for(event_type) is None:
+            return "unhandled"
+
+        received = WebhookInbox.receive(
+            event_id=event_id, event_type=event_type,
+            event_data=body.get("data", {}).get("object", {}), json_body=body,
+        )
+        if not received:
+            # Already stored: put it back in the queue unless a worker holds it right now
+            StripeWebhookEventLog.objects.exclude(
+                status=Status.PROCESSING, locked_until__gt=now()
+            ).filter(event_id=event_id).update(
+                status=Status.PENDING, attempts=0, next_attempt_at=None, locked_until=None, processed=False,
+            )
+        return WebhookInbox.process(event_id, event_type) or "locked"
+
+    # ------------------------------------------------------------------
+    # Report
+    # ------------------------------------------------------------------
+    def _report(self, total, elapsed):
+        outcomes = sorted({o for counts in self.results.values() for o in counts})
+        self.stdout.write(self.style.MIGRATE_HEADING(
+            f"\n{'event type':<42} " + " ".join(f"{o:>10}" for o in outcomes)
+            + f" {'p50 ms':>8} {'p95 ms':>8} {'max ms':>8}"
+        ))
+        for event_type in sorted(self.results):
+            counts = self.results[event_type]
+            timings = sorted(self.timings[event_type])
+            if timings:
+                p95 = statistics.quantiles(timings, n=20, method="inclusive")[-1] if len(timings) > 1 else timings[0]
+                latency = f" {statistics.median(timings):>8.1f} {p95:>8.1f} {timings[-1]:>8.1f}"
+            else:
+                latency = f" {'-':>8} {'-':>8} {'-':>8}"
+            self.stdout.write(
+                f"{event_type:<42} " + " ".join(f"{counts.get(o, 0):>10}" for o in outcomes) + latency
+            )
+
+        self.stdout.write(
+            f"\n{total} events in {elapsed:.2f}s ({total / elapsed if elapsed else 0:.1f} events/s)"
+        )
+        errors = sum(n for counts in self.results.values() for o, n in counts.items() if o.startswith("error"))
+        if errors:
+            self.stdout.write(self.style.ERROR(f"❌ {errors} events raised"))
+        else:
+            self.stdout.write(self.style.SUCCESS("✅ Replay finished"))
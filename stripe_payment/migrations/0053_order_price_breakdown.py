@@ -0,0 +1,18 @@
+# Generated by Django 5.2.7 on 2026-10-18 07:37
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('stripe_payment', '0052_remove_notaryuser_stripe_customer_id_and_more'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='order',
+            name='price_breakdown',
+            field=models.JSONField(blank=True, null=True),
+        ),
+    ]
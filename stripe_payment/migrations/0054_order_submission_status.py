@@ -0,0 +1,28 @@
+# Generated by Django 5.2.7 on 2026-10-18 07:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('stripe_payment', '0053_order_price_breakdown'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='order',
+            name='submission_result',
+            field=models.JSONField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='order',
+            name='submission_status',
+            field=models.CharField(blank=True, choices=[('pending', 'Pending'), ('processing', 'Processing'), ('ready', 'Ready'), ('failed', 'Failed')], max_length=20, null=True),
+        ),
+        migrations.AddField(
+            model_name='order',
+            name='submission_token',
+            field=models.CharField(blank=True, max_length=64, null=True, unique=True),
+        ),
+    ]
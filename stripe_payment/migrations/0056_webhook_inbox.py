@@ -0,0 +1,44 @@
+# Generated by Django 5.2.7 on 2026-10-18 07:43
+
+from django.db import migrations, models
+
+
+def mark_existing_processed(apps, schema_editor):
+    # Events logged before the inbox were handled inside the webhook request
+    StripeWebhookEventLog = apps.get_model('stripe_payment', 'StripeWebhookEventLog')
+    StripeWebhookEventLog.objects.update(status='processed')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('stripe_payment', '0055_idempotencykey'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='stripewebhookeventlog',
+            name='attempts',
+            field=models.PositiveSmallIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='stripewebhookeventlog',
+            name='locked_until',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='stripewebhookeventlog',
+            name='next_attempt_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='stripewebhookeventlog',
+            name='status',
+            field=models.CharField(choices=[('pending', 'Pending'), ('processing', 'Processing'), ('processed', 'Processed'), ('failed', 'Failed')], default='pending', max_length=20),
+        ),
+        migrations.AddIndex(
+            model_name='stripewebhookeventlog',
+            index=models.Index(fields=['status', 'next_attempt_at'], name='stripe_paym_status_257897_idx'),
+        ),
+        migrations.RunPython(mark_existing_processed, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.7 on 2026-10-18 07:44
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('stripe_payment', '0056_webhook_inbox'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='stripecharge',
+            name='event_created',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,43 @@
+# Generated by Django 5.2.7 on 2026-10-18 07:47
+
+import json
+
+from django.db import migrations, models
+
+
+def decode_event_data(apps, schema_editor):
+    # event_data used to be stored as a json.dumps() string inside the JSONField
+    StripeWebhookEventLog = apps.get_model('stripe_payment', 'StripeWebhookEventLog')
+    for evt_log in StripeWebhookEventLog.objects.only('event_id', 'event_data').iterator():
+        if isinstance(evt_log.event_data, str):
+            try:
+                evt_log.event_data = json.loads(evt_log.event_data)
+            except ValueError:
+                continue
+            evt_log.save(update_fields=['event_data'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('stripe_payment', '0057_stripecharge_event_created'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='order',
+            name='paid_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='stripecharge',
+            name='amount_refunded',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='stripecharge',
+            name='refunded',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.RunPython(decode_event_data, migrations.RunPython.noop),
+    ]
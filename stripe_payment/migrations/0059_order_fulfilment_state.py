@@ -0,0 +1,18 @@
+# Generated by Django 5.2.7 on 2026-10-18 07:56
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('stripe_payment', '0058_charge_refunds_order_paid_at'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='order',
+            name='fulfilment_state',
+            field=models.JSONField(blank=True, default=dict),
+        ),
+    ]
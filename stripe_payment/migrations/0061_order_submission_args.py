@@ -0,0 +1,23 @@
+# Generated by Django 5.2.7 on 2026-10-18 08:21
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('stripe_payment', '0060_idempotencykey_locked_until'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='order',
+            name='submission_args',
+            field=models.JSONField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='order',
+            name='submission_updated_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
@@ -22,6 +22,12 @@ class Order(models.Model):
         ("landline", "Landline"),
     ]
 
+    class SubmissionStatus(models.TextChoices):
+        PENDING = "pending", "Pending"
+        PROCESSING = "processing", "Processing"
+        READY = "ready", "Ready"
+        FAILED = "failed", "Failed"
+
     unit_type = models.CharField(max_length=20, choices=UNIT_TYPE_CHOICES)
     address = models.TextField(null=True, blank=True)
     streetAddress = models.CharField(max_length=255, null=True, blank=True)
@@ -92,6 +98,8 @@ class Order(models.Model):
     # Stripe Relationship
     stripe_session_id = models.CharField(max_length=255, null=True, blank=True)
     stripe_intent_id = models.CharField(max_length=255, null=True, blank=True)
+    # Set by the payment_intent.succeeded webhook
+    paid_at = models.DateTimeField(null=True, blank=True)
     
     location_id = models.CharField(max_length=50, null=True, blank=True)
     
@@ -106,6 +114,8 @@ class Order(models.Model):
     order_protection_price =models.DecimalField(max_digits=10, decimal_places=2, default=Decimal('0.00'), null=True, blank=True)
     discount_percent = models.DecimalField(max_digits=5, decimal_places=2, default=Decimal('0.00'), null=True, blank=True)
     discount_amount = models.DecimalField(max_digits=10, decimal_places=2, default=Decimal('0.00'), null=True, blank=True)
+    # Server side pricing (order_page.pricing.PricingEngine.price_order) of the submitted cart
+    price_breakdown = models.JSONField(null=True, blank=True)
     order_status_emails= models.CharField(max_length=255, null=True, blank=True)
     order_status_emails= models.CharField(max_length=255, null=True, blank=True)
     appointment_confirmed = models.BooleanField(default=False)
@@ -116,9 +126,22 @@ class Order(models.Model):
     contact_last_name_resched = models.CharField(max_length=100, null=True, blank=True)
     contact_phone_resched = models.CharField(max_length=20, null=True, blank=True)
 
+    # Async submission (stripe_payment.submission.OrderSubmission); empty for synchronous submits
+    submission_status = models.CharField(max_length=20, choices=SubmissionStatus.choices, null=True, blank=True)
+    submission_token = models.CharField(max_length=64, unique=True, null=True, blank=True)
+    submission_result = models.JSONField(null=True, blank=True)
+    # payment_method_id / frontend_domain of the submit request, and when submission_status
+    # last changed; OrderSubmission.sweep requeues submissions stuck pending / processing
+    submission_args = models.JSONField(null=True, blank=True)
+    submission_updated_at = models.DateTimeField(null=True, blank=True)
+    # Post-payment fulfilment (stripe_payment.fulfilment.OrderFulfilment): status and the
+    # upstream ids each completed step produced, so a retry resumes instead of starting over
+    fulfilment_state = models.JSONField(default=dict, blank=True)
+
 
     @staticmethod
     def from_api(data, coupon, owner_id, company_name, client_team_id):
+        """Build an unsaved Order; OrderGraphBuilder persists it with its children."""
         postal_code = data.get("postalCode")
         unit_type = data.get("unitType")
         address = data.get("address")
@@ -133,7 +156,7 @@ class Order(models.Model):
         if preferred_datetime is not None and not is_aware(preferred_datetime):
             preferred_datetime = make_aware(preferred_datetime)
             
-        return Order.objects.create(
+        return Order(
             unit_type=unit_type,
             address=address,
             state=data.get("state"),
@@ -215,8 +238,9 @@ class Bundle(models.Model):
 
     @staticmethod
     def from_api(order, data):
+        """Unsaved Bundle for `order`."""
         bundle_price = Decimal(str(data.get("price", 0)))
-        return Bundle.objects.create(
+        return Bundle(
             order=order,
             name=data.get("name"),
             description=data.get("description"),
@@ -242,7 +266,7 @@ class BundleOption(models.Model):
         opt_def = options_map.get(opt_id)
         if opt_def:
             price_add = opt_def.get("priceAdd")
-            return BundleOption.objects.create(
+            return BundleOption(
                 bundle=bundle,
                 name=opt_def.get("label"),
                 value=str(opt_val),
@@ -267,7 +291,7 @@ class BundleModalOption(models.Model):
         field_value = bundle_forms_entry.get(field_name)
         
         if field_value not in [None, ""]:
-            return BundleModalOption.objects.create(
+            return BundleModalOption(
                 bundle=bundle,
                 name=field_label,
                 value=str(field_value),
@@ -294,13 +318,15 @@ class ALaCarteService(models.Model):
     @classmethod
     def from_api(cls, order, recieved_data):
         """
-        Create a service and its related items/options/submenu from API payload.
+        Build services and their related items/options/submenu from API payload.
+        Returns unsaved instances, parents before children.
         """
         a_la_carte_order = recieved_data.get("a_la_carteOrder",[])
         disclosures = recieved_data.get("disclosures", [])
 
+        rows = []
         for data in a_la_carte_order:
-            service = cls.objects.create(
+            service = cls(
                 order=order,
                 service_id=data.get("id"),
                 title=data.get("title"),
@@ -308,11 +334,12 @@ class ALaCarteService(models.Model):
                 form_title=data.get("form", {}).get("title"),
                 form_description=data.get("form", {}).get("description"),
             )
+            rows.append(service)
 
             for item_data in data.get("form", {}).get("items", []):
-                ALaCarteItem.from_api(service, item_data, data.get("form", {}), recieved_data.get("serviceTotals",{}), disclosures)
+                rows.extend(ALaCarteItem.from_api(service, item_data, data.get("form", {}), recieved_data.get("serviceTotals",{}), disclosures))
 
-        return order
+        return rows
 
 
 class ALaCarteItem(models.Model):
@@ -339,9 +366,10 @@ class ALaCarteItem(models.Model):
 
     @classmethod
     def from_api(cls, service, data, form_data=None, service_totals=None, disclosures=None):
+        """Unsaved item followed by its options, submenu, modal options and disclosures."""
         print(f"Service Totals {json.dumps(service_totals.get(service.service_id, {}).get("items",{}).get(data.get("id"),{}), indent=4)}")
         form_options = data.get("options", {})
-        item = cls.objects.create(
+        item = cls(
             service=service,
             item_id=data.get("id"),
             title=data.get("title"),
@@ -353,16 +381,18 @@ class ALaCarteItem(models.Model):
             minimum_required=form_options.get("minimumRequired", 0) if form_options else 0,
         )
 
+        rows = [item]
+
         # Create options if present
         if form_options:
             for opt in form_options.get("items", []):
-                ALaCarteOption.from_api(item, opt)
+                rows.append(ALaCarteOption.from_api(item, opt))
 
         # Create submenu if present (from parent form, not just item)
         if form_data:
             submenu = form_data.get("submenu", {})
             for sub_item in submenu.get("items", []):
-                ALaCarteSubMenuItem.from_api(item, sub_item,form_data)
+                rows.append(ALaCarteSubMenuItem.from_api(item, sub_item,form_data))
 
             # Create modal options if present
             modal_option = form_data.get("modalOption", {})
@@ -374,15 +404,15 @@ class ALaCarteItem(models.Model):
                 if valid_items and data.get("id") not in valid_items:
                     continue
                 
-                ALaCarteItemModalOption.from_api(item, field)
+                rows.append(ALaCarteItemModalOption.from_api(item, field))
 
         # Handle Disclosures
         if disclosures:
             for d_data in disclosures:
                 if d_data.get("itemId") == item.item_id:
-                    ALaCarteItemDisclosure.from_api(item, d_data)
+                    rows.append(ALaCarteItemDisclosure.from_api(item, d_data))
 
-        return item
+        return [row for row in rows if row is not None]
 
 
 class ALaCarteOption(models.Model):
@@ -397,7 +427,7 @@ class ALaCarteOption(models.Model):
 
     @classmethod
     def from_api(cls, item, data):
-        return cls.objects.create(
+        return cls(
             item=item,
             option_id=data.get("id"),
             label=data.get("label"),
@@ -423,7 +453,7 @@ class ALaCarteSubMenuItem(models.Model):
     def from_api(cls, item, data,form_data=None):
         if data.get("type") == "radio" and bool(data.get("value"))==False:
             return None
-        return cls.objects.create(
+        return cls(
             item=item,
             submenu_item_id=data.get("id"),
             label=data.get("label"),
@@ -443,7 +473,7 @@ class ALaCarteItemModalOption(models.Model):
 
     @classmethod
     def from_api(cls, item, data):
-        return cls.objects.create(
+        return cls(
             item=item,
             name=data.get("label"),
             value=str(data.get("value")),
@@ -461,7 +491,7 @@ class ALaCarteItemDisclosure(models.Model):
     @classmethod
     def from_api(cls, item, disclosure_data):
         if disclosure_data.get("value") is True:
-             return cls.objects.create(
+             return cls(
                 item=item,
                 name=disclosure_data.get("name"),
                 value=disclosure_data.get("value")
@@ -486,6 +516,8 @@ class StripeCharge(models.Model):
     charge_id = models.CharField(max_length=100, unique=True)
     payment_intent_id = models.CharField(max_length=100, null=True, blank=True)
     amount = models.IntegerField()
+    amount_refunded = models.IntegerField(default=0)
+    refunded = models.BooleanField(default=False)
     currency = models.CharField(max_length=10)
     paid = models.BooleanField(default=False)
     status = models.CharField(max_length=50)
@@ -501,12 +533,25 @@ class StripeCharge(models.Model):
     network_transaction_id = models.CharField(max_length=100, null=True, blank=True)
     created = models.DateTimeField()
     livemode = models.BooleanField(default=False)
+    # `created` of the newest Stripe event applied to this row
+    event_created = models.DateTimeField(null=True, blank=True)
 
     def __str__(self):
         return self.charge_id
 
 
 class StripeWebhookEventLog(models.Model):
+    """
+    Inbox of received Stripe events. stripe_webhook stores the verified event
+    (json_body) as pending and returns; stripe_payment.inbox.WebhookInbox
+    processes it in a Celery worker.
+    """
+    class Status(models.TextChoices):
+        PENDING = "pending", "Pending"
+        PROCESSING = "processing", "Processing"
+        PROCESSED = "processed", "Processed"
+        FAILED = "failed", "Failed"
+
     event_id = models.CharField(max_length=100, primary_key=True)
     event_type = models.CharField(max_length=50)
     event_data = models.JSONField()
@@ -515,9 +560,34 @@ class StripeWebhookEventLog(models.Model):
     error_message = models.TextField(null=True, blank=True)
     json_body = models.JSONField(null=True, blank=True)
 
+    status = models.CharField(max_length=20, choices=Status.choices, default=Status.PENDING)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    # A worker owns a processing event until then; after it the event counts as abandoned
+    locked_until = models.DateTimeField(null=True, blank=True)
+    next_attempt_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [models.Index(fields=["status", "next_attempt_at"])]
+
     def __str__(self):
         return f"{self.event_type} - {self.event_id}"
 
+class IdempotencyKey(models.Model):
+    """Idempotency-Key of a submit-order request and the response it produced (see idempotency.py)."""
+    scope = models.CharField(max_length=100)   # "<company_id>:<user_id>"
+    key = models.CharField(max_length=255)
+    fingerprint = models.CharField(max_length=64)   # sha256 of the request body
+    status_code = models.PositiveSmallIntegerField(null=True, blank=True)   # None while in flight
+    response_body = models.JSONField(null=True, blank=True)
+    locked_until = models.DateTimeField(null=True, blank=True)   # claim lease, taken over once past
+    created_at = models.DateTimeField(auto_now_add=True, db_index=True)
+
+    class Meta:
+        unique_together = ("scope", "key")
+
+    def __str__(self):
+        return f"{self.scope} {self.key}"
+
 class CheckoutSession(models.Model):
     session_id = models.CharField(max_length=100, primary_key=True)
     payment_intent = models.CharField(max_length=100, null=True, blank=True)
@@ -0,0 +1,116 @@
+# order_graph.py
+from collections import defaultdict
+from decimal import Decimal
+
+from django.db import transaction
+
+from .models import (
+    Order, Bundle, BundleOption, BundleModalOption,
+    ALaCarteService, ALaCarteItem, ALaCarteOption, ALaCarteSubMenuItem,
+    ALaCarteItemModalOption, ALaCarteItemDisclosure,
+)
+
+
+class OrderGraphBuilder:
+    """
+    Collects an Order and every child row built from the submission payload
+    in memory, then writes them in one transaction: a single INSERT for the
+    order and one bulk_create per child model, whatever the cart size.
+
+    The `from_api` constructors only build unsaved instances; children point
+    at their (unsaved) parents and get their foreign keys once the parents
+    have primary keys.
+    """
+
+    # Parents before children
+    INSERT_ORDER = [
+        Bundle, BundleOption, BundleModalOption,
+        ALaCarteService, ALaCarteItem,
+        ALaCarteOption, ALaCarteSubMenuItem, ALaCarteItemModalOption, ALaCarteItemDisclosure,
+    ]
+
+    def __init__(self, order: Order):
+        self.order = order
+        self.rows = defaultdict(list)
+
+    def add(self, *instances):
+        for instance in instances:
+            if instance is not None:
+                self.rows[type(instance)].append(instance)
+
+    def add_bundles(self, data) -> Decimal:
+        """Queue bundles with their selected options and modal answers; returns their total price."""
+        total_bundle_price = Decimal('0.00')
+        bundle_forms = data.get("bundleForms", {})
+
+        for b in data.get("bundles", []):
+            total_bundle_price += Decimal(str(b.get("price", 0)))
+
+            bundle_instance = Bundle.from_api(self.order, b)
+            self.add(bundle_instance)
+
+            # Handle Bundle Options
+            selected_options = b.get("selectedOptions", {})
+            options_def = b.get("options", {}).get("items", [])
+            # Create a map for easy lookup of option definitions by ID
+            options_map = {item["id"]: item for item in options_def}
+
+            for opt_id, opt_val in selected_options.items():
+                self.add(BundleOption.from_api(bundle_instance, opt_id, opt_val, options_map))
+
+            # Handle Bundle Modal Options
+            modal_form = b.get("modalForm")
+            # Get the form data for this specific bundle from bundleForms
+            bundle_forms_entry = bundle_forms.get(b.get("name"))
+
+            if modal_form and bundle_forms_entry:
+                for field in modal_form.get("fields", []):
+                    self.add(BundleModalOption.from_api(bundle_instance, field, bundle_forms_entry))
+
+        return total_bundle_price
+
+    def add_a_la_carte(self, data):
+        """Queue a la carte services with their items, options, submenus, modal options and disclosures."""
+        self.add(*ALaCarteService.from_api(self.order, data))
+
+    def apply_price_breakdown(self, breakdown):
+        """Overwrite the client supplied prices with the server side breakdown (see order_page.pricing)."""
+        for bundle, priced in zip(self.rows.get(Bundle, []), breakdown["bundles"]):
+            bundle.price = Decimal(priced["price"])
+        for item in self.rows.get(ALaCarteItem, []):
+            priced = breakdown["services"].get(item.service.service_id, {}).get("items", {}).get(item.item_id)
+            if priced:
+                item.price = Decimal(priced["price"])
+
+        protection = Decimal(breakdown["protection"]["total"])
+        self.order.total_price = Decimal(breakdown["total"])
+        self.order.discount_percent = Decimal(breakdown["discount_percent"])
+        self.order.order_protection = protection > 0
+        self.order.order_protection_price = protection
+
+    def price_mismatches(self, breakdown) -> list:
+        """Differences between what the order page sent and the server side breakdown."""
+        mismatches = []
+        expected = {
+            "total_price": Decimal(breakdown["total"]),
+            "discount_percent": Decimal(breakdown["discount_percent"]),
+            "order_protection_price": Decimal(breakdown["protection"]["total"]),
+        }
+        for field, value in expected.items():
+            sent = Decimal(str(getattr(self.order, field) or 0))
+            if sent != value:
+                mismatches.append(f"{field}: sent {sent} expected {value}")
+
+        for item in self.rows.get(ALaCarteItem, []):
+            priced = breakdown["services"].get(item.service.service_id, {}).get("items", {}).get(item.item_id)
+            if priced and Decimal(str(item.price or 0)) != Decimal(priced["price"]):
+                mismatches.append(f"{item.service.service_id}/{item.item_id}: sent {item.price} expected {priced['price']}")
+        return mismatches
+
+    def save(self) -> Order:
+        with transaction.atomic():
+            self.order.save()
+            for model in self.INSERT_ORDER:
+                if self.rows.get(model):
+                    model.objects.bulk_create(self.rows[model])
+        return self.order
@@ -1,40 +1,11 @@
-from core.services import OAuthServices
-import requests
-import json, time
+from core.http import AsyncUpstreamClient, UpstreamClient
+from core.services import OAuthServices, BASE_URL as GHL_BASE_URL, ghl, ghl_async
+import json
+from asgiref.sync import sync_to_async
 from django.conf import settings
 
-def request_with_retry(url, headers, params=None, max_retries=10, delay=5):
-    """
-    Performs GET request with automatic retry on status 429.
-    
-    Args:
-        url (str): Request URL
-        headers (dict): Request headers
-        params (dict): Query params
-        max_retries (int): Max retry attempts
-        delay (int/float): Delay between retries (seconds)
-    """
-    attempt = 0
-
-    while attempt < max_retries:
-        response = requests.get(url, headers=headers, params=params)
-
-        # success
-        if 200 <= response.status_code < 300:
-            return response
-
-        # rate limited → retry
-        if response.status_code == 429:
-            attempt += 1
-            print(f"⚠️ Rate limit hit (429). Retrying in {delay} seconds... [{attempt}/{max_retries}]")
-            time.sleep(delay)
-            continue
-
-        # other error → stop retrying
-        return response
-
-    print("❌ Max retries exceeded for:", url)
-    return None
+notarydash = UpstreamClient("notarydash")
+notarydash_async = AsyncUpstreamClient("notarydash")
 
 class InvoiceServices:
     
@@ -45,8 +16,8 @@ class InvoiceServices:
     @staticmethod
     def post_invoice(location_id, data):
         headers = OAuthServices.get_valid_headers(location_id)
-        url = "https://services.leadconnectorhq.com/invoices/"
-        response = requests.post(url, headers=headers, json=data)
+        url = f"{GHL_BASE_URL}/invoices/"
+        response = ghl.post(url, headers=headers, json=data, rate_key=location_id)
 
         if response.status_code == 201:
             # print(json.dumps(response.json(),indent=4))
@@ -60,8 +31,8 @@ class InvoiceServices:
     def get_invoice(location_id, invoice_id):
         headers = OAuthServices.get_valid_headers(location_id)
         querystring = {"altId":location_id,"altType":"location"}
-        url = f"https://services.leadconnectorhq.com/invoices/{invoice_id}"
-        response = requests.get(url, headers=headers, params=querystring)
+        url = f"{GHL_BASE_URL}/invoices/{invoice_id}"
+        response = ghl.get(url, headers=headers, params=querystring, rate_key=location_id)
 
         if 200 <= response.status_code < 300:
             print(f"✅ Invoice {invoice_id} retrieved successfully.")
@@ -74,8 +45,8 @@ class InvoiceServices:
     @staticmethod
     def send_invoice(location_id, invoice_id, data):
         headers = OAuthServices.get_valid_headers(location_id)
-        url = f"https://services.leadconnectorhq.com/invoices/{invoice_id}/send"
-        response = requests.post(url, headers=headers, json=data)
+        url = f"{GHL_BASE_URL}/invoices/{invoice_id}/send"
+        response = ghl.post(url, headers=headers, json=data, rate_key=location_id)
 
         if 200 <= response.status_code < 300:
             print(f"✅ Invoice {invoice_id} sent successfully.")
@@ -87,8 +58,8 @@ class InvoiceServices:
     @staticmethod
     def record_payment(location_id, invoice_id, data):
         headers = OAuthServices.get_valid_headers(location_id)
-        url = f"https://services.leadconnectorhq.com/invoices/{invoice_id}/record-payment"
-        response = requests.post(url, headers=headers, json=data)
+        url = f"{GHL_BASE_URL}/invoices/{invoice_id}/record-payment"
+        response = ghl.post(url, headers=headers, json=data, rate_key=location_id)
 
         if 200 <= response.status_code < 300:
             print(f"✅ Manual payment for Invoice {invoice_id} processed successfully.")
@@ -97,10 +68,67 @@ class InvoiceServices:
             print(f"❌ Failed to process manual payment for Invoice {invoice_id}: {response.status_code} - {response.text}")
             return None
 
+class AsyncInvoiceServices:
+    """Async counterparts of InvoiceServices on the shared GHL httpx client; see AsyncContactServices."""
+
+    @staticmethod
+    async def post_invoice(location_id, data):
+        headers = await sync_to_async(OAuthServices.get_valid_headers)(location_id)
+        response = await ghl_async.post(
+            f"{GHL_BASE_URL}/invoices/", headers=headers, json=data, rate_key=location_id
+        )
+
+        if response.status_code == 201:
+            return response.json()
+        print(f"❌ Failed to create Invoice: {response.status_code} - {response.text}")
+        return None
+
+    @staticmethod
+    async def get_invoice(location_id, invoice_id):
+        headers = await sync_to_async(OAuthServices.get_valid_headers)(location_id)
+        querystring = {"altId": location_id, "altType": "location"}
+        response = await ghl_async.get(
+            f"{GHL_BASE_URL}/invoices/{invoice_id}", headers=headers, params=querystring, rate_key=location_id
+        )
+
+        if 200 <= response.status_code < 300:
+            print(f"✅ Invoice {invoice_id} retrieved successfully.")
+            return response.json()
+        print(f"❌ Failed to retrieve Invoice {invoice_id}: {response.status_code} - {response.text}")
+        return None
+
+    @staticmethod
+    async def send_invoice(location_id, invoice_id, data):
+        headers = await sync_to_async(OAuthServices.get_valid_headers)(location_id)
+        response = await ghl_async.post(
+            f"{GHL_BASE_URL}/invoices/{invoice_id}/send", headers=headers, json=data, rate_key=location_id
+        )
+
+        if 200 <= response.status_code < 300:
+            print(f"✅ Invoice {invoice_id} sent successfully.")
+            return response.json().get("invoice", {})
+        print(f"❌ Failed to send Invoice {invoice_id}: {response.status_code} - {response.text}")
+        return None
+
+    @staticmethod
+    async def record_payment(location_id, invoice_id, data):
+        headers = await sync_to_async(OAuthServices.get_valid_headers)(location_id)
+        response = await ghl_async.post(
+            f"{GHL_BASE_URL}/invoices/{invoice_id}/record-payment", headers=headers, json=data, rate_key=location_id
+        )
+
+        if 200 <= response.status_code < 300:
+            print(f"✅ Manual payment for Invoice {invoice_id} processed successfully.")
+            return response.json().get("invoice", {})
+        print(f"❌ Failed to process manual payment for Invoice {invoice_id}: {response.status_code} - {response.text}")
+        return None
+
 TEST_BASE_URL = "https://dev.notarydash.com"
 PRODUCTION_BASE_URL = "https://app.notarydash.com"
 BASE_URL=""
-if settings.NOTARY_TEST:
+if settings.NOTARY_BASE_URL:
+    BASE_URL = settings.NOTARY_BASE_URL
+elif settings.NOTARY_TEST:
     BASE_URL = TEST_BASE_URL
 else:
     BASE_URL = PRODUCTION_BASE_URL
@@ -114,7 +142,7 @@ class NotaryDashServices:
         if not url:
             url = f"{BASE_URL}/api/v2/clients"
 
-        response = request_with_retry(url, headers=Notary_header)
+        response = notarydash.get(url, headers=Notary_header)
 
         if response and 200 <= response.status_code < 300:
             print("✅ Clients retrieved successfully.")
@@ -127,7 +155,7 @@ class NotaryDashServices:
     def get_client(id: str):
         url = f"{BASE_URL}/api/v2/clients/{id}"
         
-        response = request_with_retry(url, headers=Notary_header)
+        response = notarydash.get(url, headers=Notary_header)
 
         if response and 200 <= response.status_code < 300:
             print("✅ Client retrieved successfully.")
@@ -141,7 +169,7 @@ class NotaryDashServices:
     def get_client_one_user(client_id, user_id):
         url = f"{BASE_URL}/api/v2/clients/{client_id}/users/{user_id}"
 
-        response = request_with_retry(url, headers=Notary_header)
+        response = notarydash.get(url, headers=Notary_header)
 
         if response and 200 <= response.status_code < 300:
             print(f"✅ Single client user retrieved successfully.")
@@ -157,7 +185,7 @@ class NotaryDashServices:
         if not url:
             url = f"{BASE_URL}/api/v2/clients/{client_id}/users"
 
-        response = request_with_retry(url, headers=Notary_header)
+        response = notarydash.get(url, headers=Notary_header)
 
         if response and 200 <= response.status_code < 300:
             print(f"✅ Client user for client {client_id} retrieved successfully.")
@@ -172,7 +200,7 @@ class NotaryDashServices:
         url = f"{BASE_URL}/api/v2/companies/{company_id}/products"
         params = {"global": is_global}
 
-        response = request_with_retry(url, headers=Notary_header, params=params)
+        response = notarydash.get(url, headers=Notary_header, params=params)
 
         if response and 200 <= response.status_code < 300:
             print(f"✅ Products for company {company_id} retrieved successfully.")
@@ -183,10 +211,17 @@ class NotaryDashServices:
 
     
     @staticmethod
-    def create_order(data):
+    def create_order(data, idempotency_key=None):
+        """
+        idempotency_key: sent as an Idempotency-Key header, and lets a timed out or
+        5xx POST be retried. Derive it from the local record the call is made
+        for (e.g. "order-<pk>-notary-order") so client retries and a resumed
+        fulfilment send the same key and NotaryDash creates the row once.
+        The create_* methods below take it too.
+        """
         url = f"{BASE_URL}/api/v2/orders"
         print("Creating order with data:", json.dumps(data, indent=4))
-        response = requests.post(url, headers=Notary_header, json=data)
+        response = notarydash.post(url, headers=Notary_header, json=data, idempotency_key=idempotency_key)
         if response.status_code >= 200 and response.status_code < 300:
             print("✅ Order created successfully.")
             return response.json()
@@ -195,9 +230,9 @@ class NotaryDashServices:
             return None
         
     @staticmethod
-    def create_products(data):
+    def create_products(data, idempotency_key=None):
         url = f"{BASE_URL}/api/v2/companies/{data.get("client_id")}/products"
-        response = requests.post(url, headers=Notary_header, json=data)
+        response = notarydash.post(url, headers=Notary_header, json=data, idempotency_key=idempotency_key)
         if response.status_code >= 200 and response.status_code < 300:
             print("✅ Products created successfully.")
             return response.json()
@@ -206,9 +241,9 @@ class NotaryDashServices:
             return None
     
     @staticmethod
-    def create_client(data):
+    def create_client(data, idempotency_key=None):
         url = f"{BASE_URL}/api/v2/clients"
-        response = requests.post(url, headers=Notary_header, json=data)
+        response = notarydash.post(url, headers=Notary_header, json=data, idempotency_key=idempotency_key)
         if response.status_code >= 200 and response.status_code < 300:
             print("✅ Client created successfully.")
             return response.json()
@@ -217,7 +252,7 @@ class NotaryDashServices:
             return None
 
     @staticmethod
-    def create_client_user(client_id: str, user_data: dict):
+    def create_client_user(client_id: str, user_data: dict, idempotency_key=None):
         """
         Create a new user under a specific client.
         
@@ -250,11 +285,102 @@ class NotaryDashServices:
             "Accept": "application/json",
         }
 
-        response = requests.post(url, headers=headers, json=user_data)
+        response = notarydash.post(url, headers=headers, json=user_data, idempotency_key=idempotency_key)
 
         if 200 <= response.status_code < 300:
             print("✅ Client user created successfully.")
             return response.json()
         else:
             print(f"❌ Failed to create client user: {response.status_code} - {response.text}")
-            return None
\ No newline at end of file
+            return None
+
+
+class AsyncNotaryDashServices:
+    """
+    Async counterparts of NotaryDashServices on one shared httpx client per
+    event loop. Fan out from sync code with core.http.gather(), e.g. the users
+    of every client company in pull_notary_users.
+    """
+
+    @staticmethod
+    async def _get(url, what, params=None):
+        response = await notarydash_async.get(url, headers=Notary_header, params=params)
+
+        if 200 <= response.status_code < 300:
+            print(f"✅ {what} retrieved successfully.")
+            return response.json()
+
+        print(f"❌ Failed to retrieve {what}: {response.status_code}")
+        return None
+
+    @staticmethod
+    async def _post(url, what, data, headers=Notary_header, idempotency_key=None):
+        response = await notarydash_async.post(url, headers=headers, json=data, idempotency_key=idempotency_key)
+
+        if 200 <= response.status_code < 300:
+            print(f"✅ {what} created successfully.")
+            return response.json()
+
+        print(f"❌ Failed to create {what}: {response.status_code} - {response.text}")
+        return None
+
+    @staticmethod
+    async def get_clients(url=None):
+        return await AsyncNotaryDashServices._get(url or f"{BASE_URL}/api/v2/clients", "Clients")
+
+    @staticmethod
+    async def get_client(id: str):
+        return await AsyncNotaryDashServices._get(f"{BASE_URL}/api/v2/clients/{id}", f"Client {id}")
+
+    @staticmethod
+    async def get_client_one_user(client_id, user_id):
+        return await AsyncNotaryDashServices._get(
+            f"{BASE_URL}/api/v2/clients/{client_id}/users/{user_id}", f"Client {client_id} user {user_id}"
+        )
+
+    @staticmethod
+    async def get_client_user(client_id, url=None):
+        return await AsyncNotaryDashServices._get(
+            url or f"{BASE_URL}/api/v2/clients/{client_id}/users", f"Client users for client {client_id}"
+        )
+
+    @staticmethod
+    async def get_products(company_id, is_global: bool):
+        # str() so the query string matches the sync service (requests sends True / False)
+        return await AsyncNotaryDashServices._get(
+            f"{BASE_URL}/api/v2/companies/{company_id}/products", f"Products for company {company_id}",
+            params={"global": str(is_global)},
+        )
+
+    @staticmethod
+    async def create_order(data, idempotency_key=None):
+        print("Creating order with data:", json.dumps(data, indent=4))
+        return await AsyncNotaryDashServices._post(
+            f"{BASE_URL}/api/v2/orders", "Order", data, idempotency_key=idempotency_key
+        )
+
+    @staticmethod
+    async def create_products(data, idempotency_key=None):
+        return await AsyncNotaryDashServices._post(
+            f"{BASE_URL}/api/v2/companies/{data.get("client_id")}/products", "Products", data,
+            idempotency_key=idempotency_key,
+        )
+
+    @staticmethod
+    async def create_client(data, idempotency_key=None):
+        return await AsyncNotaryDashServices._post(
+            f"{BASE_URL}/api/v2/clients", "Client", data, idempotency_key=idempotency_key
+        )
+
+    @staticmethod
+    async def create_client_user(client_id: str, user_data: dict, idempotency_key=None):
+        """See NotaryDashServices.create_client_user for the user_data shape."""
+        headers = {
+            **Notary_header,
+            "Content-Type": "application/json",
+            "Accept": "application/json",
+        }
+        return await AsyncNotaryDashServices._post(
+            f"{BASE_URL}/api/v2/clients/{client_id}/users", "Client user", user_data, headers=headers,
+            idempotency_key=idempotency_key,
+        )
@@ -0,0 +1,452 @@
+# submission.py
+import secrets
+import traceback
+from datetime import timedelta
+from decimal import Decimal
+
+import stripe
+from django.conf import settings
+from django.db import transaction
+from django.utils.timezone import now
+from rest_framework import status
+
+from core.breaker import UpstreamUnavailable
+from order_page.pricing import PricingEngine, PricingError
+
+from .models import Order, NotaryClientCompany, NotaryUser
+from .order_graph import OrderGraphBuilder
+from .services import NotaryDashServices
+from .utils import (
+    create_stripe_customer, create_stripe_session, create_payment_intent,
+    get_coupon, apply_coupon_to_customer,
+)
+
+
+class SubmissionError(Exception):
+    """A step of the order submission failed; `body` / `status_code` are the API response."""
+
+    def __init__(self, body, status_code=status.HTTP_400_BAD_REQUEST):
+        super().__init__(body.get("error") or body.get("message"))
+        self.body = body
+        self.status_code = status_code
+
+
+class OrderSubmission:
+    """
+    The steps behind FormSubmissionAPIView.
+
+    The synchronous endpoint runs them in request order. In async mode the
+    view only runs `build_graph` and saves the order; `process` (Celery task
+    stripe_payment.tasks.process_order_submission) does every NotaryDash and
+    Stripe call afterwards and stores the response body the sync endpoint
+    would have returned on the order, for OrderSubmissionStatusView.
+    """
+
+    # ------------------------------------------------------------------
+    # NotaryDash client, terms and coupon
+    # ------------------------------------------------------------------
+    @staticmethod
+    def lookup_coupon(coupon_code):
+        if not coupon_code:
+            print("No coupon code provided.")
+            return None
+        coupon: stripe.Coupon | None = get_coupon(coupon_code)
+        if coupon:
+            print(f"Coupon found: {coupon.id} - {coupon.percent_off}% off or ${float(coupon.amount_off or 0)/100} off")
+        else:
+            print(f"Coupon not found or invalid: {coupon_code}")
+        return coupon
+
+    @staticmethod
+    def resolve_client(company_id, user_id):
+        """Return ({owner_id, company_name, client_team_id}, NotaryUser) for the submitting user."""
+        response = NotaryDashServices.get_client(company_id)
+        if not response:
+            raise SubmissionError({"message": "Error on fetching Client"})
+
+        owner_id = response.get("data", {}).get("owner_id")
+        company_name = response.get("data", {}).get("company_name")
+        client_team_id = response.get("data", {}).get("teams", [])[0].get("id")
+        print(f"Company name {company_name}")
+        if not owner_id:
+            print(f"Error on fetching Owner ID for company {company_id} response: {response} ")
+            raise SubmissionError({"message": "Error on fetching Owner ID"})
+
+        client = NotaryUser.objects.filter(id=user_id).first()
+        if not client:
+            client_resp = NotaryDashServices.get_client_one_user(company_id, user_id)
+            if not client_resp:
+                raise SubmissionError({"message": "Error on fetching Client User"})
+
+            u = client_resp.get("data") or {}
+
+            # Create new User entry
+            client = NotaryUser.objects.create(
+                id=u["id"],
+                email=u.get("email"),
+                email_unverified=u.get("email_unverified"),
+                first_name=u.get("first_name", ""),
+                last_name=u.get("last_name", ""),
+                name=u.get("name", ""),
+                photo_url=u.get("photo_url"),
+                deleted_at=u.get("deleted_at"),
+                last_login_at=u.get("last_login_at"),
+                last_ip=u.get("last_ip"),
+                last_company=NotaryClientCompany.objects.filter(id=company_id).first(),
+                attr=u.get("attr", {}),
+                disabled=u.get("disabled"),
+                type=u.get("type") or "",
+                country_code=u.get("country_code"),
+                tz=u.get("tz"),
+                created_at=u.get("created_at", now()),
+                updated_at=u.get("updated_at", now()),
+                has_roles=u.get("hasRoles", []),
+                pivot_active=True,
+                pivot_role_id=None,
+                pivot_company=None,
+                page_visited=True,
+            )
+
+        client_info = {"owner_id": owner_id, "company_name": company_name, "client_team_id": client_team_id}
+        return client_info, client
+
+    @staticmethod
+    def sign_latest_terms(client, user_id):
+        """Update NotaryUser with latest TermsOfConditions"""
+        try:
+            from order_page.models import TermsOfConditions
+            latest_tos = TermsOfConditions.objects.order_by('-updated_at').first()
+
+            if client and latest_tos:
+                client.signed_terms.add(latest_tos)
+                client.last_signed_at = now()
+                client.save()
+                print(f"Updated NotaryUser {user_id} with TermsOfConditions {latest_tos.id}")
+        except Exception as e:
+            print(f"Error updating TermsOfConditions for user {user_id}: {e}")
+
+    @staticmethod
+    def apply_client(order: Order, client_info, client):
+        """Copy the NotaryDash company and the submitting user's contact details onto the order."""
+        order.owner_id = client_info["owner_id"]
+        order.company_name = client_info["company_name"]
+        order.client_team_id = client_info["client_team_id"]
+
+        if order.point_of_contact == "me":
+            order.contact_first_name_sched = client.first_name
+            order.contact_last_name_sched = client.last_name
+            order.contact_email_sched = client.email
+            order.contact_phone_sched = client.attr.get("phone")
+
+        # Handle Rescheduling Logic
+        if order.rescheduling_option == "contact_me":
+            order.contact_first_name_resched = client.first_name
+            order.contact_last_name_resched = client.last_name
+            order.contact_phone_resched = client.attr.get("phone")
+        elif order.rescheduling_option == "same_as_above":
+            order.contact_first_name_resched = order.contact_first_name_sched
+            order.contact_last_name_resched = order.contact_last_name_sched
+            order.contact_phone_resched = order.contact_phone_sched
+
+    @staticmethod
+    def apply_coupon(order: Order, coupon):
+        order.coupon_id = coupon.id if coupon else None
+        order.coupon_percent = coupon.percent_off if coupon and coupon.percent_off else Decimal('0.00')
+        order.coupon_fixed = coupon.amount_off if coupon and coupon.amount_off else Decimal('0.00')
+
+    # ------------------------------------------------------------------
+    # Cart
+    # ------------------------------------------------------------------
+    @staticmethod
+    def build_graph(order: Order, data) -> OrderGraphBuilder:
+        """Queue the bundles / a la carte rows of `data` and work out the order totals."""
+        # Everything below is built in memory and written once by graph.save()
+        graph = OrderGraphBuilder(order)
+        service_type = data.get("serviceType")
+
+        #Save bundles
+        bundles_data = data.get("bundles", [])
+        a_la_carte_data = data.get("a_la_carteOrder", [])
+        total_bundle_price = graph.add_bundles(data)
+
+        # Update order total_price for bundled services
+        if service_type == "bundled" and total_bundle_price > 0:
+            order.total_price = total_bundle_price
+
+        # Handle A La Carte services
+        total_ala_price = Decimal('0.00')
+        if a_la_carte_data:
+            order.discount_percent = Decimal(
+                data.get("progress", {}).get("currentPercent", 0)
+            )
+            graph.add_a_la_carte(data)
+
+            for svc_id, svc_total in (data.get("serviceTotals") or {}).items():
+                total_ala_price += Decimal(svc_total.get("subtotal", 0))
+
+        if bundles_data and a_la_carte_data:
+            order.service_type = "mixed"
+        elif bundles_data:
+            order.service_type = "bundled"
+        elif a_la_carte_data:
+            order.service_type = "a_la_carte"
+
+        # Calculate Order Protection Price
+        ala_carte_protection = float(data.get("alaCarteOrderProtection", 0))
+        ala_carte_protection_check = data.get("alaCarteOrderProtectionCheck", False)
+        bundle_protection = float(data.get("bundleOrderProtection", 0))
+        bundle_protection_check = data.get("bundleOrderProtectionCheck", False)
+
+        total_protection_price = Decimal('0.00')
+
+        if ala_carte_protection_check:
+            total_protection_price += Decimal(str(ala_carte_protection))
+
+        if bundle_protection_check:
+            total_protection_price += Decimal(str(bundle_protection))
+
+        if total_protection_price > 0:
+            order.order_protection = True
+            order.order_protection_price = total_protection_price
+
+        order.total_price = total_bundle_price + total_ala_price
+
+        # Price the same cart on the server; only charged when PRICING_AUTHORITATIVE is on
+        try:
+            breakdown = PricingEngine.price_order(data)
+        except PricingError as e:
+            if settings.PRICING_AUTHORITATIVE:
+                raise SubmissionError({"error": str(e)})
+            print(f"⚠️ Could not price order on the server: {e}")
+            breakdown = None
+
+        if breakdown:
+            order.price_breakdown = breakdown
+            if settings.PRICING_AUTHORITATIVE:
+                graph.apply_price_breakdown(breakdown)
+            else:
+                for mismatch in graph.price_mismatches(breakdown):
+                    print(f"⚠️ Price mismatch for company {order.company_id}: {mismatch}")
+
+        return graph
+
+    # ------------------------------------------------------------------
+    # Payment
+    # ------------------------------------------------------------------
+    @staticmethod
+    def start_payment(order: Order, payment_method_id, coupon, frontend_domain):
+        """
+        Charge a saved card (pm_...) or open a Checkout Session.
+        Returns (response body, status code) for the submit endpoint.
+        """
+        # If we have a saved card (starts with pm_) and company info
+        company = NotaryClientCompany.objects.get(id=order.company_id)
+        if payment_method_id and payment_method_id.startswith("pm_"):
+            try:
+
+                stripe_customer_id = company.stripe_customer_id
+
+                if not stripe_customer_id:
+                    raise Exception("Company has no Stripe Customer ID")
+
+                amount_cents = int(float(order.total_price or 0) * 100)
+
+                # Check order protection
+                if order.order_protection and int(Decimal(order.order_protection_price))>0:
+                    amount_cents += int(Decimal(order.order_protection_price)*100)
+
+                # Apply Coupon Discount
+                if coupon:
+                    discount_amount_cents = 0
+                    if coupon.percent_off:
+                        discount_amount_cents = int(amount_cents * (coupon.percent_off / 100))
+                    elif coupon.amount_off:
+                        # Stripe API docs say amount_off is positive integer in smallest currency unit (e.g., 100 cents to off $1.00)
+                        discount_amount_cents = int(coupon.amount_off)
+
+                    amount_cents -= discount_amount_cents
+                    if amount_cents < 50: # Minimum charge for Stripe is usually around $0.50
+                        amount_cents = 50
+
+                    # Apply coupon to customer to track redemption
+                    if stripe_customer_id:
+                        apply_coupon_to_customer(stripe_customer_id, coupon.id)
+
+                print(f"Attempting direct charge: {amount_cents} cents with {payment_method_id}")
+
+                intent, redirect_url = create_payment_intent(
+                    amount=amount_cents,
+                    currency="usd",
+                    customer_id=stripe_customer_id,
+                    payment_method_id=payment_method_id,
+                    metadata={
+                        "company_id": company.id,
+                        "user_id": order.user_id,
+                    },
+                    order=order,
+                    frontend_domain = frontend_domain
+                )
+
+                intent_status = "failed"
+                client_secret = None
+
+                if intent:
+                    order.stripe_intent_id = intent.id
+                    intent_status = intent.status
+                    client_secret = intent.client_secret
+                    order.save()
+                # Intent creation failed (likely CardError) still has a redirect_url (failure page),
+                # the order itself exists so this stays a 201.
+
+                return {
+                    "message": "Order processed",
+                    "order_id": order.id,
+                    "status": intent_status,
+                    "client_secret": client_secret,
+                    "redirect_url": redirect_url
+                }, status.HTTP_201_CREATED
+
+            except stripe.CardError as e:
+                print(f"Card Error: {e.user_message}")
+                return {
+                    "error": e.user_message,
+                    "order_id": order.id
+                }, status.HTTP_400_BAD_REQUEST
+
+            except Exception as e:
+                print(f"Direct payment failed: {e}")
+                traceback.print_exc()
+                # User likely expects error if they selected a card and it failed.
+                return {
+                    "message": "Order created, but payment failed",
+                    "error": str(e),
+                    "order_id": order.id
+                }, status.HTTP_400_BAD_REQUEST
+
+        # Fallback to Checkout Session
+        try:
+            # Ensure Stripe Customer exists for Checkout Session too (to allow saving card)
+            if not company.stripe_customer_id:
+                stripe_customer = create_stripe_customer(company.company_name)
+                if stripe_customer:
+                    company.stripe_customer_id = stripe_customer.id
+                    company.save()
+
+            stripe_session = create_stripe_session(order, frontend_domain, customer_id=company.stripe_customer_id)
+            order.stripe_session_id = stripe_session.id
+            order.save()
+
+            return {
+                "message": "Order created successfully",
+                "order_id": order.id, # type: ignore
+                "stripe_checkout_url": stripe_session.url
+            }, status.HTTP_201_CREATED
+        except Exception as e:
+            return {
+                "message": "Order created, but Stripe session failed",
+                "order_id": order.id, # type: ignore
+                "error": str(e)
+            }, status.HTTP_400_BAD_REQUEST
+
+    # ------------------------------------------------------------------
+    # Async mode
+    # ------------------------------------------------------------------
+    @staticmethod
+    def accept(order: Order, graph: OrderGraphBuilder, payment_method_id, frontend_domain):
+        """Save an order without any upstream call and queue the rest of the submission."""
+        order.submission_status = Order.SubmissionStatus.PENDING
+        order.submission_token = secrets.token_urlsafe(32)
+        order.submission_args = {"payment_method_id": payment_method_id, "frontend_domain": frontend_domain}
+        order.submission_updated_at = now()
+        with transaction.atomic():
+            graph.save()
+            transaction.on_commit(lambda: OrderSubmission.enqueue(order.id, payment_method_id, frontend_domain))
+        return order
+
+    @staticmethod
+    def enqueue(order_id, payment_method_id, frontend_domain):
+        """
+        Queue process_order_submission. The order is saved by now, so a broker
+        error is only logged: `sweep` queues the submission again later.
+        """
+        from .tasks import process_order_submission
+        try:
+            process_order_submission.delay(order_id, payment_method_id, frontend_domain)
+        except Exception as e:
+            print(f"⚠️ Could not queue order {order_id} submission, the sweep will retry it: {e}")
+
+    @staticmethod
+    def sweep(limit=100) -> int:
+        """
+        Queue submissions again that were left pending (lost enqueue) or
+        processing (crashed worker) for ORDER_SUBMISSION_STALE_AFTER seconds.
+        Every payment call uses a per-order Stripe idempotency key, so running
+        an interrupted submission again does not charge twice.
+        """
+        stale = now() - timedelta(seconds=settings.ORDER_SUBMISSION_STALE_AFTER)
+        orders = list(
+            Order.objects.filter(
+                submission_status__in=[Order.SubmissionStatus.PENDING, Order.SubmissionStatus.PROCESSING],
+                submission_updated_at__lt=stale,
+            ).order_by("submission_updated_at").values_list("id", "submission_status", "submission_args")[:limit]
+        )
+        queued = 0
+        for order_id, submission_status, args in orders:
+            # Conditional, so two sweeps (or a late worker) cannot both requeue the order
+            updated = Order.objects.filter(
+                id=order_id, submission_status=submission_status, submission_updated_at__lt=stale,
+            ).update(submission_status=Order.SubmissionStatus.PENDING, submission_updated_at=now())
+            if not updated:
+                continue
+            print(f"🧹 Requeueing order {order_id} submission, stuck {submission_status}")
+            args = args or {}
+            OrderSubmission.enqueue(order_id, args.get("payment_method_id"), args.get("frontend_domain"))
+            queued += 1
+        return queued
+
+    @staticmethod
+    def process(order_id, payment_method_id, frontend_domain, defer=False):
+        """
+        Run the NotaryDash / Stripe half of an accepted submission and record the outcome.
+        With `defer`, an unavailable NotaryDash puts the order back to pending and
+        re-raises UpstreamUnavailable, so the task can try again later.
+        """
+        updated = Order.objects.filter(
+            id=order_id, submission_status=Order.SubmissionStatus.PENDING
+        ).update(submission_status=Order.SubmissionStatus.PROCESSING, submission_updated_at=now())
+        if not updated:
+            print(f"⚠️ Order {order_id} submission is not pending, skipping")
+            return None
+
+        order = Order.objects.get(id=order_id)
+        try:
+            coupon = OrderSubmission.lookup_coupon(order.coupon_code)
+            OrderSubmission.apply_coupon(order, coupon)
+
+            client_info, client = OrderSubmission.resolve_client(order.company_id, order.user_id)
+            OrderSubmission.sign_latest_terms(client, order.user_id)
+            OrderSubmission.apply_client(order, client_info, client)
+            order.save()
+
+            body, status_code = OrderSubmission.start_payment(order, payment_method_id, coupon, frontend_domain)
+        except UpstreamUnavailable as e:
+            if defer:
+                Order.objects.filter(id=order.id).update(
+                    submission_status=Order.SubmissionStatus.PENDING, submission_updated_at=now()
+                )
+                raise
+            body, status_code = {"message": "Order created, but processing failed", "error": str(e), "order_id": order.id}, 503
+        except SubmissionError as e:
+            body, status_code = {**e.body, "order_id": order.id}, e.status_code
+        except Exception as e:
+            traceback.print_exc()
+            body, status_code = {"message": "Order created, but processing failed", "error": str(e), "order_id": order.id}, 500
+
+        order.submission_status = (
+            Order.SubmissionStatus.READY if status_code < 400 else Order.SubmissionStatus.FAILED
+        )
+        order.submission_result = body
+        order.submission_updated_at = now()
+        order.save(update_fields=["submission_status", "submission_result", "submission_updated_at"])
+        print(f"✅ Order {order.id} submission {order.submission_status}")
+        return order.submission_status
@@ -56,3 +56,59 @@ def process_tos_for_ghl(user_id: int, contact_id: int):
        response= ContactServices.push_contact(contact, contact_update_payload)
        print("updated contact with tos")
     
+
+
+@shared_task(bind=True, max_retries=None)
+def process_order_submission(self, order_id, payment_method_id=None, frontend_domain=None):
+    """
+    NotaryDash / Stripe half of an order accepted by FormSubmissionAPIView in async mode.
+    Runs again after the breaker's Retry-After while NotaryDash is unavailable, up to
+    ORDER_SUBMISSION_MAX_DEFERS times, before the submission is marked failed.
+    """
+    from django.conf import settings
+    from core.breaker import UpstreamUnavailable
+    from stripe_payment.submission import OrderSubmission
+    defer = self.request.retries < settings.ORDER_SUBMISSION_MAX_DEFERS
+    try:
+        return OrderSubmission.process(order_id, payment_method_id, frontend_domain, defer=defer)
+    except UpstreamUnavailable as e:
+        raise self.retry(countdown=max(e.retry_after, 5))
+
+
+@shared_task
+def sweep_order_submissions():
+    """Queue async order submissions again that were lost or abandoned by a worker."""
+    from stripe_payment.submission import OrderSubmission
+    queued = OrderSubmission.sweep()
+    if queued:
+        logger.info(f"Requeued {queued} stuck order submissions")
+    return queued
+
+
+@shared_task
+def purge_idempotency_keys():
+    """Drop submit-order Idempotency-Keys older than IDEMPOTENCY_KEY_TTL."""
+    from stripe_payment.idempotency import IdempotencyKeys
+    deleted = IdempotencyKeys.purge()
+    logger.info(f"Purged {deleted} expired idempotency keys")
+    return deleted
+
+
+@shared_task
+def process_webhook_event(event_id, event_type=None):
+    """Handle one Stripe event stored by stripe_webhook."""
+    from stripe_payment.inbox import WebhookInbox
+    from stripe_payment.models import StripeWebhookEventLog
+    if event_type is None:
+        event_type = StripeWebhookEventLog.objects.filter(event_id=event_id).values_list("event_type", flat=True).first()
+    return WebhookInbox.process(event_id, event_type)
+
+
+@shared_task
+def sweep_webhook_inbox():
+    """Dispatch webhook events that are due for a retry or were abandoned by a worker again."""
+    from stripe_payment.inbox import WebhookInbox
+    queued = WebhookInbox.sweep()
+    if queued:
+        logger.info(f"Queued {queued} webhook events from the inbox")
+    return queued
@@ -1,3 +1,588 @@
-from django.test import TestCase
+import threading
+from datetime import timedelta
+from decimal import Decimal
+from unittest import mock
 
-# Create your tests here.
+from django.conf import settings
+from django.db import IntegrityError, connection
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils.timezone import now
+from rest_framework.response import Response
+
+from core.breaker import CircuitOpen
+from order_page.pricing import PricingEngine, PricingError
+from stripe_payment import webhooks
+from stripe_payment.fulfilment import FulfilmentError, OrderFulfilment, Step, StepGraph
+from stripe_payment.idempotency import IdempotencyKeys
+from stripe_payment.inbox import WebhookInbox
+from stripe_payment.models import (
+    ALaCarteItem, ALaCarteItemDisclosure, ALaCarteItemModalOption, ALaCarteOption, ALaCarteSubMenuItem,
+    Bundle, BundleModalOption, BundleOption, IdempotencyKey, Order, StripeCharge, StripeWebhookEventLog,
+)
+from stripe_payment.order_graph import OrderGraphBuilder
+from stripe_payment.services import NotaryDashServices
+from stripe_payment.submission import OrderSubmission, SubmissionError
+from stripe_payment.webhooks import WebhookHandler
+
+
+class IdempotencyKeyTests(TestCase):
+    SCOPE = "7:42"
+
+    def claim(self, body, key="key-1"):
+        return IdempotencyKeys.claim(self.SCOPE, key, IdempotencyKeys.fingerprint(body))
+
+    def test_first_request_claims_and_a_repeat_replays_its_response(self):
+        record, replay = self.claim({"a": 1})
+        self.assertIsNone(replay)
+        IdempotencyKeys.complete(record, Response({"order_id": 5, "message": "Order created"}, status=201))
+
+        record, replay = self.claim({"a": 1})
+        self.assertIsNone(record)
+        self.assertEqual(replay.status_code, 201)
+        self.assertEqual(replay.data, {"order_id": 5, "message": "Order created"})
+        self.assertEqual(replay["Idempotent-Replayed"], "true")
+
+    def test_same_key_with_another_body_is_rejected(self):
+        self.claim({"a": 1})
+        _, replay = self.claim({"a": 2})
+        self.assertEqual(replay.status_code, 422)
+
+    def test_repeat_while_in_flight_gets_409(self):
+        self.claim({"a": 1})
+        _, replay = self.claim({"a": 1})
+        self.assertEqual(replay.status_code, 409)
+        self.assertEqual(replay["Retry-After"], "1")
+
+    def test_response_without_an_order_releases_the_key(self):
+        record, _ = self.claim({"a": 1})
+        IdempotencyKeys.complete(record, Response({"error": "Invalid address"}, status=400))
+        record, replay = self.claim({"a": 1})
+        self.assertIsNone(replay)
+        self.assertIsNotNone(record)
+
+    def test_abandoned_claim_is_taken_over_once_its_lease_is_up(self):
+        first, _ = self.claim({"a": 1})
+        IdempotencyKey.objects.filter(pk=first.pk).update(locked_until=now() - timedelta(seconds=1))
+
+        second, replay = self.claim({"a": 1})
+        self.assertIsNone(replay)
+        self.assertEqual(second.pk, first.pk)
+        # Only one retry takes it over
+        self.assertEqual(self.claim({"a": 1})[1].status_code, 409)
+
+        # The dead request can no longer store or release anything
+        IdempotencyKeys.release(first)
+        IdempotencyKeys.complete(second, Response({"order_id": 9}, status=201))
+        self.assertEqual(self.claim({"a": 1})[1].data, {"order_id": 9})
+
+    def test_expired_key_is_reusable(self):
+        record, _ = self.claim({"a": 1})
+        IdempotencyKeys.complete(record, Response({"order_id": 5}, status=201))
+        IdempotencyKey.objects.update(created_at=IdempotencyKeys.expires_before() - timedelta(seconds=1))
+        record, replay = self.claim({"a": 2})
+        self.assertIsNone(replay)
+        self.assertEqual(record.fingerprint, IdempotencyKeys.fingerprint({"a": 2}))
+
+    def test_overlong_key_is_rejected(self):
+        _, replay = self.claim({"a": 1}, key="k" * 256)
+        self.assertEqual(replay.status_code, 400)
+
+
+@override_settings(ORDER_SUBMISSION_STALE_AFTER=300)
+class OrderSubmissionSweepTests(TestCase):
+    def order(self, submission_status, age):
+        return Order.objects.create(
+            unit_type="single", service_type="bundled", submission_status=submission_status,
+            submission_args={"payment_method_id": "pm_1", "frontend_domain": "https://orders.example"},
+            submission_updated_at=now() - timedelta(seconds=age),
+        )
+
+    def test_stuck_submissions_are_queued_again(self):
+        pending = self.order(Order.SubmissionStatus.PENDING, 600)
+        processing = self.order(Order.SubmissionStatus.PROCESSING, 600)
+        self.order(Order.SubmissionStatus.PENDING, 10)
+        self.order(Order.SubmissionStatus.PROCESSING, 10)
+        self.order(Order.SubmissionStatus.READY, 600)
+
+        with mock.patch.object(OrderSubmission, "enqueue") as enqueue:
+            self.assertEqual(OrderSubmission.sweep(), 2)
+        self.assertCountEqual(
+            [c.args for c in enqueue.call_args_list],
+            [(order.id, "pm_1", "https://orders.example") for order in (pending, processing)],
+        )
+        processing.refresh_from_db()
+        self.assertEqual(processing.submission_status, Order.SubmissionStatus.PENDING)
+        self.assertGreater(processing.submission_updated_at, now() - timedelta(seconds=5))
+
+        # Requeued submissions are fresh again until they get stuck once more
+        with mock.patch.object(OrderSubmission, "enqueue"):
+            self.assertEqual(OrderSubmission.sweep(), 0)
+
+    def test_enqueue_swallows_broker_errors(self):
+        from stripe_payment.tasks import process_order_submission
+        with mock.patch.object(process_order_submission, "delay", side_effect=ConnectionError("broker down")):
+            OrderSubmission.enqueue(1, None, None)
+
+
+@override_settings(WEBHOOK_SWEEP_GRACE=300)
+class WebhookInboxTests(TestCase):
+    EVENT_TYPE = "test.event"
+
+    def setUp(self):
+        self.handler_func = mock.Mock(return_value=None)
+        handler = WebhookHandler(self.EVENT_TYPE, self.handler_func, run_async=False, max_attempts=3)
+        patcher = mock.patch.dict(webhooks.HANDLERS, {self.EVENT_TYPE: handler})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def receive(self, event_id="evt_1"):
+        body = {"id": event_id, "type": self.EVENT_TYPE, "created": 1700000000, "data": {"object": {}}}
+        return WebhookInbox.receive(event_id=event_id, event_type=self.EVENT_TYPE, event_data={}, json_body=body)
+
+    def process(self, event_id="evt_1"):
+        result = WebhookInbox.process(event_id, self.EVENT_TYPE)
+        return result, StripeWebhookEventLog.objects.get(event_id=event_id)
+
+    def make_due(self, event_id="evt_1"):
+        StripeWebhookEventLog.objects.filter(event_id=event_id).update(next_attempt_at=now())
+
+    def test_event_is_handled_once(self):
+        self.receive()
+        status, evt_log = self.process()
+        self.assertEqual(status, StripeWebhookEventLog.Status.PROCESSED)
+        self.assertEqual(evt_log.attempts, 1)
+        self.assertIsNone(self.process()[0])
+        self.handler_func.assert_called_once()
+
+    def test_redelivered_event_is_stored_once(self):
+        self.assertTrue(self.receive())
+        self.assertFalse(self.receive())
+        self.assertEqual(StripeWebhookEventLog.objects.filter(event_id="evt_1").count(), 1)
+        self.assertTrue(self.receive("evt_2"))
+
+    def test_claim_is_exclusive(self):
+        self.receive()
+        handler = webhooks.handler_for(self.EVENT_TYPE)
+        self.assertTrue(WebhookInbox.claim("evt_1", handler))
+        self.assertFalse(WebhookInbox.claim("evt_1", handler))
+
+    def test_failures_back_off_until_max_attempts(self):
+        self.receive()
+        self.handler_func.side_effect = RuntimeError("GHL said no")
+        for attempt, delay in ((1, 30), (2, 60)):
+            status, evt_log = self.process()
+            self.assertEqual((status, evt_log.attempts), (StripeWebhookEventLog.Status.PENDING, attempt))
+            self.assertAlmostEqual((evt_log.next_attempt_at - now()).total_seconds(), delay, delta=5)
+            # Not claimable again before it is due
+            self.assertIsNone(self.process()[0])
+            self.make_due()
+
+        status, evt_log = self.process()
+        self.assertEqual((status, evt_log.attempts), (StripeWebhookEventLog.Status.FAILED, 3))
+        self.assertEqual(evt_log.error_message, "GHL said no")
+
+    def test_handler_error_message_fails_the_event(self):
+        self.receive()
+        self.handler_func.return_value = "Checkout session expired"
+        status, evt_log = self.process()
+        self.assertEqual(status, StripeWebhookEventLog.Status.FAILED)
+        self.assertEqual(evt_log.attempts, 1)
+
+    def test_open_breaker_defers_without_using_an_attempt(self):
+        self.receive()
+        self.handler_func.side_effect = CircuitOpen("notarydash", 42)
+        status, evt_log = self.process()
+        self.assertEqual((status, evt_log.attempts), (StripeWebhookEventLog.Status.PENDING, 0))
+        self.assertAlmostEqual((evt_log.next_attempt_at - now()).total_seconds(), 42, delta=5)
+
+    def test_abandoned_lock_is_claimed_again_until_max_attempts(self):
+        self.receive()
+        StripeWebhookEventLog.objects.filter(event_id="evt_1").update(
+            status=StripeWebhookEventLog.Status.PROCESSING, attempts=3, locked_until=now() - timedelta(seconds=1),
+        )
+        status, evt_log = self.process()
+        self.assertEqual(status, StripeWebhookEventLog.Status.FAILED)
+        self.assertEqual(evt_log.error_message, "Worker lost the event")
+        self.handler_func.assert_not_called()
+
+    def test_sweep_skips_events_that_are_still_queued(self):
+        for event_id in ("fresh", "lost", "retry_due", "retry_later", "abandoned", "running"):
+            self.receive(event_id)
+        past, future = now() - timedelta(seconds=1), now() + timedelta(seconds=60)
+        events = StripeWebhookEventLog.objects
+        events.filter(event_id="lost").update(created_at=now() - timedelta(seconds=600))
+        events.filter(event_id="retry_due").update(next_attempt_at=past)
+        events.filter(event_id="retry_later").update(next_attempt_at=future)
+        events.filter(event_id="abandoned").update(status=StripeWebhookEventLog.Status.PROCESSING, locked_until=past)
+        events.filter(event_id="running").update(status=StripeWebhookEventLog.Status.PROCESSING, locked_until=future)
+
+        with mock.patch.object(WebhookInbox, "dispatch") as dispatch:
+            self.assertEqual(WebhookInbox.sweep(), 3)
+        self.assertCountEqual(
+            [c.args[0] for c in dispatch.call_args_list], ["lost", "retry_due", "abandoned"]
+        )
+
+
+@override_settings(WEBHOOK_MAX_ATTEMPTS=5)
+class WebhookRegistryTests(TestCase):
+    def setUp(self):
+        patcher = mock.patch.dict(webhooks.HANDLERS)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def event(self, event_type, event_id="evt_1"):
+        return {"id": event_id, "type": event_type, "created": 1700000000, "data": {"object": {}}}
+
+    def receive(self, event_type, event_id="evt_1"):
+        body = self.event(event_type, event_id)
+        WebhookInbox.receive(event_id=event_id, event_type=event_type, event_data={}, json_body=body)
+
+    def test_register_stores_one_handler_per_event_type(self):
+        func = mock.Mock(return_value=None)
+        webhooks.register("test.created", "test.updated", queue="orders", timeout=120)(func)
+
+        for event_type in ("test.created", "test.updated"):
+            handler = webhooks.handler_for(event_type)
+            self.assertEqual(handler.event_type, event_type)
+            self.assertIs(handler.func, func)
+            self.assertTrue(handler.run_async)
+            self.assertEqual((handler.queue, handler.timeout, handler.max_attempts), ("orders", 120, 5))
+            # The inbox lock outlives the Celery soft time limit
+            self.assertEqual(handler.lock_timeout, 180)
+
+    def test_dispatch_calls_the_registered_handler(self):
+        created, updated = mock.Mock(return_value=None), mock.Mock(return_value="Checkout session expired")
+        webhooks.register("test.created")(created)
+        webhooks.register("test.updated", max_attempts=2)(updated)
+
+        event = self.event("test.updated")
+        self.assertEqual(webhooks.dispatch(event), "Checkout session expired")
+        updated.assert_called_once_with(event)
+        created.assert_not_called()
+        self.assertEqual(webhooks.handler_for("test.updated").max_attempts, 2)
+
+    def test_unknown_event_type_is_ignored(self):
+        self.assertIsNone(webhooks.handler_for("test.unknown"))
+        self.assertIsNone(webhooks.dispatch(self.event("test.unknown")))
+
+    def test_stripe_events_are_registered_with_their_policy(self):
+        for event_type in ("charge.succeeded", "charge.updated", "charge.failed", "charge.refunded"):
+            self.assertIs(webhooks.handler_for(event_type).func, webhooks.upsert_charge)
+            self.assertFalse(webhooks.handler_for(event_type).run_async)
+        for event_type in ("payment_intent.amount_capturable_updated", "checkout.session.completed"):
+            handler = webhooks.handler_for(event_type)
+            self.assertTrue(handler.run_async)
+            self.assertEqual((handler.queue, handler.timeout), (settings.WEBHOOK_ORDER_QUEUE, 300))
+
+    def test_inline_handler_runs_in_the_request(self):
+        func = mock.Mock(return_value=None)
+        webhooks.register("test.inline", run_async=False)(func)
+        self.receive("test.inline")
+
+        with mock.patch("stripe_payment.tasks.process_webhook_event.apply_async") as apply_async:
+            WebhookInbox.dispatch("evt_1", "test.inline")
+        apply_async.assert_not_called()
+        func.assert_called_once()
+        evt_log = StripeWebhookEventLog.objects.get(event_id="evt_1")
+        self.assertEqual(evt_log.status, StripeWebhookEventLog.Status.PROCESSED)
+
+    def test_async_handler_is_queued_with_its_policy(self):
+        func = mock.Mock(return_value=None)
+        webhooks.register("test.async", queue="orders", timeout=300)(func)
+        self.receive("test.async")
+
+        with mock.patch("stripe_payment.tasks.process_webhook_event.apply_async") as apply_async:
+            WebhookInbox.dispatch("evt_1", "test.async")
+        apply_async.assert_called_once_with(("evt_1", "test.async"), queue="orders", soft_time_limit=300)
+        func.assert_not_called()
+        evt_log = StripeWebhookEventLog.objects.get(event_id="evt_1")
+        self.assertEqual(evt_log.status, StripeWebhookEventLog.Status.PENDING)
+
+    def test_unqueued_event_stays_pending_for_the_sweep(self):
+        webhooks.register("test.async")(mock.Mock(return_value=None))
+        self.receive("test.async")
+
+        with mock.patch(
+            "stripe_payment.tasks.process_webhook_event.apply_async", side_effect=ConnectionError("broker down"),
+        ):
+            WebhookInbox.dispatch("evt_1", "test.async")
+        evt_log = StripeWebhookEventLog.objects.get(event_id="evt_1")
+        self.assertEqual((evt_log.status, evt_log.attempts), (StripeWebhookEventLog.Status.PENDING, 0))
+
+    def test_unknown_event_type_is_acknowledged(self):
+        self.receive("test.unknown")
+        WebhookInbox.dispatch("evt_1", "test.unknown")
+        evt_log = StripeWebhookEventLog.objects.get(event_id="evt_1")
+        self.assertEqual(evt_log.status, StripeWebhookEventLog.Status.PROCESSED)
+        self.assertEqual(evt_log.error_message, "No handler")
+
+
+class ChargeEventOrderTests(TestCase):
+    """upsert_charge applies charge.* events by their `created` time, whatever order they arrive in."""
+
+    def event(self, event_type, created, **charge):
+        obj = {
+            "id": "ch_1", "payment_intent": "pi_1", "amount": 5000, "currency": "usd", "created": 1700000000,
+            "paid": True, "status": "succeeded", "captured": False, "amount_refunded": 0, "refunded": False,
+            **charge,
+        }
+        return {"id": f"evt_{event_type}_{created}", "type": event_type, "created": created, "data": {"object": obj}}
+
+    def charge(self):
+        return StripeCharge.objects.get(charge_id="ch_1")
+
+    def test_late_older_event_does_not_overwrite_a_newer_one(self):
+        webhooks.upsert_charge(self.event("charge.updated", 1700000100, captured=True))
+        webhooks.upsert_charge(self.event("charge.succeeded", 1700000050))
+        self.assertTrue(self.charge().captured)
+
+    def test_newer_event_is_applied(self):
+        webhooks.upsert_charge(self.event("charge.succeeded", 1700000050))
+        webhooks.upsert_charge(self.event("charge.refunded", 1700000200, amount_refunded=5000, refunded=True))
+        charge = self.charge()
+        self.assertEqual((charge.refunded, charge.amount_refunded), (True, 5000))
+
+    def test_same_second_events_never_go_backwards(self):
+        webhooks.upsert_charge(self.event("charge.updated", 1700000100, captured=True, amount_refunded=1000))
+        webhooks.upsert_charge(self.event("charge.succeeded", 1700000100))
+        charge = self.charge()
+        self.assertEqual((charge.captured, charge.amount_refunded), (True, 1000))
+
+
+class StepGraphTests(SimpleTestCase):
+    def test_steps_get_the_results_of_their_requirements(self):
+        calls = []
+
+        def step(name, value):
+            def func(**kwargs):
+                calls.append(name)
+                return value + sum(kwargs.values())
+            return func
+
+        graph = StepGraph([
+            Step("total", step("total", 100), ("left", "right")),
+            Step("left", step("left", 1), ("base",)),
+            Step("right", step("right", 2), ("base",)),
+            Step("base", step("base", 10)),
+        ], workers=4)
+        self.assertEqual(graph.run(), {"base": 10, "left": 11, "right": 12, "total": 123})
+        self.assertEqual(calls[0], "base")
+        self.assertEqual(calls[-1], "total")
+
+    def test_independent_steps_run_concurrently(self):
+        barrier = threading.Barrier(2, timeout=2)
+        graph = StepGraph([Step("a", barrier.wait), Step("b", barrier.wait)], workers=2)
+        graph.run()   # a BrokenBarrierError would mean they ran one after the other
+
+    def test_failure_stops_dependent_steps(self):
+        after = mock.Mock()
+
+        def boom():
+            raise RuntimeError("NotaryDash said no")
+
+        graph = StepGraph([Step("boom", boom), Step("after", after, ("boom",))], workers=2)
+        with self.assertRaises(FulfilmentError) as raised:
+            graph.run()
+        self.assertEqual(raised.exception.step, "boom")
+        after.assert_not_called()
+
+    def test_done_steps_and_what_only_they_needed_are_skipped(self):
+        read, created, sent = mock.Mock(return_value="r"), mock.Mock(), mock.Mock(return_value="s")
+        graph = StepGraph([
+            Step("read", read), Step("created", created, ("read",)), Step("sent", sent, ("created",)),
+        ], workers=1)
+        on_done = mock.Mock()
+        results = graph.run(done={"created": "c"}, on_done=on_done)
+        self.assertEqual(results, {"created": "c", "sent": "s"})
+        read.assert_not_called()
+        created.assert_not_called()
+        sent.assert_called_once_with(created="c")
+        on_done.assert_called_once_with("sent", "s")
+
+
+class OrderFulfilmentResumeTests(TestCase):
+    def setUp(self):
+        self.order = Order.objects.create(unit_type="single", service_type="bundled")
+        self.client_user = mock.Mock(return_value={"email": "a@example.com"})
+        self.contact = mock.Mock(return_value={"id": "contact_1"})
+        self.notary_order = mock.Mock(side_effect=[RuntimeError("NotaryDash timeout"), {"id": "no_1"}])
+        steps = [
+            Step("client_user", self.client_user),
+            Step("contact_resolved", self.contact, ("client_user",)),
+            Step("notary_order_created", self.notary_order, ("contact_resolved",)),
+        ]
+        patcher = mock.patch.object(OrderFulfilment, "steps", return_value=steps)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def fulfil(self):
+        self.order.refresh_from_db()
+        return OrderFulfilment.process({"data": {"object": {}}}, self.order)
+
+    def test_retry_resumes_after_the_finished_steps(self):
+        with self.assertRaises(FulfilmentError):
+            self.fulfil()
+        self.order.refresh_from_db()
+        state = self.order.fulfilment_state
+        self.assertEqual(state["status"], OrderFulfilment.Status.FAILED)
+        self.assertEqual(set(state["steps"]), {"contact_resolved"})
+
+        self.assertTrue(self.fulfil())
+        self.contact.assert_called_once()
+        self.client_user.assert_called_once()
+        self.notary_order.assert_called_with(contact_resolved={"id": "contact_1"})
+
+        self.order.refresh_from_db()
+        state = self.order.fulfilment_state
+        self.assertEqual((state["status"], state["attempts"]), (OrderFulfilment.Status.COMPLETED, 2))
+        self.assertEqual(state["steps"]["notary_order_created"]["result"], {"id": "no_1"})
+
+        # A completed fulfilment is not run again
+        self.assertTrue(self.fulfil())
+        self.assertEqual(self.notary_order.call_count, 2)
+
+
+@mock.patch("stripe_payment.views.render_to_string", return_value="")
+@mock.patch("stripe_payment.views.build_notary_product", return_value={"name": "Product"})
+class NotaryDashIdempotencyKeyTests(TestCase):
+    """Retried or resumed fulfilments send NotaryDash the same keys for the same order."""
+
+    def setUp(self):
+        self.order = Order.objects.create(unit_type="single", service_type="bundled", total_price=100)
+        steps = OrderFulfilment.steps({"data": {"object": {"id": "pi_1"}}}, self.order)
+        self.steps = {step.name: step.func for step in steps}
+
+    def keys(self, method):
+        return [call.kwargs["idempotency_key"] for call in method.call_args_list]
+
+    def test_product_and_order_keys_are_derived_from_the_order(self, *_):
+        created = {"data": {"id": 7, "order_id": 8}}
+        with mock.patch.object(NotaryDashServices, "create_products", return_value=created) as create_products, \
+                mock.patch.object(NotaryDashServices, "create_order", return_value=created) as create_order:
+            for _ in range(2):
+                product = self.steps["product_created"](invoice_draft=({}, "Product"))
+                self.steps["notary_order_created"](
+                    invoice_draft=({}, "Product"), product_created=product, client_user={}
+                )
+        self.assertEqual(self.keys(create_products), [f"order-{self.order.pk}-notary-product"] * 2)
+        self.assertEqual(self.keys(create_order), [f"order-{self.order.pk}-notary-order"] * 2)
+
+
+class ServerPricingTests(SimpleTestCase):
+    """OrderSubmission.build_graph against a server side breakdown (see order_page.tests for the pricing itself)."""
+
+    DATA = {"serviceType": "bundled", "company_id": "7", "bundles": [{"name": "Closing", "price": 300}]}
+    BREAKDOWN = {
+        "bundles": [{"name": "Closing", "base_price": "350.00", "price": "315.00"}],
+        "services": {},
+        "discount_percent": "0.00",
+        "protection": {"a_la_carte": "0.00", "bundle": "20.00", "total": "20.00"},
+        "total": "315.00",
+    }
+
+    def build(self, **pricing):
+        self.order = Order(unit_type="single", company_id=7)
+        pricing = pricing or {"return_value": self.BREAKDOWN}
+        with mock.patch.object(PricingEngine, "price_order", **pricing), mock.patch("builtins.print") as printed:
+            graph = OrderSubmission.build_graph(self.order, self.DATA)
+        return graph, [" ".join(map(str, call.args)) for call in printed.call_args_list]
+
+    @override_settings(PRICING_AUTHORITATIVE=False)
+    def test_shadow_mode_charges_the_sent_prices_and_logs_mismatches(self):
+        graph, printed = self.build()
+        self.assertEqual(self.order.total_price, Decimal("300"))
+        self.assertEqual(graph.rows[Bundle][0].price, Decimal("300"))
+        self.assertEqual(self.order.price_breakdown, self.BREAKDOWN)
+        mismatches = [line for line in printed if line.startswith("⚠️ Price mismatch for company 7")]
+        self.assertEqual(len(mismatches), 2)
+        self.assertIn("total_price: sent 300.00 expected 315.00", mismatches[0])
+        self.assertIn("order_protection_price: sent 0 expected 20.00", mismatches[1])
+
+    @override_settings(PRICING_AUTHORITATIVE=False)
+    def test_shadow_mode_still_takes_orders_it_cannot_price(self):
+        graph, printed = self.build(side_effect=PricingError("Unknown bundle: 'Closing'"))
+        self.assertEqual(self.order.total_price, Decimal("300"))
+        self.assertTrue(any("Could not price order" in line for line in printed))
+
+    @override_settings(PRICING_AUTHORITATIVE=True)
+    def test_authoritative_mode_charges_the_breakdown(self):
+        graph, printed = self.build()
+        self.assertEqual(self.order.total_price, Decimal("315.00"))
+        self.assertEqual(graph.rows[Bundle][0].price, Decimal("315.00"))
+        self.assertEqual((self.order.order_protection, self.order.order_protection_price), (True, Decimal("20.00")))
+        self.assertFalse(any("Price mismatch" in line for line in printed))
+
+    @override_settings(PRICING_AUTHORITATIVE=True)
+    def test_authoritative_mode_rejects_orders_it_cannot_price(self):
+        with self.assertRaises(SubmissionError):
+            self.build(side_effect=PricingError("Unknown bundle: 'Closing'"))
+
+
+def submission(bundles, services, items):
+    """An order page payload with every kind of child row."""
+    item_ids = [(f"svc{s}", f"item{s}_{i}") for s in range(services) for i in range(items)]
+    return {
+        "bundles": [{
+            "name": f"Bundle {b}", "price": 90, "basePrice": 100,
+            "selectedOptions": {"scan": True, "rush": False},
+            "options": {"items": [{"id": "scan", "label": "Scan", "priceAdd": 10}, {"id": "rush", "label": "Rush"}]},
+            "modalForm": {"fields": [{"name": "loan", "label": "Loan number"}]},
+        } for b in range(bundles)],
+        "bundleForms": {f"Bundle {b}": {"loan": f"L-{b}"} for b in range(bundles)},
+        "a_la_carteOrder": [{
+            "id": f"svc{s}", "title": f"Service {s}",
+            "form": {
+                "items": [{
+                    "id": item_id, "title": "Item",
+                    "options": {"type": "checkbox", "items": [{"id": "notarize", "label": "Notarize", "value": True}]},
+                } for service_id, item_id in item_ids if service_id == f"svc{s}"],
+                "submenu": {"items": [{"id": "signers", "label": "Signers", "type": "counter", "value": 2}]},
+                "modalOption": {"form": [{"label": "Notes", "value": "Gate code 1234"}]},
+            },
+        } for s in range(services)],
+        "disclosures": [{"itemId": item_id, "name": "Acknowledged", "value": True} for _, item_id in item_ids],
+        "serviceTotals": {},
+    }
+
+
+class OrderGraphBuilderTests(TestCase):
+    CHILDREN = {
+        BundleOption: "bundle__order", BundleModalOption: "bundle__order", ALaCarteItem: "service__order",
+        ALaCarteOption: "item__service__order", ALaCarteSubMenuItem: "item__service__order",
+        ALaCarteItemModalOption: "item__service__order", ALaCarteItemDisclosure: "item__service__order",
+    }
+
+    def save(self, data):
+        order = Order(unit_type="single", service_type="mixed")
+        graph = OrderGraphBuilder(order)
+        graph.add_bundles(data)
+        graph.add_a_la_carte(data)
+        with CaptureQueriesContext(connection) as queries:
+            graph.save()
+        return order, [query["sql"] for query in queries if query["sql"].startswith("INSERT")]
+
+    def test_one_insert_per_model_whatever_the_cart_size(self):
+        for size in ((1, 1, 1), (3, 3, 4)):
+            with self.subTest(size=size):
+                _, inserts = self.save(submission(*size))
+                # The order plus the nine child models
+                self.assertEqual(len(inserts), 10)
+
+    def test_children_are_saved_under_their_parents(self):
+        order, _ = self.save(submission(2, 2, 3))
+        self.assertEqual(order.bundles.count(), 2)
+        self.assertEqual(order.a_la_carte_services.count(), 2)
+        # Only the selected bundle option is stored
+        counts = {model: model.objects.filter(**{lookup: order}).count() for model, lookup in self.CHILDREN.items()}
+        self.assertEqual(counts, {
+            BundleOption: 2, BundleModalOption: 2, ALaCarteItem: 6, ALaCarteOption: 6,
+            ALaCarteSubMenuItem: 6, ALaCarteItemModalOption: 6, ALaCarteItemDisclosure: 6,
+        })
+
+    def test_a_failed_insert_saves_nothing(self):
+        with mock.patch.object(ALaCarteItemDisclosure.objects, "bulk_create", side_effect=IntegrityError), \
+                self.assertRaises(IntegrityError):
+            self.save(submission(1, 1, 1))
+        self.assertFalse(Order.objects.exists())
+        self.assertFalse(ALaCarteItem.objects.exists())
@@ -1,7 +1,7 @@
 from django.urls import path, include
 from rest_framework.routers import DefaultRouter
 from .views import (
-    FormSubmissionAPIView, stripe_webhook,
+    FormSubmissionAPIView, OrderSubmissionStatusView, stripe_webhook,
     OrderRetrieveView, notary_view, stripe_coupon, test_email_template,
     OrderRetrieveView, notary_view, stripe_coupon, test_email_template,
     create_setup_intent, save_payment_method, set_default_card,
@@ -14,6 +14,7 @@ router.register(r'orders', OrderRetrieveView, basename='order')
 
 urlpatterns = [
     path("submit-order/", FormSubmissionAPIView.as_view(), name="submit-order"),
+    path("submit-order/status/<str:token>/", OrderSubmissionStatusView.as_view(), name="submit-order-status"),
     path("submit-order/<str:stripe_session_id>/", InvoiceView.as_view(), name="submit-order-with-session"),
     path("invoice/payment-intent/<str:payment_intent_id>/", retrieve_invoice_by_payment_intent, name="retrieve-invoice-by-pi"),
     path("stripe-webhook/", stripe_webhook, name="stripe-webhook"),
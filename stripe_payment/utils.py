@@ -49,71 +49,82 @@ def apply_coupon_to_customer(customer_id, coupon_id):
         print(f"❌ Error applying coupon to customer: {e}")
         return False
 
-def generate_order_line_items(order: Order):
-    """
-    Generates the line items list for an order, used for both Stripe Session and PaymentIntent metadata.
+def order_price_lines(order: Order):
     """
-    line_items = []
-
-    bundles = order.bundles.all()
-    if bundles.exists():
-        for bundle in bundles:
-            line_items.append({
-                "price_data": {
-                    "currency": "usd",
-                    "product_data": {
-                        "name": bundle.name,
-                        "description": f"Bundle - {bundle.description}" if bundle.description else f"Bundle - {bundle.name}",
-                    },
-                    "unit_amount": int(float(bundle.price or 0) * 100),
-                },
-                "quantity": 1,
-            })
+    One priced line per bundle and per a la carte item of an order.
 
+    Prices come from the saved rows, which FormSubmissionAPIView fills from the
+    server side price breakdown (Order.price_breakdown) when pricing is
+    authoritative. Stripe line items, the GHL invoice and the NotaryDash
+    product name are all built from these lines.
+    """
+    lines = []
+    for bundle in order.bundles.all():
+        lines.append({
+            "name": bundle.name,
+            "description": bundle.description,
+            "service_title": None,
+            "price": bundle.price or Decimal("0.00"),
+            "product_name": bundle.name,
+            "metadata": None,
+        })
 
-    services = order.a_la_carte_services.all()
+    services = order.a_la_carte_services.prefetch_related("items__options", "items__submenu_items")
     for service in services:
         for item in service.items.all():
             # Gather options
-            selected_options = item.options.filter(value=True).values_list("label", flat=True)
+            selected_options = [opt.label for opt in item.options.all() if opt.value]
 
             # Gather submenu info
-            submenu_parts = []
-            for sub in item.submenu_items.all():
-                if sub.value > 0:
-                    label = f"{sub.label} X{sub.value}" if sub.value > 1 else sub.label
-                    submenu_parts.append(label)
+            submenu_items = [sub for sub in item.submenu_items.all() if sub.value > 0]
+            submenu_parts = [f"{sub.label} X{sub.value}" if sub.value > 1 else sub.label for sub in submenu_items]
 
             # Build product name
-            product_name = item.title
+            name = item.title
             if submenu_parts:
-                product_name += " + " + " + ".join(submenu_parts)
+                name += " + " + " + ".join(submenu_parts)
             if selected_options:
-                product_name += f" ({' + '.join(selected_options)})"
-
-            # Price logic
-            price_value = item.price or item.base_price or 0
-
-            line_items.append({
-                "price_data": {
-                    "currency": "usd",
-                    "product_data": {
-                        "name": product_name,
-                        "description": service.title,
-                        "metadata": {
-                            "service_id": service.service_id,
-                            "item_id": item.item_id,
-                            "options": ", ".join(selected_options),
-                            "submenu": ", ".join(
-                                f"{sub.label} ({sub.value})" for sub in item.submenu_items.all() if sub.value > 0
-                            ),
-                        },
-                    },
-                    "unit_amount": int(float(price_value) * 100),
+                name += f" ({' + '.join(selected_options)})"
+
+            lines.append({
+                "name": name,
+                "description": item.subtitle,
+                "service_title": service.title,
+                "price": item.price or item.base_price or Decimal("0.00"),
+                "product_name": item.item_id,
+                "metadata": {
+                    "service_id": service.service_id,
+                    "item_id": item.item_id,
+                    "options": ", ".join(selected_options),
+                    "submenu": ", ".join(f"{sub.label} ({sub.value})" for sub in submenu_items),
                 },
-                "quantity": 1,
             })
+    return lines
+
+
+def generate_order_line_items(order: Order):
+    """
+    Generates the line items list for an order, used for both Stripe Session and PaymentIntent metadata.
+    """
+    line_items = []
+
+    for line in order_price_lines(order):
+        product_data = {"name": line["name"]}
+        if line["metadata"] is None:
+            # Bundle
+            product_data["description"] = f"Bundle - {line['description']}" if line["description"] else f"Bundle - {line['name']}"
+        else:
+            product_data["description"] = line["service_title"]
+            product_data["metadata"] = line["metadata"]
 
+        line_items.append({
+            "price_data": {
+                "currency": "usd",
+                "product_data": product_data,
+                "unit_amount": int(Decimal(line["price"]) * 100),
+            },
+            "quantity": 1,
+        })
 
     if not line_items:
         line_items.append({
@@ -200,7 +211,9 @@ def create_stripe_session(order: Order, domain, customer_id=None):
         session_params["payment_intent_data"]["setup_future_usage"] = "off_session"
 
     # print("Creating Stripe session with line items:", json.dumps(line_items, indent=4))
-    session = stripe.checkout.Session.create(**session_params)
+    session = stripe.checkout.Session.create(
+        **session_params, idempotency_key=f"order-{order.id}-checkout-session"
+    )
 
     return session
 
@@ -382,7 +395,9 @@ def create_payment_intent(amount, currency, customer_id, payment_method_id, meta
         off_session=True,
         confirm=True,
         capture_method='manual',
-        metadata=final_metadata
+        metadata=final_metadata,
+        # One intent per order, also when an interrupted submission runs again
+        idempotency_key=f"order-{order.id}-payment-intent" if order else None,
     )
     
     # Determine Redirect URL
@@ -1,6 +1,7 @@
 # views.py
 from dj_IBstripe.settings import STRIPE_PUBLISHABLE_KEY
 from django.shortcuts import render
+from django.urls import reverse
 from rest_framework.views import APIView
 from rest_framework.response import Response
 from rest_framework import viewsets, mixins, generics
@@ -8,33 +9,37 @@ from rest_framework import status
 from rest_framework.pagination import PageNumberPagination
 from rest_framework.filters import SearchFilter
 from stripe_payment.models import (
-    Order, ALaCarteService,
-    StripeCharge, CheckoutSession, NotaryClientCompany,
-    StripeWebhookEventLog, Bundle, BundleOption, BundleModalOption,
+    Order,
+    CheckoutSession, NotaryClientCompany,
+    StripeWebhookEventLog,
     ALaCarteItem, ALaCarteItemDisclosure
 )
 from rest_framework.decorators import api_view
 from rest_framework.response import Response
 from rest_framework import status
 from .serializer import OrderSerializer, NotaryUserSerializer, NotaryClientCompanySerializer
-from core.services import OAuthServices, ContactServices
+from core.breaker import UpstreamUnavailable
+from core.services import OAuthServices
 from core.models import Contact, OAuthToken
 from django.utils.dateparse import parse_datetime
 from decimal import Decimal
 import json
+import time
 from .utils import (
-    create_stripe_customer, create_stripe_session, get_coupon_by_promo_code,
+    create_stripe_customer, get_coupon_by_promo_code,
     create_stripe_setup_intent,
-    create_payment_intent,
-    generate_order_line_items,
+    generate_order_line_items, order_price_lines,
     list_payment_methods,attach_payment_method,
     set_default_payment_method, get_coupon,
-    apply_coupon_to_customer
 )
 from .services import InvoiceServices, NotaryDashServices
+from .submission import OrderSubmission, SubmissionError
+from .idempotency import IdempotencyKeys
+from .inbox import WebhookInbox
+from .fulfilment import OrderFulfilment, FulfilmentError
 import stripe
 # from stripe.error import SignatureVerificationError
-from stripe._error import SignatureVerificationError, StripeError
+from stripe._error import SignatureVerificationError
 from django.conf import settings
 from django.http import HttpResponse, JsonResponse
 from django.views.decorators.csrf import csrf_exempt
@@ -48,316 +53,136 @@ import re
 stripe.api_key = settings.STRIPE_SECRET_KEY
 
 class FormSubmissionAPIView(APIView):
+    """
+    Create an order from the order page and start its payment.
+
+    Synchronous by default. With ORDER_SUBMISSION_ASYNC on (or a
+    `Prefer: respond-async` request header) the order is saved without any
+    NotaryDash / Stripe call and the view answers 202 with a status URL;
+    the checkout URL or client_secret shows up there once the Celery task
+    finishes (see OrderSubmissionStatusView). A synchronous submission
+    falls back to the async path when NotaryDash is unavailable (circuit
+    open / rate limited); the task retries until it is back.
+    """
     def post(self, request):
         data = request.data
         print("Received data:", json.dumps(data, indent=4)) 
-        streetAddress = data.get("streetAddress")
-        city = data.get("city")
-        state = data.get("state")
-        
+
         company_id = data.get("company_id")
         user_id= data.get("user_id")
-        owner_id = None
-        company_name = None
-        coupon_code = data.get("coupon_code")
-        coupon = None
-        if coupon_code:
-            coupon:stripe.Coupon |None = get_coupon(coupon_code)
-            if coupon:
-                print(f"Coupon found: {coupon.id} - {coupon.percent_off}% off or ${float(coupon.amount_off)/100} off")
-            else:
-                print(f"Coupon not found or invalid: {coupon_code}")
-        else:
-            print("No coupon code provided.")
         if (not company_id) or (not user_id):
             msg = "Company ID and User ID are required."
             return Response({"error": msg}, status=status.HTTP_400_BAD_REQUEST)
-        else:
-            response = NotaryDashServices.get_client(company_id)
-            if not response:
-                return Response({"message":"Error on fetching Client"},status=status.HTTP_400_BAD_REQUEST)
-            else:
-                owner_id = response.get("data",{}).get("owner_id")
-                company_name = response.get("data",{}).get("company_name")
-                client_team_id = response.get("data",{}).get("teams",[])[0].get("id")
-                print(f"Company name {company_name}")
-                if not owner_id:
-                    print(f"Error on fetching Owner ID for company {company_id} response: {json.dumps(response, indent=4)} ")
-                    return Response({"message":"Error on fetching Owner ID"},status=status.HTTP_400_BAD_REQUEST)
-                client = NotaryUser.objects.filter(id=user_id).first()
-                if not client:
-                    client_resp = NotaryDashServices.get_client_one_user(company_id, user_id)
-                    if not client_resp:
-                        return Response({"message": "Error on fetching Client User"}, status=status.HTTP_400_BAD_REQUEST)
-                    
-                    u = client_resp.get("data") or {}
-                
-                    # Create new User entry
-                    client = NotaryUser.objects.create(
-                        id=u["id"],
-                        email=u.get("email"),
-                        email_unverified=u.get("email_unverified"),
-                        first_name=u.get("first_name", ""),
-                        last_name=u.get("last_name", ""),
-                        name=u.get("name", ""),
-                        photo_url=u.get("photo_url"),
-                        deleted_at=u.get("deleted_at"),
-                        last_login_at=u.get("last_login_at"),
-                        last_ip=u.get("last_ip"),
-                        last_company=NotaryClientCompany.objects.filter(id=company_id).first(),
-                        attr=u.get("attr", {}),
-                        disabled=u.get("disabled"),
-                        type=u.get("type") or "",
-                        country_code=u.get("country_code"),
-                        tz=u.get("tz"),
-                        created_at=u.get("created_at", now()),
-                        updated_at=u.get("updated_at", now()),
-                        has_roles=u.get("hasRoles", []),
-                        pivot_active=True,
-                        pivot_role_id=None,
-                        pivot_company=None,
-                        page_visited=True,
-                    )
-
-            # Update NotaryUser with latest TermsOfConditions
-            try:
-                from order_page.models import TermsOfConditions
-                latest_tos = TermsOfConditions.objects.order_by('-updated_at').first()
-                
-                if client and latest_tos:
-                    client.signed_terms.add(latest_tos)
-                    client.last_signed_at = now()
-                    client.save()
-                    print(f"Updated NotaryUser {user_id} with TermsOfConditions {latest_tos.id}")
-            except Exception as e:
-                print(f"Error updating TermsOfConditions for user {user_id}: {e}")
-            
-         
-        service_type = data.get("serviceType")
-        order = Order.from_api(data, coupon, owner_id, company_name, client_team_id)
-        
-        if order.point_of_contact == "me":
-            order.contact_first_name_sched = client.first_name
-            order.contact_last_name_sched = client.last_name
-            order.contact_email_sched = client.email
-            order.contact_phone_sched = client.attr.get("phone")
-
-        # Handle Rescheduling Logic
-        if order.rescheduling_option == "contact_me":
-             order.contact_first_name_resched= client.first_name
-             order.contact_last_name_resched = client.last_name
-             order.contact_phone_resched = client.attr.get("phone")
-        elif order.rescheduling_option == "same_as_above":
-             order.contact_first_name_resched = order.contact_first_name_sched
-             order.contact_last_name_resched = order.contact_last_name_sched
-             order.contact_phone_resched = order.contact_phone_sched
-
-
-  
-        #Save bundles
-        bundles_data = data.get("bundles", [])
-        a_la_carte_data = data.get("a_la_carteOrder", [])
-        total_bundle_price = Decimal('0.00')
-        
-        for b in bundles_data:
-            bundle_price = Decimal(str(b.get("price", 0)))
-            total_bundle_price += bundle_price
-            
-            bundle_instance = Bundle.from_api(order, b)
-
-            # Handle Bundle Options
-            selected_options = b.get("selectedOptions", {})
-            options_def = b.get("options", {}).get("items", [])
-            # Create a map for easy lookup of option definitions by ID
-            options_map = {item["id"]: item for item in options_def}
-
-            for opt_id, opt_val in selected_options.items():
-                BundleOption.from_api(bundle_instance, opt_id, opt_val, options_map)
-
-            # Handle Bundle Modal Options
-            bundle_name = b.get("name")
-            modal_form = b.get("modalForm")
-            # Get the form data for this specific bundle from bundleForms
-            bundle_forms_entry = data.get("bundleForms", {}).get(bundle_name)
-
-            if modal_form and bundle_forms_entry:
-                fields = modal_form.get("fields", [])
-                for field in fields:
-                    BundleModalOption.from_api(bundle_instance, field, bundle_forms_entry)
-        
-        # Update order total_price for bundled services
-        if service_type == "bundled" and total_bundle_price > 0:
-            order.total_price = total_bundle_price
-            order.save()
-
-        # Handle A La Carte services
-        total_ala_price =Decimal('0.00')
-        if a_la_carte_data:
-            order.discount_percent = Decimal(
-                data.get("progress", {}).get("currentPercent", 0)
-            )
-            ALaCarteService.from_api(order, data)
-
-            
-            for svc_id, svc_total in (data.get("serviceTotals") or {}).items():
-                total_ala_price += Decimal(svc_total.get("subtotal", 0))
-            
 
+        idempotency_key = request.headers.get("Idempotency-Key")
+        if not idempotency_key:
+            return self.submit(request, data)
 
-        if bundles_data and a_la_carte_data:
-            order.service_type = "mixed"
-        elif bundles_data:
-            order.service_type = "bundled"
-        elif a_la_carte_data:
-            order.service_type = "a_la_carte"
-
+        record, replay = IdempotencyKeys.claim(
+            f"{company_id}:{user_id}", idempotency_key, IdempotencyKeys.fingerprint(data)
+        )
+        if replay is not None:
+            return replay
+        try:
+            response = self.submit(request, data)
+        except Exception:
+            IdempotencyKeys.release(record)
+            raise
+        IdempotencyKeys.complete(record, response)
+        return response
+
+    def submit(self, request, data):
+        company_id = data.get("company_id")
+        user_id = data.get("user_id")
+        frontend_domain = request.headers.get("Origin") 
+        print(f"Frontend domain: {frontend_domain}")
+        # Check for direct payment method
+        payment_method_id = data.get("payment_method")
 
-        # Calculate Order Protection Price
-        ala_carte_protection = float(data.get("alaCarteOrderProtection", 0))
-        ala_carte_protection_check = data.get("alaCarteOrderProtectionCheck", False)
-        bundle_protection = float(data.get("bundleOrderProtection", 0))
-        bundle_protection_check = data.get("bundleOrderProtectionCheck", False)
+        if settings.ORDER_SUBMISSION_ASYNC or "respond-async" in request.headers.get("Prefer", ""):
+            return self.accept(request, data, payment_method_id, frontend_domain)
 
-        total_protection_price = Decimal('0.00')
+        coupon = OrderSubmission.lookup_coupon(data.get("coupon_code"))
+        try:
+            try:
+                client_info, client = OrderSubmission.resolve_client(company_id, user_id)
+            except UpstreamUnavailable as e:
+                if not NotaryClientCompany.objects.filter(id=company_id).exists():
+                    raise
+                print(f"⚠️ {e}, deferring order submission to the queue")
+                return self.accept(request, data, payment_method_id, frontend_domain)
+            OrderSubmission.sign_latest_terms(client, user_id)
+
+            order = Order.from_api(data, coupon, **client_info)
+            OrderSubmission.apply_client(order, client_info, client)
+            graph = OrderSubmission.build_graph(order, data)
+        except SubmissionError as e:
+            return Response(e.body, status=e.status_code)
+        graph.save()
+
+        body, status_code = OrderSubmission.start_payment(order, payment_method_id, coupon, frontend_domain)
+        return Response(body, status=status_code)
+
+    def accept(self, request, data, payment_method_id, frontend_domain):
+        if not NotaryClientCompany.objects.filter(id=data.get("company_id")).exists():
+            return Response({"message": "Error on fetching Client"}, status=status.HTTP_400_BAD_REQUEST)
+
+        # NotaryDash company details and the coupon are filled in by the task
+        order = Order.from_api(data, None, None, None, None)
+        try:
+            graph = OrderSubmission.build_graph(order, data)
+        except SubmissionError as e:
+            return Response(e.body, status=e.status_code)
+        OrderSubmission.accept(order, graph, payment_method_id, frontend_domain)
 
-        if ala_carte_protection_check:
-             total_protection_price += Decimal(str(ala_carte_protection))
-        
-        if bundle_protection_check:
-             total_protection_price += Decimal(str(bundle_protection))
-        
-        if total_protection_price > 0:
-            order.order_protection = True
-            order.order_protection_price = total_protection_price
+        status_url = request.build_absolute_uri(
+            reverse("submit-order-status", kwargs={"token": order.submission_token})
+        )
+        return Response({
+            "message": "Order accepted",
+            "order_id": order.id,
+            "status": order.submission_status,
+            "status_url": status_url,
+        }, status=status.HTTP_202_ACCEPTED, headers={"Location": status_url})
 
-        order.total_price = total_bundle_price + total_ala_price
-        order.save()
 
-        frontend_domain = request.headers.get("Origin") 
-        print(f"Frontend domain: {frontend_domain}")
+class OrderSubmissionStatusView(APIView):
+    """
+    Status of an async order submission, by its unguessable submission token.
 
-        # Check for direct payment method
-        payment_method_id = data.get("payment_method")
-        
-        # If we have a saved card (starts with pm_) and company info
-        company = NotaryClientCompany.objects.get(id=company_id)
-        if payment_method_id and payment_method_id.startswith("pm_"):
-            try:
-                
-                stripe_customer_id = company.stripe_customer_id
-                
-                if not stripe_customer_id:
-                     raise Exception("Company has no Stripe Customer ID")
+    202 while the task is pending / processing (with Retry-After), 200 with
+    the submit endpoint's response body under "result" once it is ready or
+    failed. `?wait=<seconds>` holds the answer for up to ORDER_STATUS_MAX_WAIT
+    (a second) while it is in progress; clients keep polling after Retry-After.
+    """
+    POLL_INTERVAL = 0.5
 
-                amount_cents = int(float(order.total_price or 0) * 100)
-                
-                # Check order protection
-                if order.order_protection and int(Decimal(order.order_protection_price))>0:
-                     amount_cents += int(Decimal(order.order_protection_price)*100)
-
-                # Apply Coupon Discount
-                if coupon:
-                    discount_amount_cents = 0
-                    if coupon.percent_off:
-                        discount_amount_cents = int(amount_cents * (coupon.percent_off / 100))
-                    elif coupon.amount_off:
-                        discount_amount_cents = int(coupon.amount_off) # amount_off is usually in cents for Stripe coupons? Need to verify. 
-                        # Stripe API docs say amount_off is positive integer in smallest currency unit (e.g., 100 cents to off $1.00)
-                    
-                    amount_cents -= discount_amount_cents
-                    if amount_cents < 50: # Minimum charge for Stripe is usually around $0.50
-                        amount_cents = 50
-                    
-                    # Apply coupon to customer to track redemption
-                    if stripe_customer_id:
-                        apply_coupon_to_customer(stripe_customer_id, coupon.id)
-
-                print(f"Attempting direct charge: {amount_cents} cents with {payment_method_id}")
-
-                intent, redirect_url = create_payment_intent(
-                    amount=amount_cents,
-                    currency="usd",
-                    customer_id=stripe_customer_id,
-                    payment_method_id=payment_method_id,
-                    metadata={
-                        "company_id": company.id,
-                        "user_id": user_id,
-                    },
-                    order=order,
-                    frontend_domain = frontend_domain
-                )
-                
-                status_code = status.HTTP_201_CREATED
-                intent_status = "failed"
-                client_secret = None
-
-                if intent:
-                    order.stripe_intent_id = intent.id
-                    intent_status = intent.status
-                    client_secret = intent.client_secret
-                    if intent.status == "succeeded":
-                        # We might want to mark order as paid or similar if we track that
-                        pass
-                    order.save()
-                else:
-                    # Intent creation failed (likely CardError), but we have a redirect_url (failure page)
-                    # We should decide if we return 201 (Order Created) or 400.
-                    # Since the order IS created in DB before this block, returning 201 seems appropriate if we want to redirect user to failure page.
-                    # Or we can return 200.
-                    pass
-                
-                return Response({
-                    "message": "Order processed",
-                    "order_id": order.id, 
-                    "status": intent_status,
-                    "client_secret": client_secret,
-                    "redirect_url": redirect_url
-                }, status=status_code)
-
-            except stripe.CardError as e:
-                print(f"Card Error: {e.user_message}")
-                return Response({
-                    "error": e.user_message,
-                    "order_id": order.id 
-                }, status=status.HTTP_400_BAD_REQUEST)
+    def get(self, request, token):
+        order = Order.objects.filter(submission_token=token).only(
+            "id", "submission_status", "submission_result"
+        ).first()
+        if not order:
+            return Response({"error": "Order not found"}, status=status.HTTP_404_NOT_FOUND)
 
-            except Exception as e:
-                print(f"Direct payment failed: {e}")
-                import traceback
-                traceback.print_exc()
-                # Fallback or return error? User likely expects error if they selected a card and it failed.
-                return Response({
-                    "message": "Order created, but payment failed",
-                    "error": str(e),
-                    "order_id": order.id
-                }, status=status.HTTP_400_BAD_REQUEST)
-
-
-        # Fallback to Checkout Session
-        # Fallback to Checkout Session
         try:
-            # Ensure Stripe Customer exists for Checkout Session too (to allow saving card)
-            if not company.stripe_customer_id:
-                stripe_customer = create_stripe_customer(company.company_name)
-                if stripe_customer:
-                    company.stripe_customer_id = stripe_customer.id
-                    company.save()
-            
-            stripe_session = create_stripe_session(order, frontend_domain, customer_id=company.stripe_customer_id)
-            order.stripe_session_id = stripe_session.id
-            order.save()
+            wait = min(max(float(request.query_params.get("wait", 0)), 0), settings.ORDER_STATUS_MAX_WAIT)
+        except ValueError:
+            wait = 0
+        in_progress = (Order.SubmissionStatus.PENDING, Order.SubmissionStatus.PROCESSING)
+        deadline = time.monotonic() + wait
+        while order.submission_status in in_progress and time.monotonic() < deadline:
+            time.sleep(self.POLL_INTERVAL)
+            order.refresh_from_db(fields=["submission_status", "submission_result"])
+
+        body = {
+            "order_id": order.id,
+            "status": order.submission_status,
+            "result": order.submission_result,
+        }
+        if order.submission_status in in_progress:
+            return Response(body, status=status.HTTP_202_ACCEPTED, headers={"Retry-After": "1"})
+        return Response(body)
 
-            return Response({
-                "message": "Order created successfully",
-                "order_id": order.id, # type: ignore
-                "stripe_checkout_url": stripe_session.url
-            }, status=status.HTTP_201_CREATED)
-        except Exception as e:
-            return Response({
-                "message": "Order created, but Stripe session failed",
-                "order_id": order.id, # type: ignore
-                "error": str(e)
-            }, status=status.HTTP_400_BAD_REQUEST)
     
 class InvoiceView(APIView):
     def get(self, request, stripe_session_id):
@@ -429,6 +254,9 @@ def retrieve_invoice_by_payment_intent(request, payment_intent_id):
 
         return Response(response, status=status.HTTP_200_OK)
 
+    except UpstreamUnavailable:
+        # 503 from UpstreamUnavailableMiddleware
+        raise
     except Exception as e:
         print(f"Error retrieving invoice by PI: {e}")
         return Response({"error": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
@@ -647,120 +475,25 @@ def stripe_webhook(request):
         return HttpResponse(status=400)
      
     event_id = event.get('id', None)
-    event_created = event.get('created', None)
     event_type = event['type']
-    
     print(f"Event ID: {event_id}")
     print(f"Event type: {event_type}")
-    print(f"Event created: {event_created}")
-    
-    data_object = event['data']['object']
-    
-    # Check if event already processed
-    evt_log = StripeWebhookEventLog.objects.filter(event_id=event_id).first()
-    if evt_log:
-        print(f"⚠️ Event {event_id} already processed at {evt_log.created_at}")
-        return HttpResponse(status=200)
-    
-    # Create event log
-    evt_log = StripeWebhookEventLog(
+
+    # Store the event and acknowledge right away; WebhookInbox processes it in a worker
+    body = json.loads(payload)
+    created = WebhookInbox.receive(
         event_id=event_id,
         event_type=event_type,
-        created_at=make_aware(datetime.datetime.fromtimestamp(event_created)) if event_created else None,
-        event_data=json.dumps(data_object, indent=4),
+        event_data=body['data']['object'],
+        json_body=body,
     )
-    
-    payment_indent_id = data_object.get("payment_intent", None)
-    print(f"Payment intent ID: {payment_indent_id}")
-    
-    # Handle different event types
-    if event_type == 'charge.succeeded':
-        print("Processing charge.succeeded...")
-        handle_charge_succeeded(event)
-        return HttpResponse(status=200)
-        
-    elif event_type == 'charge.failed':
-        print("Processing charge.failed...")
-        handle_charge_failed(event)
-        return HttpResponse(status=200)
-        
-    elif event_type == 'charge.refunded':
-        print("Processing charge.refunded...")
-        handle_charge_refunded(event)
-        return HttpResponse(status=200)
-        
-    elif event_type == 'charge.updated':
-        print("Processing charge.updated...")
-        handle_charge_updated(event)
-        return HttpResponse(status=200)
-    
-    elif event_type == 'payment_intent.amount_capturable_updated':
-        print("---- Processing payment_intent.requires_action...")
-        handle_payment_intent_requires_action(event)
-        return HttpResponse(status=200) 
-
-    # elif event_type == 'payment_intent.succeeded':
-    #     print("Processing payment_intent.succeeded...")
-    #     handle_payment_intent_succeeded(event)
-        
-    #     # Mark event log as processed if successful (or handled inside)
-    #     evt_log.error_message = "No errors"
-    #     evt_log.processed = True
-    #     evt_log.save()
-    #     return HttpResponse(status=200)
-
-    elif event_type == 'checkout.session.completed':
-        print("=== Processing checkout.session.completed ===")
-        print(f"Session ID: {data_object.get('id')}")
-        print(f"Payment status: {data_object.get('payment_status')}")
-        print(f"Amount total: {data_object.get('amount_total')}")
-        
-        session_obj = handle_checkout_session_completed(event)
-        print(f"handle_checkout_session_completed returned: {session_obj is not None}")
-        
-        if not session_obj:
-            msg = "Failed to process CheckoutSession. Expiring session due to server error."
-            print(f"❌ {msg}")
-            evt_log.error_message = msg
-            evt_log.processed = True
-            evt_log.save()
-            
-            # Expire the session
-            try:
-                stripe.checkout.Session.expire(data_object.get("id"))
-                print("✅ Session expired successfully")
-            except Exception as e:
-                print(f"❌ Failed to expire session: {e}")
-            
-            return HttpResponse(status=500)
-        else:
-            print("✅ Session processed successfully, attempting to capture payment...")
-            try:
-                if payment_indent_id:
-                    stripe.PaymentIntent.capture(payment_indent_id)
-                    print("✅ Payment captured successfully")
-                else:
-                    print("⚠️ No payment intent ID found")
-                
-                evt_log.error_message = "No errors"
-                evt_log.processed = True
-                evt_log.save()
-                print("✅ Event log saved successfully")
-                
-            except StripeError as e:
-                msg = e.user_message or str(e)
-                print(f"❌ Payment capture failed: {msg}")
-                evt_log.error_message = msg
-                evt_log.processed = True
-                evt_log.save()
-                return HttpResponse(status=500)
-            
-            return HttpResponse(status=200)
-    
-    else:
-        print(f"⚠️ Unhandled event type: {event_type}")
+    if not created:
+        print(f"⚠️ Event {event_id} already received")
         return HttpResponse(status=200)
 
+    WebhookInbox.dispatch(event_id, event_type)
+    return HttpResponse(status=200)
+
 
 @api_view(['POST'])
 def create_setup_intent(request):
@@ -1064,48 +797,6 @@ def format_phone_number(phone):
 
     return f"+{digits}"
 
-def handle_charge_failed(event):
-    print("❌ Charge failed:", json.dumps(event,indent=4))
-    # Log failure or alert user
-
-def handle_charge_refunded(event):
-    print("↩️ Charge refunded:", json.dumps(event,indent=4))
-    # Update refund status in your DB
-
-def handle_charge_succeeded(event):
-    import time
-    time.sleep(1)  # Simulate processing delay
-    obj = event['data']['object']
-    # print(f"Stripe charge suceed: {json.dumps(event, indent=4)}")
-    StripeCharge.objects.update_or_create(
-        charge_id=obj['id'],
-        defaults={
-            "payment_intent_id": obj.get("payment_intent"),
-            "amount": obj["amount"],
-            "currency": obj["currency"],
-            "paid": obj["paid"],
-            "status": obj["status"],
-            "captured": obj["captured"],
-            "receipt_url": obj.get("receipt_url"),
-            "customer_email": obj.get("billing_details", {}).get("email"),
-            "customer_name": obj.get("billing_details", {}).get("name"),
-            "billing_country": obj.get("billing_details", {}).get("address", {}).get("country"),
-            "brand": obj.get("payment_method_details", {}).get("card", {}).get("brand"),
-            "last4": obj.get("payment_method_details", {}).get("card", {}).get("last4"),
-            "exp_month": obj.get("payment_method_details", {}).get("card", {}).get("exp_month"),
-            "exp_year": obj.get("payment_method_details", {}).get("card", {}).get("exp_year"),
-            "network_transaction_id": obj.get("payment_method_details", {}).get("card", {}).get("network_transaction_id"),
-            "created": make_aware(datetime.datetime.fromtimestamp(obj["created"])),
-            "livemode": obj.get("livemode", False),
-        }
-    )
-
-def handle_charge_updated(event):
-    import time
-    time.sleep(1)
-    handle_charge_succeeded(event)
-    # Optional: update metadata, receipt URL, etc.
-
 def handle_payment_intent_requires_action(event):
     try:
         obj = event['data']['object']
@@ -1118,8 +809,11 @@ def handle_payment_intent_requires_action(event):
         if not order_obj:
             print("ERROR: No order found with this payment intent ID")
             return None
-        process_order(event,order_obj)
+        return OrderFulfilment.process(event, order_obj)
         
+    except FulfilmentError:
+        # Retried by the webhook inbox, resuming from the saved fulfilment state
+        raise
     except Exception as e:
         print(f"Error in handle_payment_intent_requires_action: {e}")
         return None
@@ -1144,14 +838,17 @@ def handle_checkout_session_completed(event):
         print(f"Order ID: {order_obj.id}, Company ID: {order_obj.company_id}, User ID: {order_obj.user_id}")
         
         # Determine success of processing
-        processed_successfully = process_order(event, order_obj)
+        processed_successfully = OrderFulfilment.process(event, order_obj)
         
         if not processed_successfully:
-             print("ERROR: process_order failed in handle_checkout_session_completed")
+             print("ERROR: order fulfilment failed in handle_checkout_session_completed")
              return None
 
         # Proceed to update Session object (keeping existing logic for session tracking)
     
+    except FulfilmentError:
+        # Retried by the webhook inbox, resuming from the saved fulfilment state
+        raise
     except Exception as e:
         print(f"ERROR in handle_checkout_session_completed: {str(e)}")
         print(f"Exception type: {type(e).__name__}")
@@ -1180,168 +877,41 @@ def handle_checkout_session_completed(event):
     
     return session_obj
 
-def process_order(event,order_obj):
-    obj = event['data']['object']
-    
-    # Handle polymorphic event object (Session vs PaymentIntent)
-    if obj.get("object") == "checkout.session":
-        payment_intent_id = obj.get("payment_intent")
-    else:
-        # Assume it is a PaymentIntent or Charge where id is the PI/Charge ID
-        # For our usage, it is PaymentIntent
-        payment_intent_id = obj.get("id")
-    try:
-        company_id = order_obj.company_id
-        user_id = order_obj.user_id
-        
-        print("Calling NotaryDashServices.get_client_one_user...")
-        client_user = NotaryDashServices.get_client_one_user(company_id, user_id)
-        client_user = client_user.get("data", {}) if client_user else {}
-        print(f"Client user retrieved: {bool(client_user)}")
-        try:
-            contact_phone = format_phone_number(order_obj.contact_phone_sched)
-        except:
-            contact_phone = order_obj.contact_phone_sched
-        contact_email = client_user.get("email")
-        print(f"Contact phone: {contact_phone}, Contact email: {contact_email}")
-        
-        print("Getting OAuth token...")
-        token_obj = OAuthServices.get_valid_access_token_obj()
-        print(f"Token location ID: {token_obj.LocationId if token_obj else 'None'}")
-        
-        print("Searching for existing contacts...")
-        search_response = ContactServices.search_contacts(token_obj.LocationId, query={
-            "locationId": "n7iGMwfy1T5lZZacxygj",
-            "page": 1,
-            "pageLimit": 20,
-            "filters": [
-                {
-                    "field": "email",
-                    "operator": "eq",
-                    "value": contact_email
-                },
-                # {
-                #     "field": "phone",
-                #     "operator": "eq",
-                #     "value": contact_phone
-                # },
-            ],
-            "sort": [
-                {
-                    "field": "dateAdded",
-                    "direction": "desc"
-                }
-            ]
-        })
-        
-        # print(f"Contact search response: {json.dumps(search_response, indent=4)}")
-        
-        if len(search_response.get("contacts", [])) > 0:
-            contact_data = search_response["contacts"][0]
-            # print(f"Found existing contact: {json.dumps(contact_data, indent=4)}")
-        else:
-            client_attr = client_user.get("attr")
-            notary_phone = (client_attr.get("phone") if client_attr.get("phone") else client_attr.get("mobile_phone") ) #type: ignore
-            ghl_phone = notary_phone if notary_phone else contact_phone 
-            print("Creating new contact...")
-            contact = {
-                "firstName": client_user.get("first_name") if client_user.get("first_name") else order_obj.contact_first_name_sched,
-                "lastName": client_user.get("last_name") if client_user.get("last_name") else order_obj.contact_last_name_sched,
-                # "name": contact_name,
-                "locationId": token_obj.LocationId,
-                "email": contact_email,
-                "phone": ghl_phone,
-                "country": "US",  
-                "type": "customer"  
+def build_notary_product(order: Order, inv_data, prd_name, event_obj):
+    """
+    Build the NotaryDash product payload for the order.
+    """
+    # Handle polymorphic event_obj (Checkout Session or Payment Intent)
+    amount_cents = event_obj.get("amount_total") if event_obj.get("object") == "checkout.session" else event_obj.get("amount", 0)
+    final_price = amount_cents / 100 if amount_cents else 0
+
+    html_content = render_to_string(
+        "order_product_detail.html", 
+        context={
+            "invoice_data":inv_data,
+            "order":order
             }
-            contact_data, status = ContactServices.post_contact(token_obj.LocationId, contact)
-            print(f"Contact creation status: {status}")
-            
-            if status != 201:
-                contact_id = contact_data.get("meta", {}).get("contactId", None)
-                print(f"Contact creation failed with status {status}. Attempting to retrieve existing contact by ID: {contact_id}")
-                if contact_id:
-                    contact_data = ContactServices.get_contact(token_obj.LocationId, contact_id)
-                    if contact_data:
-                        ContactServices.save_contact(contact_data)
-                    contact_data["id"] = contact_id
-                    # print(f"Contact creation conflicted with: {contact_data.get('id')} Using {json.dumps(contact_data, indent=4)}")
-            ContactServices.save_contact(contact_data)
-        
-        print("=== ABOUT TO CALL BUILD_INVOICE_PAYLOAD ===")
-        print(f"Parameters: order_obj={order_obj.id}, contact={contact_data.get('id', 'Unknown')}, location_id={token_obj.LocationId}")
-        
-        invoice_payload, notary_order = build_invoice_payload(
-            order_obj, contact=contact_data, location_id=token_obj.LocationId,
-            event_obj=obj, client_user=client_user
-        )
-        
-        print("=== BUILD_INVOICE_PAYLOAD COMPLETED ===")
-        print(f"Invoice payload returned: {invoice_payload is not None}")
-        
-        if not invoice_payload:
-            print("ERROR: build_invoice_payload returned None")
-            return None
-        else:
-            print("Calling InvoiceServices.post_invoice...")
-            response = InvoiceServices.post_invoice(token_obj.LocationId, invoice_payload)
-            # print(f"Invoice response: {json.dumps(response, indent=4)}")
-            
-            if response:
-                print("Invoice created successfully, updating order...")
-                order_obj.location_id = token_obj.LocationId
-                order_obj.invoice_id = response.get("_id")
-                order_obj.save()
-                print(f"Order updated with invoice_id: {order_obj.invoice_id}")
-            else:
-                print("Failed to create invoice, skipping sending and payment recording.")
-                return None
-                
-            print("Sending invoice...")
-            send_invoice(response)
-            print("Recording payment...")
-            record_payment(response)
-        if payment_intent_id:
-            try:
-                pi = stripe.PaymentIntent.retrieve(payment_intent_id)
-                existing_metadata = pi.metadata or {}
-                order_id = str(notary_order.get("data", {}).get("order_id"))
-                new_metadata = {
-                    **existing_metadata,
-                    "notarydash_order_id":order_id,
-                }
-                stripe.PaymentIntent.modify(payment_intent_id, metadata=new_metadata)
-                print(f"✅ Metadata updated for PaymentIntent {payment_intent_id}")
-                
-                 # Check status and capture if needed (Manual capture flow)
-                pi = stripe.PaymentIntent.retrieve(payment_intent_id)
-                if pi.status == "requires_capture":
-                    print(f"PaymentIntent {payment_intent_id} requires capture. Capturing now...")
-                    stripe.PaymentIntent.capture(payment_intent_id)
-                    print(f"✅ Payment captured successfully")
-                else:
-                    print(f"PaymentIntent status is {pi.status}, skipping capture.")
-            except Exception as e:
-                print(f"❌ Failed to update PaymentIntent metadata: {e}")
-        else:
-            print("⚠️ No payment_intent ID found in session")
-        from stripe_payment.tasks import process_tos_for_ghl
-        process_tos_for_ghl(order_obj.user_id,contact_data["id"])
-    
-    except Exception as e:
-        print(f"ERROR in handle_checkout_session_completed: {str(e)}")
-        print(f"Exception type: {type(e).__name__}")
-        import traceback
-        print(f"Traceback: {traceback.format_exc()}")
-        return None
-    
+        ).replace("\n", "").replace('"', "'")
+
+    return {
+        "client_id": order.company_id,
+        "owner_id": order.owner_id,
+        "name": prd_name,
+        "pay_to_notary": 0,
+        "charge_client": final_price,
+        "scanbacks_required": False,
+        "attr": {
+            "additional_instructions": html_content,
+            # "scanbacks_instructions": "alias",
+            },
+        }
 
 
-def build_notary_order(order :Order, inv_data, prd_name, client_user, event_obj):
+def build_notary_order(order :Order, inv_data, prd_name, client_user, event_obj, prd_response=None):
     
     """
     Build Notary order payload based on given order and contact.
-
+    The product is created first unless `prd_response` (an earlier create_products response) is given.
     """
     print(f"=== BUILD NOTARY ORDER DEBUG START ===")
     print(f"Order ID: {order.id}")
@@ -1359,10 +929,6 @@ def build_notary_order(order :Order, inv_data, prd_name, client_user, event_obj)
     print(f"Order postalCode: {getattr(order, 'postalCode', None)}")
     print(f"Order contact_phone: {getattr(order, 'contact_phone', None)}")
 
-    # Handle polymorphic event_obj (Checkout Session or Payment Intent)
-    amount_cents = event_obj.get("amount_total") if event_obj.get("object") == "checkout.session" else event_obj.get("amount", 0)
-    final_price = amount_cents / 100 if amount_cents else 0
-  
     company_id = order.company_id
     client_id = order.user_id
     client_team_id = order.client_team_id
@@ -1375,13 +941,6 @@ def build_notary_order(order :Order, inv_data, prd_name, client_user, event_obj)
     
     }
     
-    html_content = render_to_string(
-        "order_product_detail.html", 
-        context={
-            "invoice_data":inv_data,
-            "order":order
-            }
-        ).replace("\n", "").replace('"', "'")
     order_status_emails_list = []
     if order.order_status_emails:
         order_status_emails_list = order.order_status_emails.split('\n')
@@ -1398,25 +957,14 @@ def build_notary_order(order :Order, inv_data, prd_name, client_user, event_obj)
     
 
     
-    notary_product={
-        "client_id": company_id,
-        "owner_id": order.owner_id,
-        "name": prd_name,
-        "pay_to_notary": 0,
-        "charge_client": final_price,
-        "scanbacks_required": False,
-        "attr": {
-            "additional_instructions": html_content,
-            # "scanbacks_instructions": "alias",
-            },
-        }
-    
-    # print(f"Notary product payload: {json.dumps(notary_product, indent=2)}")
-    
-    prd_response = None
     prd = {}
-    print(f"Calling NotaryDashServices.create_products...")
-    prd_response = NotaryDashServices.create_products(notary_product)
+    if prd_response is None:
+        notary_product = build_notary_product(order, inv_data, prd_name, event_obj)
+        # print(f"Notary product payload: {json.dumps(notary_product, indent=2)}")
+        print(f"Calling NotaryDashServices.create_products...")
+        prd_response = NotaryDashServices.create_products(
+            notary_product, idempotency_key=f"order-{order.pk}-notary-product"
+        )
     
     print(f"Product creation response: {prd_response}")
     if prd_response:
@@ -1480,7 +1028,7 @@ def build_notary_order(order :Order, inv_data, prd_name, client_user, event_obj)
     # print(f"Final notary order payload: {json.dumps(notary_order, indent=2)}")
     print(f"Calling NotaryDashServices.create_order...")
     
-    ord_response = NotaryDashServices.create_order(notary_order)
+    ord_response = NotaryDashServices.create_order(notary_order, idempotency_key=f"order-{order.pk}-notary-order")
     # print(f"Order creation response: {ord_response}")
 
     if ord_response and ord_response.get("data"):
@@ -1491,7 +1039,8 @@ def build_notary_order(order :Order, inv_data, prd_name, client_user, event_obj)
         inv_data["invoiceNumber"] = order_id
         print(f"Updated inv_data with invoiceNumber: {order_id}")
         print(f"=== BUILD NOTARY ORDER DEBUG END (SUCCESS) ===")
-        order.save()
+        # Only what this builder changed; OrderFulfilment writes fulfilment_state concurrently
+        order.save(update_fields=["notary_order_id", "service_type"])
         return inv_data, ord_response
     else:
         print(f"ERROR: Notary order creation failed")
@@ -1501,7 +1050,28 @@ def build_notary_order(order :Order, inv_data, prd_name, client_user, event_obj)
         
 def build_invoice_payload(order: Order , contact, location_id, event_obj, client_user):
     """
-    Build JSON payload for invoice based on given order.
+    Build JSON payload for invoice based on given order, creating the NotaryDash product and order on the way.
+    """
+    invoice_data, notary_product_names = build_invoice_data(order, contact, location_id, event_obj, client_user)
+    print(f"Initial invoice data created with invoiceNumber: {invoice_data['invoiceNumber']}")
+    print(f"Calling build_notary_order with product names: {notary_product_names}")
+    
+    invoice_data, notary_order = build_notary_order(order, inv_data=invoice_data, prd_name=notary_product_names, client_user=client_user, event_obj=event_obj)
+    
+    if invoice_data:
+      
+        print(f"Final invoice data has invoiceNumber: {invoice_data.get('invoiceNumber')}")
+        print(f"=== BUILD INVOICE PAYLOAD DEBUG END (SUCCESS) ===")
+    else:
+        print("ERROR: build_notary_order returned None")
+        print(f"=== BUILD INVOICE PAYLOAD DEBUG END (FAILURE) ===")
+        
+    return invoice_data, notary_order
+
+def build_invoice_data(order: Order, contact, location_id, event_obj, client_user):
+    """
+    Build the invoice JSON and the NotaryDash product name of the order, without any API call.
+    `contact` may be None; OrderFulfilment fills in contactDetails.id once the GHL contact exists.
     """
     print(f"=== BUILD INVOICE PAYLOAD DEBUG START ===")
     print(f"Order ID: {order.id}")
@@ -1543,55 +1113,24 @@ def build_invoice_payload(order: Order , contact, location_id, event_obj, client
 
     print(f"Building invoice items for order {order.id} (type: {order.service_type})")
 
-    # 🟩 1. Always include Bundles if any
-    bundles = order.bundles.all()
-    if bundles.exists():
-        print(f"Found {bundles.count()} bundles for order")
-
-        for bundle in bundles:
-            print(f"Processing bundle: {bundle.name} (${bundle.price})")
-            total_bundle_price += float(bundle.price or 0)
+    # 🟩 1. Bundles first, then 🟦 2. A La Carte items (same lines as the Stripe line items)
+    for line in order_price_lines(order):
+        is_bundle = line["metadata"] is None
+        print(f"Processing {'bundle' if is_bundle else 'item'}: {line['name']} (${line['price']})")
+        if is_bundle:
+            total_bundle_price += float(line["price"])
+        else:
+            total_ala_price += float(line["price"])
 
-            items.append(build_item(
-                name=bundle.name,
-                description=bundle.description,
-                price=bundle.price
-            ))
-            notary_product_names.append(bundle.name)
+        items.append(build_item(
+            name=line["name"],
+            description=line["description"] if is_bundle else (line["description"] or line["service_title"]),
+            price=line["price"]
+        ))
+        notary_product_names.append(line["product_name"])
 
-    # 🟦 2. Include A La Carte services if any
+    bundles = order.bundles.all()
     services = order.a_la_carte_services.all()
-    if services.exists():
-        print(f"Found {services.count()} A La Carte services")
-
-        for service in services:
-            for item in service.items.all():
-                submenu_parts = []
-                for sub in item.submenu_items.all():
-                    if sub.value > 0:
-                        label = f"{sub.label} X{sub.value}" if sub.value > 1 else sub.label
-                        submenu_parts.append(label)
-
-                # Selected options
-                selected_options = item.options.filter(value=True).values_list("label", flat=True)
-
-                # Build product name
-                title_parts = [item.title]
-                if submenu_parts:
-                    title_parts.append(" + ".join(submenu_parts))
-
-                option_suffix = f" ({' + '.join(selected_options)})" if selected_options else ""
-                product_name = f"{' + '.join(title_parts)}{option_suffix}"
-
-                price_value = item.price or item.base_price or 0
-                total_ala_price += float(price_value)
-
-                items.append(build_item(
-                    name=product_name,
-                    description=item.subtitle or service.title,
-                    price=price_value
-                ))
-                notary_product_names.append(item.item_id)
 
     # 🟥 3. Handle "mixed" automatically
     if bundles.exists() and services.exists():
@@ -1680,7 +1219,7 @@ def build_invoice_payload(order: Order , contact, location_id, event_obj, client
         "termsNotes": "<p>This is a default terms.</p>",
         "title": f"Invoice -{order.get_service_type_display() if order.service_type !="mixed" else "Bundle+A La Carte"}",
         "contactDetails": {
-            "id": contact.get("id"),
+            "id": contact.get("id") if contact else None,
             "name": client_user.get("name") or (order.contact_first_name_sched + " " + order.contact_last_name_sched if order.contact_first_name_sched and order.contact_last_name_sched else ""),
             "phoneNo": contact_ph or "",
             "email": client_user.get("email", ""),
@@ -1706,20 +1245,7 @@ def build_invoice_payload(order: Order , contact, location_id, event_obj, client
         "attachments": []
     }
     
-    print(f"Initial invoice data created with invoiceNumber: {invoice_data['invoiceNumber']}")
-    print(f"Calling build_notary_order with product names: {notary_product_names}")
-    
-    invoice_data, notary_order = build_notary_order(order, inv_data=invoice_data, prd_name=notary_product_names, client_user=client_user, event_obj=event_obj)
-    
-    if invoice_data:
-      
-        print(f"Final invoice data has invoiceNumber: {invoice_data.get('invoiceNumber')}")
-        print(f"=== BUILD INVOICE PAYLOAD DEBUG END (SUCCESS) ===")
-    else:
-        print("ERROR: build_notary_order returned None")
-        print(f"=== BUILD INVOICE PAYLOAD DEBUG END (FAILURE) ===")
-        
-    return invoice_data, notary_order
+    return invoice_data, notary_product_names
 
 def send_invoice(invoice_data):
     oauth_obj = OAuthToken.objects.get(LocationId=invoice_data.get("altId"))
@@ -1732,6 +1258,7 @@ def send_invoice(invoice_data):
     }
     response = InvoiceServices.send_invoice(invoice_data.get("altId"), invoice_data.get("_id"), payload)
     # print(f"Send invoice response: {json.dumps(response, indent=4)}")
+    return response
 
 def record_payment(invoice_data):
     oauth_obj = OAuthToken.objects.get(LocationId=invoice_data.get("altId"))
@@ -1751,6 +1278,7 @@ def record_payment(invoice_data):
     }
     response = InvoiceServices.record_payment(invoice_data.get("altId"), invoice_data.get("_id"), payload)
     # print(f"Record payment response: {json.dumps(response, indent=4)}")
+    return response
     
 
 
@@ -0,0 +1,204 @@
+# webhooks.py
+"""
+Stripe event type -> handler registry.
+
+A handler takes the stripe.Event and returns None on success or an error
+message when the event failed for good; raising makes the inbox retry it
+(see inbox.WebhookInbox) up to the handler's `max_attempts`.
+
+    run_async     False: handled inside the webhook request right after the
+                  event is stored (cheap DB-only handlers); True: queued.
+    queue         Celery queue for async handlers, so NotaryDash / GHL heavy
+                  work can get its own workers.
+    timeout       Celery soft time limit, in seconds; the inbox lock outlives it.
+    max_attempts  attempts before the event is marked failed.
+"""
+import datetime
+from dataclasses import dataclass
+from typing import Callable
+
+import stripe
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import Q
+from django.utils.timezone import make_aware
+
+from .models import Order, StripeCharge
+
+
+@dataclass(frozen=True)
+class WebhookHandler:
+    event_type: str
+    func: Callable
+    run_async: bool = True
+    queue: str | None = None
+    timeout: int = 60
+    max_attempts: int = 8
+
+    @property
+    def lock_timeout(self):
+        return self.timeout + 60
+
+
+HANDLERS: dict[str, WebhookHandler] = {}
+
+
+def register(*event_types, run_async=True, queue=None, timeout=60, max_attempts=None):
+    def decorator(func):
+        for event_type in event_types:
+            HANDLERS[event_type] = WebhookHandler(
+                event_type, func, run_async=run_async, queue=queue, timeout=timeout,
+                max_attempts=max_attempts or settings.WEBHOOK_MAX_ATTEMPTS,
+            )
+        return func
+    return decorator
+
+
+def handler_for(event_type) -> WebhookHandler | None:
+    return HANDLERS.get(event_type)
+
+
+def dispatch(event):
+    """Run the registered handler of `event`; unknown types are acknowledged and ignored."""
+    handler = handler_for(event['type'])
+    if handler is None:
+        print(f"⚠️ Unhandled event type: {event['type']}")
+        return None
+    print(f"Processing {event['type']} {event['id']}")
+    return handler.func(event)
+
+
+def _timestamp(value):
+    return make_aware(datetime.datetime.fromtimestamp(value))
+
+
+# ----------------------------------------------------------------------
+# Charges
+# ----------------------------------------------------------------------
+@register("charge.succeeded", "charge.updated", "charge.failed", "charge.refunded", run_async=False)
+def upsert_charge(event):
+    """
+    Upsert the StripeCharge of a charge.* event, unless a newer event was already applied.
+
+    Stripe does not deliver events in order. Events of one payment intent are
+    serialized with a row lock and compared by their `created` timestamp, so a
+    late charge.succeeded can no longer overwrite a newer charge.updated.
+    """
+    obj = event['data']['object']
+    event_created = _timestamp(event['created'])
+    card = obj.get("payment_method_details", {}).get("card", {})
+    values = {
+        "payment_intent_id": obj.get("payment_intent"),
+        "amount": obj["amount"],
+        "amount_refunded": obj.get("amount_refunded") or 0,
+        "refunded": obj.get("refunded", False),
+        "currency": obj["currency"],
+        "paid": obj["paid"],
+        "status": obj["status"],
+        "captured": obj["captured"],
+        "receipt_url": obj.get("receipt_url"),
+        "customer_email": obj.get("billing_details", {}).get("email"),
+        "customer_name": obj.get("billing_details", {}).get("name"),
+        "billing_country": obj.get("billing_details", {}).get("address", {}).get("country"),
+        "brand": card.get("brand"),
+        "last4": card.get("last4"),
+        "exp_month": card.get("exp_month"),
+        "exp_year": card.get("exp_year"),
+        "network_transaction_id": card.get("network_transaction_id"),
+        "created": _timestamp(obj["created"]),
+        "livemode": obj.get("livemode", False),
+        "event_created": event_created,
+    }
+    if event['type'] == "charge.failed":
+        print(f"❌ Charge {obj['id']} failed: {obj.get('failure_code')} {obj.get('failure_message')}")
+    elif event['type'] == "charge.refunded":
+        print(f"↩️ Charge {obj['id']} refunded {values['amount_refunded']} of {values['amount']} {values['currency']}")
+
+    # First event for this charge
+    try:
+        with transaction.atomic():
+            StripeCharge.objects.create(charge_id=obj['id'], **values)
+            return None
+    except IntegrityError:
+        pass
+
+    with transaction.atomic():
+        locked = StripeCharge.objects.select_for_update().filter(
+            Q(charge_id=obj['id']) | Q(payment_intent_id=obj.get("payment_intent"), payment_intent_id__isnull=False)
+        ).order_by("charge_id")
+        charge = next(c for c in locked if c.charge_id == obj['id'])
+
+        if charge.event_created and charge.event_created > event_created:
+            print(f"⏭️ Skipping stale {event['type']} for {charge.charge_id} ({event_created} < {charge.event_created})")
+            return None
+        # Same-second events arrive in any order; a charge never goes back to unpaid / uncaptured / unrefunded
+        if charge.event_created == event_created:
+            values["paid"] = values["paid"] or charge.paid
+            values["captured"] = values["captured"] or charge.captured
+            values["refunded"] = values["refunded"] or charge.refunded
+            values["amount_refunded"] = max(values["amount_refunded"], charge.amount_refunded)
+
+        for field, value in values.items():
+            setattr(charge, field, value)
+        charge.save()
+    return None
+
+
+# ----------------------------------------------------------------------
+# Payment intents
+# ----------------------------------------------------------------------
+@register("payment_intent.succeeded", run_async=False)
+def payment_intent_succeeded(event):
+    """Stamp paid_at on the order the payment intent belongs to."""
+    obj = event['data']['object']
+    order_id = (obj.get("metadata") or {}).get("order_id")
+    query = Q(stripe_intent_id=obj["id"])
+    if order_id and str(order_id).isdigit():
+        query |= Q(id=order_id)
+
+    updated = Order.objects.filter(query, paid_at__isnull=True).update(paid_at=_timestamp(obj["created"]))
+    print(f"💰 PaymentIntent {obj['id']} succeeded ({updated} order(s) marked paid)")
+    return None
+
+
+@register("payment_intent.amount_capturable_updated", queue=settings.WEBHOOK_ORDER_QUEUE, timeout=300)
+def payment_intent_capturable(event):
+    from .views import handle_payment_intent_requires_action
+
+    if not handle_payment_intent_requires_action(event):
+        return "Failed to process PaymentIntent order."
+    return None
+
+
+# ----------------------------------------------------------------------
+# Checkout
+# ----------------------------------------------------------------------
+@register("checkout.session.completed", queue=settings.WEBHOOK_ORDER_QUEUE, timeout=300)
+def checkout_session_completed(event):
+    from .views import handle_checkout_session_completed
+
+    data_object = event['data']['object']
+    print(f"Session ID: {data_object.get('id')}")
+    print(f"Payment status: {data_object.get('payment_status')}")
+    print(f"Amount total: {data_object.get('amount_total')}")
+
+    # A failed fulfilment raises FulfilmentError: the inbox retries the event and the
+    # fulfilment resumes from its saved state. Only a missing order ends up here as None.
+    session_obj = handle_checkout_session_completed(event)
+    print(f"handle_checkout_session_completed returned: {session_obj is not None}")
+
+    if not session_obj:
+        msg = "Failed to process CheckoutSession. Expiring session due to server error."
+        print(f"❌ {msg}")
+
+        # Expire the session
+        try:
+            stripe.checkout.Session.expire(data_object.get("id"))
+            print("✅ Session expired successfully")
+        except Exception as e:
+            print(f"❌ Failed to expire session: {e}")
+        return msg
+
+    # The payment itself is captured by the fulfilment (OrderFulfilment `captured` step)
+    print("✅ Session processed successfully")
+    return None
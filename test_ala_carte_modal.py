@@ -74,7 +74,10 @@ def test_modal_option_creation():
     
     print("Testing NTinperson (Should have 'Signers Name' only)")
     item_data_inperson = service_data["form"]["items"][0]
-    item_inperson = ALaCarteItem.from_api(service, item_data_inperson, service_data["form"], service_totals)
+    rows = ALaCarteItem.from_api(service, item_data_inperson, service_data["form"], service_totals)
+    for row in rows:
+        row.save()
+    item_inperson = rows[0]
     
     modal_options_inperson = ALaCarteItemModalOption.objects.filter(item=item_inperson)
     print(f"Count: {modal_options_inperson.count()}")
@@ -83,7 +86,10 @@ def test_modal_option_creation():
         
     print("\nTesting NTonline (Should have 'Signers Name' and 'Email')")
     item_data_online = service_data["form"]["items"][1]
-    item_online = ALaCarteItem.from_api(service, item_data_online, service_data["form"], service_totals)
+    rows = ALaCarteItem.from_api(service, item_data_online, service_data["form"], service_totals)
+    for row in rows:
+        row.save()
+    item_online = rows[0]
     
     modal_options_online = ALaCarteItemModalOption.objects.filter(item=item_online)
     print(f"Count: {modal_options_online.count()}")